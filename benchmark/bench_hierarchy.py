@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+'''bench_hierarchy.py [entries...] -- compare hierarchy.hierarchy against the old list-based trie
+
+Two layouts are measured: "grouped", components in a thousand groups with a tenth of them
+holding a nested repo, as a large manifest might be; and "flat", every repo at the top level,
+where the old implementation's list searches make it quadratic.  The old implementation is
+only run up to OLD_LIMIT paths of each layout.'''
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from rug import hierarchy
+
+DEFAULT_SIZES = [10000, 100000]
+OLD_LIMIT = {'grouped': 100000, 'flat': 10000}
+
+#The implementation hierarchy.py used before the dict-backed trie, kept for comparison
+def old_dfs(info):
+	ret = []
+	for c in info[3]:
+		if c[0]:
+			ret.append(c[0])
+		else:
+			ret.extend(old_dfs(c))
+	return ret
+
+def old_hierarchy(paths):
+	path_split = map(lambda x:[s for s in x.split(os.path.sep) if s not in ['','.']], paths)
+
+	root = [None, None, [], []]
+	path_leaves = []
+
+	for idx in range(len(paths)):
+		cursor = root
+		for d in path_split[idx]:
+			try:
+				cursor = cursor[3][cursor[2].index(d)]
+			except ValueError:
+				cursor[2].append(d)
+				new_cursor = [None, cursor, [], []]
+				cursor[3].append(new_cursor)
+				cursor = new_cursor
+		if cursor[0] is not None:
+			raise ValueError('Duplicate paths: "%s" and "%s"' % (cursor[0], paths[idx]))
+		else:
+			cursor[0] = paths[idx]
+			path_leaves.append(cursor)
+
+	path_dict = {}
+	for idx in range(len(paths)):
+		path_dict[paths[idx]] = old_dfs(path_leaves[idx])
+
+	return path_dict
+
+def generate(layout, entries):
+	if layout == 'flat':
+		return ['component%06d' % idx for idx in range(entries)]
+	paths = []
+	idx = 0
+	while len(paths) < entries:
+		path = 'group%03d/component%06d' % (idx % 1000, idx)
+		paths.append(path)
+		if (idx % 10 == 0) and (len(paths) < entries):
+			paths.append(path + '/external/nested')
+		idx += 1
+	return paths
+
+def timed(func, *args):
+	start = time.time()
+	ret = func(*args)
+	return (time.time() - start, ret)
+
+def main():
+	sizes = map(int, sys.argv[1:]) or DEFAULT_SIZES
+	print '%8s %8s %10s %10s %12s %12s' % ('layout', 'entries', 'old', 'trie', 'trie_add', 'trie_remove')
+	for (layout, entries) in [(l, e) for l in ['grouped', 'flat'] for e in sizes]:
+		paths = generate(layout, entries)
+		(trie_seconds, trie_ret) = timed(hierarchy.hierarchy, paths)
+		if entries <= OLD_LIMIT[layout]:
+			(old_seconds, old_ret) = timed(old_hierarchy, paths)
+			assert dict([(k, sorted(v)) for (k, v) in old_ret.items()]) == dict([(k, sorted(v)) for (k, v) in trie_ret.items()])
+			old = '%10.3f' % old_seconds
+		else:
+			old = '%10s' % '-'
+
+		#incremental changes, as Project.add and remove make them
+		trie = hierarchy.Trie(paths)
+		extra = ['added/repo%06d' % idx for idx in range(1000)]
+		(add_seconds, ret) = timed(lambda: map(trie.add, extra))
+		(remove_seconds, ret) = timed(lambda: map(trie.remove, extra))
+		print '%8s %8d %s %10.3f %12.6f %12.6f' % (layout, entries, old, trie_seconds, add_seconds / len(extra), remove_seconds / len(extra))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+'''bench_manifest.py [entries...] -- compare manifest read/write against the old xml.dom.minidom code
+
+Each measurement runs in a fresh interpreter so that peak RSS belongs to one implementation.'''
+import os
+import sys
+import time
+import resource
+import tempfile
+import subprocess
+import xml.dom.minidom
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from rug import manifest
+
+DEFAULT_SIZES = [1000, 20000]
+
+#The minidom implementation manifest.py used before streaming, kept for comparison
+def minidom_read(file_or_name, default_default=None):
+	doc = xml.dom.minidom.parse(file_or_name)
+	default = {}
+	if default_default is not None:
+		default.update(default_default)
+	for node in doc.getElementsByTagName('default'):
+		default.update(node.attributes.items())
+	remotes = {}
+	for node in doc.getElementsByTagName('remote'):
+		remote = dict(node.attributes.items())
+		remotes[remote['name']] = remote
+	repos = {}
+	for node in sum(map(doc.getElementsByTagName, ['repo', 'project']), []):
+		repo = {}
+		repo.update(default)
+		repo.update(node.attributes.items())
+		repos[repo['path']] = repo
+	return (remotes, repos)
+
+def minidom_write(filename, remotes, repos, default):
+	doc = xml.dom.minidom.Document()
+	m = doc.createElement('manifest')
+	doc.appendChild(m)
+	node = doc.createElement('default')
+	for (k,v) in sorted(default.items()):
+		node.setAttribute(k,v)
+	m.appendChild(node)
+	for remote in sorted(remotes.values(), key=lambda x:x['name']):
+		node = doc.createElement('remote')
+		for (k,v) in sorted(remote.items()):
+			node.setAttribute(k,v)
+		m.appendChild(node)
+	for repo in sorted(repos.values(), key=lambda x:x['name']):
+		node = doc.createElement('repo')
+		for (k,v) in sorted(repo.items()):
+			node.setAttribute(k,v)
+		m.appendChild(node)
+	f = open(filename, 'w')
+	doc.writexml(f, newl='\n', addindent='\t')
+	f.close()
+
+IMPLEMENTATIONS = {
+	'minidom': (minidom_read, minidom_write),
+	'streaming': (lambda f, default_default=None: manifest.read(f, default_default=default_default), manifest.write),
+}
+
+def generate(entries):
+	remotes = {'origin': {'name': 'origin', 'fetch': 'ssh://git.example.com/projects'}}
+	repos = {}
+	for idx in range(entries):
+		path = 'group%03d/component%06d' % (idx % 1000, idx)
+		repos[path] = {'path': path, 'name': 'component%06d' % idx, 'revision': 'release/%d' % (idx % 7)}
+	return (remotes, repos, {'remote': 'origin', 'revision': 'master'})
+
+def measure(impl, op, filename, entries):
+	(read, write) = IMPLEMENTATIONS[impl]
+	if op == 'read':
+		start = time.time()
+		read(filename, default_default={'vcs': 'git'})
+	else:
+		(remotes, repos, default) = generate(entries)
+		start = time.time()
+		write(filename, remotes, repos, default)
+	elapsed = time.time() - start
+	#ru_maxrss is in kilobytes on Linux
+	print '%f %d' % (elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+def main():
+	if (len(sys.argv) > 1) and (sys.argv[1] == '--measure'):
+		measure(sys.argv[2], sys.argv[3], sys.argv[4], int(sys.argv[5]))
+		return
+
+	sizes = map(int, sys.argv[1:]) or DEFAULT_SIZES
+	print '%8s %10s %6s %10s %12s' % ('entries', 'impl', 'op', 'seconds', 'peak_rss_kb')
+	for entries in sizes:
+		(fd, filename) = tempfile.mkstemp(suffix='.xml')
+		os.close(fd)
+		try:
+			(remotes, repos, default) = generate(entries)
+			manifest.write(filename, remotes, repos, default)
+			for op in ['read', 'write']:
+				for impl in sorted(IMPLEMENTATIONS):
+					target = filename
+					if op == 'write':
+						target = filename + '.' + impl
+					out = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--measure', impl, op, target, str(entries)],
+						stdout=subprocess.PIPE).communicate()[0]
+					(seconds, rss) = out.split()
+					print '%8d %10s %6s %10.3f %12s' % (entries, impl, op, float(seconds), rss)
+					if op == 'write':
+						os.remove(target)
+		finally:
+			os.remove(filename)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+'''bench_project.py [options] -- time rug commands on synthetic projects built on local disk
+
+Each size gets a fresh project: bare repos with generated history, nested as requested, listed
+in a manifest, all served from file:// remotes.  The rug commands a user would run are then
+timed one by one, each in its own interpreter, and the git commands each one starts are
+counted from its --trace-json output (long-lived cat-file --batch channels aren't included).
+The publish result also records how many of the locally changed repos reached their remotes.
+
+options:
+  --repos=N[,N...]   project sizes (default 10,100,1000)
+  --depth=N          commits of history per repo (default 5)
+  --files=N          files per repo (default 10)
+  --nesting=N        repos per chain of nested repos, 1 for none (default 1)
+  --changes=N        percentage of repos changed before fetch/update and commit (default 10)
+  --jobs=N           -j passed to the rug commands that take it
+  --output=FILE      write the JSON results to FILE instead of stdout
+  --keep=DIR         build the projects under DIR and leave them there'''
+import os
+import sys
+import json
+import time
+import getopt
+import shutil
+import tempfile
+import platform
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from rug import git, manifest, version
+
+RUG = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'rug', 'rug.py')
+DEFAULT_SIZES = [10, 100, 1000]
+
+#commits are made by the benchmark and by rug itself: give both a fixed identity
+ENV = dict(os.environ)
+ENV.update({
+	'GIT_AUTHOR_NAME': 'bench',
+	'GIT_AUTHOR_EMAIL': 'bench@example.com',
+	'GIT_COMMITTER_NAME': 'bench',
+	'GIT_COMMITTER_EMAIL': 'bench@example.com',
+})
+
+def history(name, commits, files, first=0):
+	'''history(name, commits, files, first=0) -> git fast-import stream for master
+	The first commit of a new repo adds every file; each later commit changes one.'''
+	lines = []
+	for idx in range(first, first + commits):
+		message = '%s commit %d' % (name, idx)
+		lines.append('commit refs/heads/master')
+		lines.append('committer bench <bench@example.com> %d +0000' % (1000000000 + idx))
+		lines.append('data %d' % len(message))
+		lines.append(message)
+		if (idx == first) and first:
+			lines.append('from refs/heads/master^0')
+		if idx == 0:
+			changed = range(files)
+		else:
+			changed = [idx % files]
+		for f in changed:
+			content = '%s file %d version %d\n' % (name, f, idx)
+			lines.append('M 644 inline file%03d' % f)
+			lines.append('data %d' % len(content))
+			lines.append(content)
+	return '\n'.join(lines) + '\n'
+
+def repo_paths(repos, nesting):
+	'repo_paths(repos, nesting) -> working tree paths, chains of nesting repos each inside the last'
+	paths = []
+	for idx in range(repos):
+		name = 'r%04d' % idx
+		if (idx % nesting) and paths:
+			paths.append(paths[-1] + '/' + name)
+		else:
+			paths.append(name)
+	return paths
+
+def generate(root, repos, depth, files, nesting):
+	'''generate(root, repos, depth, files, nesting) -> url of the manifest repo of a new project
+	The bare repos are created under root/remotes.'''
+	remotes = os.path.join(root, 'remotes')
+	os.makedirs(remotes)
+	repo_dict = {}
+	for (idx, path) in enumerate(repo_paths(repos, nesting)):
+		name = 'r%04d' % idx
+		bare = os.path.join(remotes, name)
+		git.shell_cmd(git.GIT, ['init', '-q', '--bare', bare])
+		git.shell_cmd(git.GIT, ['symbolic-ref', 'HEAD', 'refs/heads/master'], cwd=bare)
+		git.shell_cmd(git.GIT, ['fast-import', '--quiet'], cwd=bare, input=history(name, depth, files))
+		repo_dict[path] = {'path': path, 'name': name}
+
+	src = os.path.join(root, 'manifest_src')
+	os.makedirs(src)
+	manifest.write(os.path.join(src, 'manifest.xml'),
+		{'origin': {'name': 'origin', 'fetch': 'file://' + remotes}}, repo_dict,
+		{'remote': 'origin', 'revision': 'master'})
+	for args in [['init', '-q'], ['symbolic-ref', 'HEAD', 'refs/heads/master'], ['add', 'manifest.xml'], ['commit', '-q', '-m', 'manifest'],
+			['clone', '-q', '--bare', src, os.path.join(remotes, 'manifest')]]:
+		subprocess.check_call([git.GIT] + args, cwd=src, env=ENV)
+	return 'file://' + os.path.join(remotes, 'manifest')
+
+def change_remotes(root, repos, percent, depth, files):
+	'add a commit to percent% of the bare repos, as if others had pushed'
+	remotes = os.path.join(root, 'remotes')
+	for idx in range(0, repos, max(1, 100 / max(1, percent))):
+		name = 'r%04d' % idx
+		git.shell_cmd(git.GIT, ['fast-import', '--quiet'], cwd=os.path.join(remotes, name),
+			input=history(name, 1, files, first=depth))
+
+def changed_working(repos, percent):
+	'''changed_working(repos, percent) -> indices of the repos change_working modifies
+	Repos changed by change_remotes are avoided where possible, so publishing doesn't depend on update.'''
+	step = max(1, 100 / max(1, percent))
+	return range(step / 2, repos, step)
+
+def change_working(project, repos, percent, nesting):
+	'modify a tracked file in percent% of the repos in the working project'
+	paths = repo_paths(repos, nesting)
+	for idx in changed_working(repos, percent):
+		f = open(os.path.join(project, paths[idx], 'file000'), 'a')
+		f.write('local change\n')
+		f.close()
+
+def published(root, project, repos, percent, nesting):
+	'published(...) -> number of the repos change_working modified whose commit reached the remote'
+	paths = repo_paths(repos, nesting)
+	count = 0
+	for idx in changed_working(repos, percent):
+		local = git.shell_cmd(git.GIT, ['rev-parse', 'HEAD'], cwd=os.path.join(project, paths[idx]))
+		remote = git.shell_cmd(git.GIT, ['rev-parse', 'master'], cwd=os.path.join(root, 'remotes', 'r%04d' % idx))
+		if local == remote:
+			count += 1
+	return count
+
+def rug(cwd, args):
+	'''rug(cwd, args) -> (seconds, git commands run, exit code) of one rug command'''
+	(fd, trace_file) = tempfile.mkstemp(suffix='.json')
+	os.close(fd)
+	try:
+		devnull = open(os.devnull, 'w')
+		start = time.time()
+		ret = subprocess.call([sys.executable, RUG, '--trace-json=%s' % trace_file] + args,
+			cwd=cwd, env=ENV, stdout=devnull, stderr=devnull)
+		seconds = time.time() - start
+		devnull.close()
+		try:
+			events = json.load(open(trace_file))['traceEvents']
+			commands = len([e for e in events if e['cat'] == 'command'])
+		except ValueError:
+			#rug died before writing the trace
+			commands = None
+		return (seconds, commands, ret)
+	finally:
+		os.remove(trace_file)
+
+def bench(root, repos, depth, files, nesting, percent, jobs):
+	'bench(...) -> list of result dictionaries for one project size'
+	url = generate(root, repos, depth, files, nesting)
+	project = os.path.join(root, 'project')
+	jobs_args = jobs and ['-j', str(jobs)] or []
+
+	steps = [
+		('clone', root, ['clone'] + jobs_args + [url, project], None),
+		('checkout', project, ['checkout'] + jobs_args, None),
+		('status', project, ['status'] + jobs_args, None),
+		('status -p', project, ['status', '-p'] + jobs_args, None),
+		('fetch (no changes)', project, ['fetch'] + jobs_args, None),
+		('fetch', project, ['fetch'] + jobs_args, lambda: change_remotes(root, repos, percent, depth, files)),
+		('update', project, ['update'], None),
+		('commit', project, ['commit', '-a', '-r', '-m', 'bench'], lambda: change_working(project, repos, percent, nesting)),
+		('publish', project, ['publish'] + jobs_args, None),
+	]
+	results = []
+	for (name, cwd, args, prepare) in steps:
+		if prepare is not None:
+			prepare()
+		(seconds, commands, ret) = rug(cwd, args)
+		results.append({'repos': repos, 'command': name, 'seconds': round(seconds, 4),
+			'git_commands': commands, 'exit_code': ret})
+		sys.stderr.write('%6d %-20s %10.3f %8s %5d\n' % (repos, name, seconds, commands, ret))
+
+	#a publish that pushed nothing would time a no-op
+	count = published(root, project, repos, percent, nesting)
+	results[-1]['published_repos'] = count
+	if count != len(changed_working(repos, percent)):
+		sys.stderr.write('warning: publish pushed %d of %d changed repos\n' % (count, len(changed_working(repos, percent))))
+	return results
+
+def main():
+	[optlist, args] = getopt.gnu_getopt(sys.argv[1:], '',
+		['repos=', 'depth=', 'files=', 'nesting=', 'changes=', 'jobs=', 'output=', 'keep='])
+	opts = dict(optlist)
+	sizes = map(int, opts.get('--repos', ','.join(map(str, DEFAULT_SIZES))).split(','))
+	depth = int(opts.get('--depth', 5))
+	files = int(opts.get('--files', 10))
+	nesting = max(1, int(opts.get('--nesting', 1)))
+	percent = int(opts.get('--changes', 10))
+	jobs = opts.has_key('--jobs') and int(opts['--jobs']) or None
+
+	info = {
+		'rug_version': version.__version__,
+		'git_version': git.shell_cmd(git.GIT, ['--version']),
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'parameters': {'depth': depth, 'files': files, 'nesting': nesting, 'changes': percent, 'jobs': jobs},
+		'results': [],
+	}
+	sys.stderr.write('%6s %-20s %10s %8s %5s\n' % ('repos', 'command', 'seconds', 'git_cmds', 'exit'))
+	for repos in sizes:
+		if opts.has_key('--keep'):
+			root = os.path.join(os.path.abspath(opts['--keep']), 'repos%d' % repos)
+			if os.path.exists(root):
+				shutil.rmtree(root)
+			os.makedirs(root)
+		else:
+			root = tempfile.mkdtemp(prefix='rug-bench-')
+		try:
+			info['results'] += bench(root, repos, depth, files, nesting, percent, jobs)
+		finally:
+			if not opts.has_key('--keep'):
+				shutil.rmtree(root)
+
+	if opts.has_key('--output'):
+		f = open(opts['--output'], 'w')
+		json.dump(info, f, indent=1)
+		f.close()
+	else:
+		print json.dumps(info, indent=1)
+
+if __name__ == '__main__':
+	main()
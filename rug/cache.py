@@ -0,0 +1,83 @@
+import os
+import shutil
+import hashlib
+import tempfile
+try:
+	import fcntl
+except ImportError:
+	#no locking where fcntl isn't available
+	fcntl = None
+import git
+
+#Environment variable naming the object cache directory, for every project on the machine
+RUG_CACHE_ENV = 'RUG_OBJECT_CACHE'
+
+class ObjectCache(object):
+	'''ObjectCache(cache_dir) -- a directory of bare mirrors, one per remote URL
+	Clones borrow objects from a mirror through git's alternates mechanism, so each object is
+	downloaded once per machine instead of once per checkout.  Mirrors are only ever added to:
+	their garbage collection is disabled, since other repositories depend on their objects.
+	Creating and updating a mirror holds a lock on it, so concurrent rug commands (and the
+	worker threads of a single command) can share a cache.'''
+
+	def __init__(self, cache_dir):
+		self.dir = os.path.abspath(cache_dir)
+
+	def mirror_dir(self, url):
+		'mirror_dir(url) -> path of the mirror for url, which may not exist yet'
+		name = os.path.splitext(os.path.basename(url.rstrip('/')))[0] or 'repo'
+		return os.path.join(self.dir, '%s-%s.git' % (name, hashlib.sha1(url).hexdigest()))
+
+	def lock(self, url):
+		'lock(url) -> open lock file for url\'s mirror, locked exclusively; close it to unlock'
+		if not os.path.exists(self.dir):
+			try:
+				os.makedirs(self.dir)
+			except OSError:
+				#created concurrently
+				if not os.path.isdir(self.dir):
+					raise
+		f = open(self.mirror_dir(url) + '.lock', 'a')
+		if fcntl is not None:
+			fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+		return f
+
+	def mirror(self, url):
+		'''mirror(url) -> path of an up to date mirror of url, created if necessary
+		The path is suitable for git.Repo.clone's reference argument.'''
+		lock = self.lock(url)
+		try:
+			path = self.mirror_dir(url)
+			if git.Repo.valid_repo(path):
+				self._fetch(path)
+			else:
+				#clone next to the final location and rename, so an interrupted clone
+				#never leaves a partial mirror behind
+				tmp = tempfile.mkdtemp(prefix='tmp-', dir=self.dir)
+				try:
+					git.shell_cmd(git.GIT, ['clone', '-q', '--mirror', url, tmp])
+					for (name, value) in [('gc.auto', '0'), ('gc.pruneExpire', 'never')]:
+						git.shell_cmd(git.GIT, ['config', name, value], cwd=tmp)
+					if os.path.exists(path):
+						shutil.rmtree(path)
+					os.rename(tmp, path)
+				except:
+					shutil.rmtree(tmp, ignore_errors=True)
+					raise
+			return path
+		finally:
+			lock.close()
+
+	def update(self, url):
+		'update(url) -- fetch into url\'s mirror, if there is one'
+		lock = self.lock(url)
+		try:
+			path = self.mirror_dir(url)
+			if git.Repo.valid_repo(path):
+				self._fetch(path)
+		finally:
+			lock.close()
+
+	def _fetch(self, path):
+		#no --prune: refs may go, but objects other repositories borrow must stay
+		git.shell_cmd(git.GIT, ['fetch', '-q', 'origin'], cwd=path)
@@ -1,4 +1,6 @@
+import os
 import string
+import tempfile
 
 class ConfigFile(object):
 	#section_header = re.compile('\[(?P<section>[^]]*)\]')
@@ -74,4 +76,18 @@ class ConfigFile(object):
 			file.write('\n')
 
 	def to_path(self, path):
-		self.to_file(open(path, 'w'))
+		'''to_path(path) -- write to path atomically
+		The file is written beside path under a temporary name and renamed over it, so readers
+		see either the old contents or the new, never a partial file.'''
+		(fd, tmp) = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '-', dir=os.path.dirname(os.path.abspath(path)))
+		try:
+			if os.path.exists(path):
+				#mkstemp creates the file private: keep the mode path had
+				os.chmod(tmp, os.stat(path).st_mode & 07777)
+			f = os.fdopen(fd, 'w')
+			self.to_file(f)
+			f.close()
+			os.rename(tmp, path)
+		except:
+			os.remove(tmp)
+			raise
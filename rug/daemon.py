@@ -0,0 +1,287 @@
+import os
+import json
+import errno
+import socket
+import threading
+import output
+from project import Project, RugError, RUG_DIR
+
+#Name of the daemon's socket, in the project's rug directory
+RUG_DAEMON_SOCKET = 'daemon.sock'
+
+class DaemonError(RugError):
+	pass
+
+def socket_path(project_dir):
+	'socket_path(project_dir) -> path of the socket a daemon for the project listens on'
+	if Project.valid_bare_project(project_dir):
+		rug_dir = project_dir
+	else:
+		rug_dir = os.path.join(project_dir, RUG_DIR)
+	return os.path.join(rug_dir, RUG_DAEMON_SOCKET)
+
+def answers(command, args):
+	'''answers(command, args) -> whether the daemon can run the command
+	Only queries are answered: commands that change the project run in the caller's process.'''
+	return (command in ['status', 'revset_list']) or ((command == 'revset') and not args)
+
+def file_stamp(path):
+	'file_stamp(path) -> value that changes whenever the file at path does, None if it doesn\'t exist'
+	try:
+		st = os.stat(path)
+	except OSError:
+		return None
+	return (st.st_mtime, st.st_size, st.st_ino)
+
+def refs_stamp(git_dir):
+	'''refs_stamp(git_dir) -> value that changes whenever a ref in the repository does
+	Git changes a loose ref by renaming a new file over it, which touches its directory, so the
+	directories under refs/ are stamped rather than every ref file.'''
+	stamps = [file_stamp(os.path.join(git_dir, 'HEAD')), file_stamp(os.path.join(git_dir, 'packed-refs'))]
+	for (dirpath, dirnames, filenames) in os.walk(os.path.join(git_dir, 'refs')):
+		stamps.append((dirpath, file_stamp(dirpath)))
+	return stamps
+
+def decode(obj):
+	#json gives unicode strings; rug passes plain strings around
+	if isinstance(obj, unicode):
+		return obj.encode('utf-8')
+	elif isinstance(obj, list):
+		return map(decode, obj)
+	elif isinstance(obj, dict):
+		return dict([(decode(k), decode(v)) for (k, v) in obj.items()])
+	else:
+		return obj
+
+def send(conn, message):
+	conn.sendall(json.dumps(message) + '\n')
+
+class RequestWriter(output.Writer):
+	'''RequestWriter() -- writer for the daemon's project, collecting the output of the request running
+	The project and the buffers of its repos are created once, so the destination is switched
+	instead.  Requests are run one at a time.'''
+
+	def __init__(self):
+		super(RequestWriter, self).__init__()
+		self.target = None
+
+	def write(self, str):
+		if self.target is not None:
+			self.target.write(str)
+
+class Daemon(object):
+	'''Daemon(project_dir, commands) -- a resident process answering queries about one project
+	The project, its manifest and the repos and ref snapshots built while answering are kept
+	between requests.  Before each request, whatever changed on disk since the last one is
+	reloaded: the manifest if its file changed, a repo's refs if any of its refs changed, and a
+	repo entry if the repo appeared or disappeared from the working tree.  Where the working
+	tree can be watched (see Project.watch), repos' status is also kept until files under them
+	change; otherwise it is queried afresh by every command.
+	commands maps the command names the daemon answers to the rug command functions.'''
+
+	def __init__(self, project_dir, commands):
+		self.commands = commands
+		self.writer = RequestWriter()
+		self.output = output.EventOutputBuffer(self.writer)
+		self.project = Project(project_dir, output_buffer=self.output)
+		#status only re-examines the repos that changed, where that can be watched
+		self.project.watch()
+		self.path = socket_path(self.project.dir)
+		#path: stamp of the manifest files and repos seen so far, see refresh
+		self.stamps = {}
+		#requests run one at a time, see RequestWriter
+		self.lock = threading.Lock()
+		self.sock = None
+		self.running = False
+		#request threads, waited for before serve returns
+		self.threads = []
+
+	def refresh(self, project=None):
+		'refresh() -- reload the parts of the project state that changed on disk since the last call'
+		if project is None:
+			project = self.project
+		stamp = file_stamp(project.manifest_filename)
+		if self.stamps.get(project.manifest_filename, stamp) != stamp:
+			project.read_manifest()
+		self.stamps[project.manifest_filename] = stamp
+
+		self.refresh_repo(project.manifest_repo)
+		for r in project.repos.values():
+			#repos created or removed since are recreated on next use; the refs of the
+			#others are only reloaded if they changed, see refresh_repo
+			project.reload_repo(r['path'], refs=False)
+			#repo objects that haven't been created yet have nothing to refresh
+			if dict.__contains__(r, 'repo') and (r['repo'] is not None):
+				self.refresh_repo(r['repo'])
+
+	def refresh_repo(self, repo):
+		if hasattr(repo, 'project'):
+			#rug subproject
+			self.refresh(repo.project)
+			return
+		stamp = refs_stamp(repo.git_dir)
+		if self.stamps.get(repo.git_dir) != stamp:
+			#refs may also have been loaded before the repo was first stamped
+			repo.invalidate_refs()
+			repo.batch.close()
+			self.stamps[repo.git_dir] = stamp
+
+	def run(self, conn, request):
+		'run(conn, request) -- answer one request, sending its output and result on conn as they are produced'
+		command = request['command']
+		args = request.get('args', [])
+		if (command not in self.commands) or not answers(command, args):
+			raise DaemonError('%s is not answered by the daemon' % command)
+
+		log = output.StringWriter()
+		self.writer.target = log
+		try:
+			self.refresh()
+			ret = self.commands[command](self.project, request.get('options', {}), *args)
+			if isinstance(ret, basestring):
+				send(conn, {'stdout': ret})
+			elif ret is not None:
+				#streamed output
+				for chunk in ret:
+					send(conn, {'stdout': chunk})
+		finally:
+			self.output.flush()
+			self.writer.target = None
+		send(conn, {'stderr': log.string})
+
+	def handle(self, conn):
+		f = conn.makefile('r')
+		try:
+			request = decode(json.loads(f.readline()))
+			if request.get('command') == 'stop':
+				send(conn, {'exit': 0})
+				self.stop()
+				return
+			with self.lock:
+				self.run(conn, request)
+			send(conn, {'exit': 0})
+		except Exception, e:
+			try:
+				send(conn, {'error': '%s: %s' % (type(e).__name__, e)})
+			except socket.error:
+				#client went away
+				pass
+		finally:
+			f.close()
+			conn.close()
+
+	def listen(self):
+		'listen() -- create the project\'s socket; raises DaemonError if a daemon is already running'
+		s = connect(self.path)
+		if s is not None:
+			s.close()
+			raise DaemonError('a daemon is already running for %s' % self.project.dir)
+		if os.path.exists(self.path):
+			#left behind by a daemon that died
+			os.remove(self.path)
+
+		self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.sock.bind(self.path)
+		os.chmod(self.path, 0600)
+		self.sock.listen(16)
+		self.running = True
+
+	def serve(self):
+		'serve() -- answer requests on the socket (see listen) until stop is called or requested'
+		if self.sock is None:
+			self.listen()
+		try:
+			while self.running:
+				try:
+					(conn, addr) = self.sock.accept()
+				except socket.error, e:
+					if (e.errno == errno.EINTR) and self.running:
+						continue
+					break
+				if not self.running:
+					#woken by stop
+					conn.close()
+					break
+				t = threading.Thread(target=self.handle, args=(conn,))
+				t.daemon = True
+				t.start()
+				self.threads = [thread for thread in self.threads if thread.is_alive()] + [t]
+		finally:
+			self.running = False
+			self.sock.close()
+			for t in self.threads:
+				t.join()
+			if os.path.exists(self.path):
+				os.remove(self.path)
+
+	def stop(self):
+		'stop() -- make serve return'
+		self.running = False
+		#wake the accept
+		s = connect(self.path)
+		if s is not None:
+			s.close()
+
+def connect(path):
+	'connect(path) -> socket connected to the daemon listening at path, or None if there isn\'t one'
+	s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		s.connect(path)
+	except socket.error:
+		s.close()
+		return None
+	return s
+
+def query(project_dir, command, options, args):
+	'''query(project_dir, command, options, args) -> iterator of ('stdout' or 'stderr', text), or None
+	None is returned if no daemon is running for the project, or it couldn't answer, in which
+	case the command should be run locally.  Output is read as the daemon produces it; a
+	failure after the first output raises DaemonError.'''
+	if not answers(command, args):
+		return None
+	s = connect(socket_path(project_dir))
+	if s is None:
+		return None
+	f = s.makefile('r')
+	try:
+		send(s, {'command': command, 'options': options, 'args': args})
+		line = f.readline()
+	except socket.error:
+		line = ''
+	if line:
+		message = decode(json.loads(line))
+	if (not line) or ('error' in message):
+		f.close()
+		s.close()
+		return None
+
+	def messages(message):
+		try:
+			while 'exit' not in message:
+				if 'error' in message:
+					raise DaemonError(message['error'])
+				for name in ['stdout', 'stderr']:
+					if name in message:
+						yield (name, message[name])
+				line = f.readline()
+				if not line:
+					raise DaemonError('connection to the daemon lost')
+				message = decode(json.loads(line))
+		finally:
+			f.close()
+			s.close()
+	return messages(message)
+
+def stop(project_dir):
+	'stop(project_dir) -> whether a running daemon for the project was asked to stop'
+	s = connect(socket_path(project_dir))
+	if s is None:
+		return False
+	f = s.makefile('r')
+	try:
+		send(s, {'command': 'stop'})
+		f.readline()
+	finally:
+		f.close()
+		s.close()
+	return True
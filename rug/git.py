@@ -1,6 +1,14 @@
 import os.path
+import sys
+import errno
+import types
+import select
 import subprocess
+import collections
 import string
+import time
+import threading
+import Queue
 import output
 
 GIT = 'git'
@@ -16,28 +24,503 @@ class InvalidRepoError(GitError):
 class UnknownRevisionError(GitError):
 	pass
 
-def shell_cmd(cmd, args, cwd=None, raise_errors=True):
-	'''shell_cmd(cmd, args, cwd=None, raise_errors=True) -> runs a shell command
+#Maximum number of commands (batch channels aside) running at once, across all threads and
+#coroutine loops.  See set_max_processes.
+MAX_PROCESSES = 32
+_process_slots = threading.BoundedSemaphore(MAX_PROCESSES)
+#depth of run_coroutines loops running on each thread
+_loops = threading.local()
+#Functions called as hook(job, start, end, out, err) as each command finishes, with its start
+#and end times; see rug/tracing.py
+command_hooks = []
+
+def set_max_processes(n):
+	'set_max_processes(n) -- change the global limit on concurrently running commands'
+	global MAX_PROCESSES, _process_slots
+	MAX_PROCESSES = n
+	_process_slots = threading.BoundedSemaphore(n)
+
+def shell_cmd(cmd, args, cwd=None, raise_errors=True, input=None):
+	'''shell_cmd(cmd, args, cwd=None, raise_errors=True, input=None) -> runs a shell command
+	input: string written to the command's stdin
 	raise_errors=True: returns stdout
 	raise_errors=False: returns (returncode, stdout, stderr)'''
+	return Job(cmd, args, cwd=cwd, raise_errors=raise_errors, input=input).wait()
+
+class Job(object):
+	'''Job(cmd, args, cwd=None, raise_errors=True, input=None) -- a command to run
+	A coroutine yields a Job to have run_coroutines run it without blocking; wait() runs it
+	synchronously.  Either way the result is what shell_cmd returns for the same arguments,
+	and the command holds one of the MAX_PROCESSES slots while it runs.'''
+	def __init__(self, cmd, args, cwd=None, raise_errors=True, input=None):
+		if not isinstance(args, list):
+			args = list(args)
+		self.cmd = cmd
+		self.args = args
+		self.cwd = cwd
+		self.raise_errors = raise_errors
+		self.input = input
+		self.proc = None
+		self._slots = None
+
+	def start(self, blocking=True, slot=True):
+		'''start(blocking=True, slot=True) -> True if the command was started
+		Waits for a free process slot, unless blocking is False, in which case nothing is
+		started if there isn't one.  slot=False starts the command regardless of the limit.'''
+		if slot:
+			slots = _process_slots
+			if not slots.acquire(blocking):
+				return False
+			self._slots = slots
 
-	if not isinstance(args, list):
-		args = list(args)
+		if self.input is None:
+			stdin = None
+		else:
+			stdin = subprocess.PIPE
+		try:
+			self.start_time = time.time()
+			self.proc = subprocess.Popen([self.cmd]+self.args, cwd=self.cwd or None, stdin=stdin,
+				stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		except:
+			self._release()
+			raise
+		return True
+
+	def wait(self):
+		'wait() -> result of the command, starting it first if necessary'
+		if self.proc is None:
+			#a thread running coroutines must never wait for a slot: the jobs holding them may be
+			#its own, and they only make progress while it does
+			self.start(slot=not getattr(_loops, 'depth', 0))
+		try:
+			(out, err) = self.proc.communicate(self.input)
+		finally:
+			self._release()
+		return self.finish(out, err)
+
+	def finish(self, out, err):
+		'finish(out, err) -> result of the finished command, given its output; runs command_hooks'
+		end = time.time()
+		for hook in command_hooks:
+			hook(self, self.start_time, end, out, err)
+		ret = self.proc.returncode
+		if self.raise_errors:
+			if ret != 0:
+				raise GitError('%s %s: %s' % (self.cmd, ' '.join(self.args), err))
+			else:
+				return out.rstrip()
+		else:
+			return (ret, out, err)
+
+	def _release(self):
+		if self._slots is not None:
+			self._slots.release()
+			self._slots = None
+
+class Call(object):
+	'''Call(func, *args, **kwargs) -- synchronous code for a coroutine to wait on
+	run_coroutines runs it on a thread of its own, so that it doesn't hold up other coroutines.'''
+	def __init__(self, func, *args, **kwargs):
+		self.func = func
+		self.args = args
+		self.kwargs = kwargs
+
+	def wait(self):
+		return self.func(*self.args, **self.kwargs)
+
+def run_coroutine(coroutine):
+	'run_coroutine(coroutine) -> result of a single coroutine, raising its error (see run_coroutines)'
+	[(ret, exc_info)] = _run_coroutines([coroutine])
+	if exc_info is not None:
+		#with the traceback from inside the coroutine
+		raise exc_info[0], exc_info[1], exc_info[2]
+	return ret
+
+def run_coroutines(coroutines, jobs=None):
+	'''run_coroutines(coroutines, jobs=MAX_PROCESSES) -> list of (result, error) tuples in input order
+	Drives generator-based coroutines on the calling thread, multiplexing their commands' pipes
+	with select.  A coroutine yields
+	  - a Job or Call to wait for it: the yield evaluates to its result, or raises its error
+	  - another coroutine to run it to completion in the same way
+	  - any other value to finish, with that value as its result (falling off the end gives None)
+	An exception escaping a coroutine is returned as its error.  At most jobs commands from this
+	call run at once, and they count against the global MAX_PROCESSES limit.'''
+	return [(ret, exc_info and exc_info[1]) for (ret, exc_info) in _run_coroutines(coroutines, jobs)]
+
+def _run_coroutines(coroutines, jobs=None):
+	#run_coroutines, with each error as the sys.exc_info() triple it was raised with
+	if jobs is None:
+		jobs = MAX_PROCESSES
+	jobs = max(1, jobs)
+	coroutines = list(coroutines)
+	results = [None]*len(coroutines)
+
+	#(idx, coroutine stack, value, exc_info) of coroutines that can run
+	ready = collections.deque()
+	for (idx, coroutine) in enumerate(coroutines):
+		ready.append((idx, [coroutine], None, None))
+	#(idx, stack, job) of jobs waiting for a process slot
+	pending = collections.deque()
+	#fd: (idx, stack, job, file, chunks) for the pipes of running jobs; stdin has chunks None
+	pipes = {}
+	#job: number of its pipes still open
+	running = {}
+	calls = Queue.Queue()
+	call_count = [0]
+	wake = []
+	#set, under wake_lock, once the loop is done with the wake pipe: calls still running then
+	#(the loop was left by an exception) must not write to its closed fds
+	wake_lock = threading.Lock()
+	wake_closed = [False]
+
+	def step(idx, stack, value, error):
+		while True:
+			try:
+				if error is not None:
+					y = stack[-1].throw(*error)
+				else:
+					y = stack[-1].send(value)
+			except StopIteration:
+				y = None
+			except Exception:
+				y = None
+				error = sys.exc_info()
+			else:
+				error = None
+				if isinstance(y, types.GeneratorType):
+					stack.append(y)
+					value = None
+					continue
+				elif isinstance(y, Job):
+					pending.append((idx, stack, y))
+					return
+				elif isinstance(y, Call):
+					start_call(idx, stack, y)
+					return
+				stack[-1].close()
+			#the coroutine on top of the stack finished: pass its result down
+			stack.pop()
+			if not stack:
+				if error is not None:
+					results[idx] = (None, error)
+				else:
+					results[idx] = (y, None)
+				return
+			value = y
+
+	def start_call(idx, stack, call):
+		if not wake:
+			wake.extend(os.pipe())
+		def run():
+			try:
+				calls.put((idx, stack, call.wait(), None))
+			except Exception:
+				calls.put((idx, stack, None, sys.exc_info()))
+			#one byte per result, written after it is queued: the loop only collects results it
+			#has been woken for, so it can't finish normally before this write
+			with wake_lock:
+				if not wake_closed[0]:
+					os.write(wake[1], 'x')
+		t = threading.Thread(target=run)
+		t.daemon = True
+		t.start()
+		call_count[0] += 1
+
+	def start_job(idx, stack, job):
+		job.output = ([], [])
+		job.offset = 0
+		running[job] = 0
+		for (f, chunks) in [(job.proc.stdout, job.output[0]), (job.proc.stderr, job.output[1]), (job.proc.stdin, None)]:
+			if f is not None:
+				pipes[f.fileno()] = (idx, stack, job, f, chunks)
+				running[job] += 1
+		if (job.proc.stdin is not None) and (not job.input):
+			close_pipe(job.proc.stdin.fileno())
+
+	def close_pipe(fd):
+		(idx, stack, job, f, chunks) = pipes.pop(fd)
+		f.close()
+		running[job] -= 1
+		if running[job] == 0:
+			del running[job]
+			job.proc.wait()
+			job._release()
+			try:
+				ready.append((idx, stack, job.finish(''.join(job.output[0]), ''.join(job.output[1])), None))
+			except GitError:
+				ready.append((idx, stack, None, sys.exc_info()))
+
+	depth = getattr(_loops, 'depth', 0)
+	_loops.depth = depth + 1
+	try:
+		while ready or pending or running or call_count[0]:
+			while ready:
+				step(*ready.popleft())
+
+			#start what the limits allow.  A nested loop (run from a coroutine on this thread)
+			#takes no slots - see Job.wait
+			while pending and (len(running) < jobs):
+				(idx, stack, job) = pending[0]
+				if not job.start(blocking=False, slot=(depth == 0)):
+					if running or call_count[0]:
+						break
+					#nothing of ours to wait for: the slots are held elsewhere
+					job.start()
+				pending.popleft()
+				start_job(idx, stack, job)
+
+			if not (running or call_count[0]):
+				continue
+
+			readers = [fd for (fd, p) in pipes.items() if p[4] is not None]
+			writers = [fd for (fd, p) in pipes.items() if p[4] is None]
+			if wake:
+				readers.append(wake[0])
+			#poll while jobs wait for slots held by other threads
+			timeout = (pending and (len(running) < jobs)) and 0.1 or None
+			try:
+				(r, w, x) = select.select(readers, writers, [], timeout)
+			except select.error, e:
+				if e.args[0] == errno.EINTR:
+					continue
+				raise
+
+			for fd in w:
+				(idx, stack, job, f, chunks) = pipes[fd]
+				try:
+					job.offset += os.write(fd, job.input[job.offset:job.offset + select.PIPE_BUF])
+				except OSError, e:
+					if e.errno != errno.EPIPE:
+						raise
+					#the command exited without reading all of its input
+					job.offset = len(job.input)
+				if job.offset >= len(job.input):
+					close_pipe(fd)
+
+			for fd in r:
+				if wake and (fd == wake[0]):
+					for b in os.read(fd, 512):
+						call_count[0] -= 1
+						ready.append(calls.get())
+				else:
+					data = os.read(fd, 65536)
+					if data:
+						pipes[fd][4].append(data)
+					else:
+						close_pipe(fd)
+	finally:
+		_loops.depth = depth
+		with wake_lock:
+			wake_closed[0] = True
+			for fd in wake:
+				os.close(fd)
+	return results
+
+def is_url(repo):
+	'''is_url(repo) -> True if repo names a remote location rather than a local path'''
+	if '://' in repo:
+		return True
+	#scp-like syntax: host:path, with no slash before the colon.  As in git, the only
+	#exception is a DOS drive prefix (c:path) on Windows
+	colon = repo.find(':')
+	slash = repo.find('/')
+	if (os.name == 'nt') and (colon == 1) and repo[0].isalpha():
+		return False
+	return (colon > 0) and ((slash == -1) or (colon < slash))
+
+def is_git_dir(path):
+	'''is_git_dir(path) -> True if path has the on-disk layout of a git directory
+	(HEAD, objects and refs), mirroring git's own is_git_directory check'''
+	head = os.path.join(path, 'HEAD')
+	if not os.path.isfile(head):
+		return False
+
+	common_dir = path
+	common_file = os.path.join(path, 'commondir')
+	if os.path.isfile(common_file):
+		common_dir = os.path.join(path, open(common_file).read().strip())
+	if not (os.path.isdir(os.path.join(common_dir, 'objects')) and os.path.isdir(os.path.join(common_dir, 'refs'))):
+		return False
+
+	try:
+		contents = open(head).read(256).strip()
+	except IOError:
+		return False
+	return contents.startswith('ref: refs/') or \
+		((len(contents) >= 40) and all(c in string.hexdigits for c in contents[:40]))
+
+def find_git_dir(path):
+	'''find_git_dir(path) -> git directory of the repository at path, or None if path isn't a repository
+	Checks path/.git (directory or "gitdir:" file) and then path itself (bare repository).'''
+	dot_git = os.path.join(path, GIT_DIR)
+	if os.path.isfile(dot_git):
+		try:
+			contents = open(dot_git).read().strip()
+		except IOError:
+			contents = ''
+		if contents.startswith('gitdir:'):
+			dot_git = os.path.join(path, contents[len('gitdir:'):].strip())
+	for candidate in [dot_git, path]:
+		if is_git_dir(candidate):
+			return os.path.normpath(candidate)
+	return None
+
+def read_config(git_dir, name):
+	'''read_config(git_dir, name) -> value of name ("section.key" or "section.subsection.key")
+	in the repository's config file, or None if it isn't set.
+	Only understands the plain syntax git writes itself: raises GitError on anything else
+	(e.g. include directives) so that callers can fall back to "git config"'''
+	parts = name.split('.')
+	section = parts[0].lower()
+	key = parts[-1].lower()
+	subsection = '.'.join(parts[1:-1]) or None
+
+	try:
+		f = open(os.path.join(git_dir, 'config'))
+	except IOError:
+		return None
+
+	value = None
+	current = None
+	for line in f:
+		line = line.strip()
+		if (not line) or (line[0] in '#;'):
+			continue
+		elif line[0] == '[':
+			header = line[1:line.index(']')].strip()
+			if '"' in header:
+				(sec, sub) = header.split('"', 1)
+				current = (sec.strip().lower(), sub.rstrip('"'))
+			elif '.' in header:
+				(sec, sub) = header.split('.', 1)
+				current = (sec.lower(), sub.lower())
+			else:
+				current = (header.lower(), None)
+			if current[0] in ['include', 'includeif']:
+				raise GitError('config file %s uses includes' % os.path.join(git_dir, 'config'))
+		elif current == (section, subsection):
+			if '=' in line:
+				(k, v) = line.split('=', 1)
+			else:
+				#a bare key is a boolean true
+				(k, v) = (line, 'true')
+			if k.strip().lower() == key:
+				v = v.strip()
+				if (len(v) > 1) and (v[0] == '"') and (v[-1] == '"'):
+					v = v[1:-1]
+				value = v
+	f.close()
+
+	return value
+
+class BatchUnavailableError(GitError):
+	pass
 
-	if cwd:
-		proc = subprocess.Popen([cmd]+args, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-	else:
-		proc = subprocess.Popen([cmd]+args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+class UncachedRefError(GitError):
+	pass
 
-	(out, err) = proc.communicate()
-	ret = proc.returncode
-	if raise_errors:
-		if ret != 0:
-			raise GitError('%s %s: %s' % (cmd, ' '.join(args), err))
+#Maximum number of batch co-processes kept alive at once.  Each holds two pipes open,
+#so an unbounded number would exhaust file descriptors on large projects.
+BATCH_CHANNEL_LIMIT = 64
+_open_channels = []
+_open_channels_lock = threading.Lock()
+
+class BatchChannel(object):
+	'''BatchChannel(repo_dir) -- a long-lived "git cat-file --batch-check" co-process
+	Object name queries are answered over a pipe instead of forking a new git for each one.
+	The co-process is started lazily and closed when too many channels are open.'''
+
+	def __init__(self, repo_dir):
+		self.dir = repo_dir
+		self.proc = None
+		self.broken = False
+		self.lock = threading.Lock()
+
+	def _start(self):
+		devnull = open(os.devnull, 'w')
+		try:
+			self.proc = subprocess.Popen([GIT, 'cat-file', '--batch-check'], cwd=self.dir,
+				stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=devnull)
+		finally:
+			devnull.close()
+
+		with _open_channels_lock:
+			_open_channels.append(self)
+			stale = _open_channels[:-BATCH_CHANNEL_LIMIT]
+			del _open_channels[:-BATCH_CHANNEL_LIMIT]
+		for channel in stale:
+			channel.close()
+
+	def close(self):
+		with _open_channels_lock:
+			if self in _open_channels:
+				_open_channels.remove(self)
+		with self.lock:
+			if self.proc is not None:
+				try:
+					self.proc.stdin.close()
+					self.proc.stdout.close()
+					self.proc.wait()
+				except (IOError, OSError):
+					pass
+				self.proc = None
+
+	def resolve(self, name):
+		'''resolve(name) -> sha of the object named, or None if it doesn't exist
+		Raises BatchUnavailableError when the channel can't give a definitive answer'''
+		if self.broken or (not name) or ('\n' in name) or name.isspace():
+			raise BatchUnavailableError(name)
+
+		with self.lock:
+			try:
+				if self.proc is None:
+					self._start()
+				self.proc.stdin.write(name + '\n')
+				self.proc.stdin.flush()
+				line = self.proc.stdout.readline()
+			except (IOError, OSError):
+				line = ''
+			if not line:
+				#co-process died or couldn't be started - don't try again
+				self.broken = True
+				self.proc = None
+				raise BatchUnavailableError(name)
+
+		fields = line.split()
+		if fields[-1] == 'missing':
+			#rev-parse accepts full SHAs without checking that the object exists
+			if (len(name) == 40) and all(c in string.hexdigits for c in name):
+				return name
+			return None
+		elif fields[-1] == 'ambiguous':
+			raise BatchUnavailableError(name)
 		else:
-			return out.rstrip()
-	else:
-		return (ret, out, err)
+			return fields[0]
+
+class RefSnapshot(object):
+	'''RefSnapshot() -- in-memory map of a repository's refs
+	Shared by every Repo object for the same repository, so that a ref changed through one
+	object is seen by the others.'''
+
+	def __init__(self):
+		self.refs = None
+		self.symrefs = None
+		self.lock = threading.Lock()
+
+_ref_snapshots = {}
+_ref_snapshots_lock = threading.Lock()
+
+def ref_snapshot(git_dir):
+	'''ref_snapshot(git_dir) -> the RefSnapshot for the repository at git_dir'''
+	with _ref_snapshots_lock:
+		return _ref_snapshots.setdefault(git_dir, RefSnapshot())
+
+#Ancestry never changes for a given pair of commits, so answers are kept for the life of the process
+_ancestry_cache = {}
+
+#Number of commits a shallow repo is first deepened by when a query needs more history;
+#doubled on each further step
+DEEPEN_STEP = 50
 
 class Rev(object):
 	def __init__(self, repo_finder, name, checked=False):
@@ -72,8 +555,7 @@ class Rev(object):
 		return cls(repo_finder, dst)
 
 	def is_empty_head(self):
-		if (self.name == 'HEAD') and self.is_symbolic() and \
-				not os.path.exists(os.path.join(self.repo.git_dir, self.repo.symbolic_ref('HEAD'))):
+		if (self.name == 'HEAD') and self.is_symbolic() and not self.repo.valid_rev('HEAD'):
 			return True
 		else:
 			return False
@@ -117,7 +599,7 @@ class Rev(object):
 
 	def is_descendant(self, rev):
 		rev = self.cast(self.repo_finder, rev)
-		return rev.get_sha() in self.repo.git_func(['rev-list', self.get_short_name()]).split()
+		return self.repo.is_ancestor(rev.get_sha(), self.get_sha())
 
 	def merge_base(self, rev):
 		cls = type(self)
@@ -126,10 +608,81 @@ class Rev(object):
 			self.repo.git_func(['merge-base', self.get_short_name(), rev.get_short_name()]))
 
 	def can_fastforward(self, rev):
-		return self.get_sha() == self.merge_base(rev).get_sha()
+		#equivalent to self == merge_base(self, rev)
+		rev = self.cast(self.repo_finder, rev)
+		return self.repo.is_ancestor(self.get_sha(), rev.get_sha())
+
+class RefTransaction(object):
+	'''RefTransaction(repo) -- ref creates, updates and deletes applied together
+	Changes are queued, then committed atomically by a single "git update-ref --stdin":
+	either every ref changes or none do.  As a context manager, the transaction is
+	committed when the block exits without an exception.'''
+
+	def __init__(self, repo):
+		self.repo = repo
+		self.commands = []
+		#new values of the refs changed so far, so later changes can refer to them
+		self.pending = {}
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.commit()
+		return False
+
+	def _resolve(self, val):
+		if isinstance(val, Rev):
+			val = val.get_long_name()
+		if val in self.pending:
+			if self.pending[val] is None:
+				raise UnknownRevisionError('Unknown revision %s (deleted in this transaction)' % val)
+			return self.pending[val]
+		else:
+			return self.repo.rev_parse(val)
+
+	def update(self, ref, newval):
+		'''update(ref, newval) -- set ref to newval, creating it if necessary (see Repo.update_ref)'''
+		#ref may not exist, so can't Rev.cast
+		if isinstance(ref, Rev):
+			ref = ref.get_long_name()
+		sha = self._resolve(newval)
+		self.commands.append('update %s %s' % (ref, sha))
+		self.pending[ref] = sha
+
+	def create(self, ref, newval):
+		'''create(ref, newval) -- create ref at newval; the transaction fails if ref already exists'''
+		if isinstance(ref, Rev):
+			ref = ref.get_long_name()
+		sha = self._resolve(newval)
+		self.commands.append('create %s %s' % (ref, sha))
+		self.pending[ref] = sha
+
+	def delete(self, ref):
+		'''delete(ref) -- delete ref (see Repo.delete_ref)'''
+		ref = Rev.cast(self.repo, ref).get_long_name()
+		self.commands.append('delete %s' % ref)
+		self.pending[ref] = None
+
+	def commit(self):
+		if self.commands:
+			self.repo.git_cmd(['update-ref', '--stdin'], input='\n'.join(self.commands) + '\n')
+			for (ref, sha) in self.pending.items():
+				self.repo._set_ref(ref, sha)
+		self.commands = []
+		self.pending = {}
 
 class Repo(object):
 	rev_class = Rev
+	#Answer object name queries through a persistent BatchChannel rather than one-shot rev-parse
+	use_batch = True
+	#Answer ref name queries from an in-memory snapshot of all refs
+	use_ref_snapshot = True
+	#git's rules for expanding an abbreviated ref name, in priority order (see git's refs.c)
+	ref_rules = ['%s', 'refs/%s', 'refs/tags/%s', 'refs/heads/%s', 'refs/remotes/%s', 'refs/remotes/%s/HEAD']
+	#the command the ref snapshot is loaded with
+	refs_args = ['for-each-ref', '--format=%(objectname) %(refname) %(symref)']
 
 	def __init__(self, repo_dir, output_buffer=None):
 		if output_buffer is None:
@@ -139,14 +692,27 @@ class Repo(object):
 		if not self.valid_repo(abs_dir):
 			raise InvalidRepoError('not a valid git repository')
 		self.dir = abs_dir
-		self.bare = (self.git_func(['config', 'core.bare']).lower() == 'true')
+		self.batch = BatchChannel(self.dir)
+		git_dir = find_git_dir(self.dir)
+		self._snapshot = ref_snapshot(git_dir)
+		try:
+			bare = read_config(git_dir, 'core.bare')
+		except GitError:
+			bare = None
+		if bare is None:
+			bare = self.git_func(['config', 'core.bare'])
+		self.bare = (bare.lower() == 'true')
 		if self.bare:
 			self.git_dir = self.dir
 		else:
-			self.git_dir = os.path.join(self.dir, GIT_DIR)
+			self.git_dir = git_dir
 
 	@classmethod
 	def valid_repo(cls, repo, config=None):
+		#Local paths are checked on disk; only actual URLs need a round trip through ls-remote
+		if not is_url(repo):
+			return find_git_dir(os.path.abspath(repo)) is not None
+
 		try:
 			args = []
 			if config is not None:
@@ -175,7 +741,11 @@ class Repo(object):
 			return cls(repo_dir, output_buffer=output_buffer)
 
 	@classmethod
-	def clone(cls, url, repo_dir=None, remote=None, rev=None, local_branch=None, bare=None, config=None, output_buffer=None):
+	def clone(cls, url, repo_dir=None, remote=None, rev=None, local_branch=None, bare=None, config=None, reference=None, depth=None, filter=None, output_buffer=None):
+		'''reference: path of a local repository (e.g. an ObjectCache mirror) to borrow objects from,
+		as with "git clone --reference"
+		depth: number of commits of history to fetch (a shallow clone)
+		filter: object filter spec such as "blob:none" or "tree:0" (a partial clone)'''
 		if output_buffer is None:
 			output_buffer = output.NullOutputBuffer()
 
@@ -207,8 +777,10 @@ class Repo(object):
 					repo.config(name, value)
 			if bare:
 				repo.config('core.bare', 'true')
+			if reference is not None:
+				repo.add_alternate(reference)
 			repo.remote_add(remote, url, mirror_fetch=repo.bare)
-			repo.fetch(remote)
+			repo.fetch(remote, depth=depth, filter=filter)
 
 			if not repo.bare:
 				try:
@@ -218,7 +790,9 @@ class Repo(object):
 					remote_has_head = False
 
 				if rev and repo.valid_sha(rev):
-					#rev is a Commit ID
+					#rev is a Commit ID, which may be older than a shallow fetch reached
+					if not repo.deepen(lambda: repo.has_object(rev), remote):
+						raise UnknownRevisionError('%s: no such commit on %s' % (rev, remote))
 					repo.checkout(rev)
 				else:
 					if rev or remote_has_head:
@@ -244,15 +818,16 @@ class Repo(object):
 
 			return repo
 
-	def git_cmd(self, args, raise_errors=True, return_output=False):
-		'''git_cmd(args, raise_errors=True, return_output=False) -> runs a shell command
+	def git_cmd(self, args, raise_errors=True, return_output=False, input=None):
+		'''git_cmd(args, raise_errors=True, return_output=False, input=None) -> runs a shell command
+		input: string written to git's stdin
 		return_output=False: returns None, appends stdout to output buffer
 		return_output=True, raise_errors=True: returns stdout
 		return_output=True, raise_errors=False: returns (returncode, stdout, stderr)'''
 		#if hasattr(self, 'git_dir'):
 		#	return shell_cmd(GIT, args + ['--git-dir=%s' % self.git_dir])
 		#else:
-		ret = shell_cmd(GIT, args, cwd = self.dir, raise_errors=raise_errors)
+		ret = self.git_job(args, raise_errors=raise_errors, input=input).wait()
 
 		if raise_errors:
 			stdout = ret
@@ -264,9 +839,18 @@ class Repo(object):
 		else:
 			self.output.append(stdout)
 
-	def git_func(self, args, raise_errors=True):
-		'''git_func(args, raise_errors=True) -> shorthand for git_cmd(args, raise_errors, return_output=True)'''
-		return self.git_cmd(args, raise_errors, return_output=True)
+	def git_job(self, args, raise_errors=True, input=None):
+		'''git_job(args, raise_errors=True, input=None) -> Job running git in the repo, for coroutines to yield
+		Its result is the same as git_func's'''
+		return Job(GIT, args, cwd=self.dir, raise_errors=raise_errors, input=input)
+
+	def git_func(self, args, raise_errors=True, input=None):
+		'''git_func(args, raise_errors=True, input=None) -> shorthand for git_cmd(args, raise_errors, return_output=True, input)'''
+		return self.git_cmd(args, raise_errors, return_output=True, input=input)
+
+	def close(self):
+		'''close() -- shut down the batch co-process (it is restarted on demand)'''
+		self.batch.close()
 
 	def gitk(self, *args):
 		shell_cmd(GITK, args, cwd = self.dir)
@@ -291,7 +875,9 @@ class Repo(object):
 			args.append('--mirror=fetch')
 		self.git_cmd(args)
 
-	def remote_set_head(self, remote):
+	def remote_set_head(self, remote, refs=None):
+		'''remote_set_head(remote, refs=None) -- point refs/remotes/<remote>/HEAD at the remote's HEAD branch
+		refs is the remote's ls_remote(), if the caller already has it'''
 		#weirdness: Git can't actually tell what the HEAD of the remote is directly,
 		#just what it's SHA is.  Which means that if multiple remote branches are at the HEAD sha,
 		#git can't tell which is the actual HEAD.  'git remote set-head -a' errors in this case.
@@ -301,7 +887,12 @@ class Repo(object):
 		#Error free version (mimics guess_remote_host)
 		#We could run remote set-head -a, and parse the error output, but that would be error-prone
 		#and fragile
-		refs = self.ls_remote(remote)
+		return run_coroutine(self.remote_set_head_async(remote, refs))
+
+	def remote_set_head_async(self, remote, refs=None):
+		'coroutine version of remote_set_head'
+		if refs is None:
+			refs = yield self.ls_remote_async(remote)
 		if 'HEAD' in refs:
 			head_sha = refs['HEAD']
 			matching_refs = [key[len('refs/heads')+1:] for (key, val) in refs.items() if (val == head_sha) and (key.startswith('refs/heads'))]
@@ -310,7 +901,14 @@ class Repo(object):
 			else:
 				#TODO: can there be no matching refs?
 				head_ref = matching_refs[0]
-			self.git_cmd(['remote', 'set-head', remote, head_ref])
+			#symbolic refs are never packed, so the current target can be read from its file
+			try:
+				current = open(os.path.join(self.git_dir, 'refs', 'remotes', remote, 'HEAD')).read()
+			except IOError:
+				current = None
+			if current != 'ref: refs/remotes/%s/%s\n' % (remote, head_ref):
+				self.output.append((yield self.git_job(['remote', 'set-head', remote, head_ref])))
+				self.invalidate_refs()
 		else:
 			raise UnknownRevisionError('remote %s has no head' % remote)
 
@@ -318,18 +916,98 @@ class Repo(object):
 		self.git_cmd(['remote','set-url', remote, url])
 
 	def ls_remote(self, remote):
-		revs = self.git_func(['ls-remote', remote])
+		return run_coroutine(self.ls_remote_async(remote))
+
+	def ls_remote_async(self, remote):
+		'coroutine version of ls_remote'
+		revs = yield self.git_job(['ls-remote', remote])
 		revs = map(lambda line:line.split(), [a for a in revs.split('\n') if a])
 		ref_dict = {}
 		for (sha, ref) in revs:
 			ref_dict[ref] = sha
-		return ref_dict
+		yield ref_dict
+
+	def fetch(self, remote=None, depth=None, filter=None, deepen=None):
+		'''fetch(remote=None, depth=None, filter=None, deepen=None)
+		depth limits the history fetched, deepen extends the history of a shallow repo by that
+		many commits, and filter is a partial clone filter spec, remembered by git for the remote'''
+		return run_coroutine(self.fetch_async(remote, depth, filter, deepen))
 
-	def fetch(self, remote=None):
+	def fetch_async(self, remote=None, depth=None, filter=None, deepen=None):
+		'coroutine version of fetch'
 		args = ['fetch', '-v']
+		if depth: args.append('--depth=%s' % depth)
+		if deepen: args.append('--deepen=%s' % deepen)
+		if filter: args.append('--filter=%s' % filter)
 		if remote: args.append(remote)
 
-		self.git_cmd(args)
+		self.output.append((yield self.git_job(args)))
+		self.invalidate_refs()
+
+	def is_shallow(self):
+		'is_shallow() -> True if the repo is missing history, i.e. was fetched with a depth'
+		return os.path.exists(os.path.join(self.git_dir, 'shallow'))
+
+	def deepen(self, until, remote=None):
+		'''deepen(until, remote=None) -> until(), after fetching as much history as it needs
+		Fetches history into a shallow repo in doubling steps until until() is True or the repo
+		is no longer shallow.  until is only retried after each step, so it may return False for
+		a shallow repo when the answer isn't known yet.'''
+		step = DEEPEN_STEP
+		ret = until()
+		while (not ret) and self.is_shallow():
+			if remote is None:
+				remotes = self.remote_list()
+				if len(remotes) == 1:
+					remote = remotes[0]
+			self.fetch(remote, deepen=step)
+			step *= 2
+			ret = until()
+		return ret
+
+	def remote_current(self, remote, refs):
+		'''remote_current(remote, refs) -> True if fetching remote would change no local ref
+		refs is the remote's ls_remote().  Its branches are compared with the remote tracking
+		branches and its tags with the local tags.  Only the default fetch refspec is
+		understood: a remote configured any other way is never considered current.'''
+		return run_coroutine(self.remote_current_async(remote, refs))
+
+	def remote_current_async(self, remote, refs):
+		'coroutine version of remote_current'
+		try:
+			refspec = read_config(self.git_dir, 'remote.%s.fetch' % remote)
+			tag_opt = read_config(self.git_dir, 'remote.%s.tagopt' % remote)
+		except GitError:
+			yield False
+		if refspec != '+refs/heads/*:refs/remotes/%s/*' % remote:
+			yield False
+
+		local = yield self.refs_async()
+		for (ref, sha) in refs.items():
+			if ref.startswith('refs/heads/'):
+				if local.get('refs/remotes/%s/%s' % (remote, ref[len('refs/heads/'):])) != sha:
+					yield False
+			elif ref.startswith('refs/tags/') and (tag_opt != '--no-tags') and (not ref.endswith('^{}')):
+				if local.get(ref) != sha:
+					yield False
+		yield True
+
+	def update_remote(self, remote, before_fetch=None):
+		'''update_remote(remote, before_fetch=None) -> fetch remote unless it is already current, then set its HEAD
+		One ls-remote answers both questions.  before_fetch is called first if a fetch is needed.
+		Returns True if a fetch was run.'''
+		return run_coroutine(self.update_remote_async(remote, before_fetch))
+
+	def update_remote_async(self, remote, before_fetch=None):
+		'coroutine version of update_remote'
+		refs = yield self.ls_remote_async(remote)
+		current = yield self.remote_current_async(remote, refs)
+		if not current:
+			if before_fetch is not None:
+				yield Call(before_fetch)
+			yield self.fetch_async(remote)
+		yield self.remote_set_head_async(remote, refs)
+		yield not current
 
 	def add(self, *files):
 		args = ['add']
@@ -347,6 +1025,7 @@ class Repo(object):
 		args.extend(['-m', message])
 
 		self.git_cmd(args)
+		self.invalidate_refs()
 
 	def push(self, remote=None, refspec=None, force=False):
 		args = ['push']
@@ -360,6 +1039,8 @@ class Repo(object):
 				args.append(refspec)
 
 		self.git_cmd(args)
+		#pushing updates remote tracking refs
+		self.invalidate_refs()
 
 	def test_push(self, remote=None, refspec=None, force=False):
 		args = ['push', '-n']
@@ -385,7 +1066,7 @@ class Repo(object):
 
 	def ref_list(self):
 		args = ['show-ref']
-		return map(lambda r: Rev(self, r), [r.split()[1][5:] for r in self.git_func(args).split('\n')])
+		return map(lambda r: Rev(self, r, checked=True), [r.split()[1][5:] for r in self.git_func(args).split('\n')])
 
 	def branch_create(self, dst, src=None, force=False):
 		args = ['branch']
@@ -393,9 +1074,14 @@ class Repo(object):
 			args.append('-f')
 		args.append(dst)
 		if src:
-			args.append(Rev.cast(self, src).get_short_name())
+			src = Rev.cast(self, src)
+			args.append(src.get_short_name())
+		else:
+			src = self.head()
+		sha = src.get_sha()
 
 		self.git_cmd(args)
+		self._set_ref('refs/heads/%s' % dst, sha)
 
 	def branch_delete(self, dst, force=False):
 		args = ['branch']
@@ -406,6 +1092,7 @@ class Repo(object):
 		args.append(Rev.cast(self, dst).get_short_name())
 
 		self.git_cmd(args)
+		self.invalidate_refs()
 
 	def checkout(self, branch, force=False):
 		args = ['checkout']
@@ -414,6 +1101,8 @@ class Repo(object):
 		args.append(Rev.cast(self, branch).get_short_name())
 
 		self.git_cmd(args)
+		#checkout can create a local branch tracking a remote one
+		self.invalidate_refs()
 
 	SOFT = 0
 	MIXED = 1
@@ -432,6 +1121,7 @@ class Repo(object):
 				pass
 		args.append(Rev.cast(self, branch).get_short_name())
 		self.git_cmd(args)
+		self.invalidate_refs()
 
 	def update(self, recursive=False):
 		#Stub for recursive updates
@@ -439,9 +1129,11 @@ class Repo(object):
 
 	def stash(self):
 		self.git_cmd(['stash'])
+		self.invalidate_refs()
 
 	def stash_pop(self):
 		self.git_cmd(['stash', 'pop'])
+		self.invalidate_refs()
 
 	def update_ref(self, ref, newval):
 		#ref may not exist, so can't Rev.cast
@@ -449,17 +1141,27 @@ class Repo(object):
 			ref = ref.get_long_name()
 		if isinstance(newval, Rev):
 			newval = newval.get_long_name()
+		sha = self.rev_parse(newval)
 		self.git_cmd(['update-ref', ref, newval])
+		self._set_ref(ref, sha)
 
 	def delete_ref(self, ref):
-		self.git_cmd(['update-ref', '-d', Rev.cast(self, ref).get_long_name()])
+		ref = Rev.cast(self, ref).get_long_name()
+		self.git_cmd(['update-ref', '-d', ref])
+		self._set_ref(ref, None)
+
+	def ref_transaction(self):
+		'''ref_transaction() -> RefTransaction queuing ref changes to this repo'''
+		return RefTransaction(self)
 
 	#Branch combination operations
 	#these commands do not currently raise errors
 	#TODO:differentiate between errors and conflicts, act accordingly
 
 	def merge(self, merge_head):
-		return self.git_func(['merge', Rev.cast(self, merge_head).get_short_name()], raise_errors=False)
+		ret = self.git_func(['merge', Rev.cast(self, merge_head).get_short_name()], raise_errors=False)
+		self.invalidate_refs()
+		return ret
 
 	def rebase(self, base, onto=None):
 		args = ['rebase']
@@ -467,7 +1169,9 @@ class Repo(object):
 			args.extend(['--onto', onto])
 		args.append(Rev.cast(self, base).get_short_name())
 
-		return self.git_func(args, raise_errors=False)
+		ret = self.git_func(args, raise_errors=False)
+		self.invalidate_refs()
+		return ret
 
 	def config(self, name, value=None):
 		if value is None:
@@ -480,6 +1184,18 @@ class Repo(object):
 		f.write(pattern + '\n')
 		f.close()
 
+	def add_alternate(self, path):
+		'add_alternate(path) -- borrow objects from the repository at path (see gitrepository-layout)'
+		objects = os.path.join(os.path.abspath(path), 'objects')
+		if not os.path.isdir(objects):
+			objects = os.path.join(os.path.abspath(path), GIT_DIR, 'objects')
+		info_dir = os.path.join(self.git_dir, 'objects', 'info')
+		if not os.path.exists(info_dir):
+			os.makedirs(info_dir)
+		f = open(os.path.join(info_dir, 'alternates'), 'a')
+		f.write(objects + '\n')
+		f.close()
+
 	#Query functions
 	def status(self, porcelain=True):
 		#TODO: parse status output, or leave as text?
@@ -495,7 +1211,152 @@ class Repo(object):
 	def diff(self):
 		return self.git_func(['diff'])
 
+	#Ref snapshot
+	def refs(self):
+		'''refs() -> dictionary of full ref name: sha for every ref in the repo
+		Loaded in one pass, then kept up to date by this object's ref-changing methods'''
+		snapshot = self._snapshot
+		with snapshot.lock:
+			if snapshot.refs is None:
+				(snapshot.refs, snapshot.symrefs) = self._parse_refs(self.git_func(self.refs_args))
+			return snapshot.refs
+
+	def refs_async(self):
+		'''coroutine version of refs()
+		The snapshot's lock can't be held while waiting, so concurrent loads may both run'''
+		snapshot = self._snapshot
+		if snapshot.refs is None:
+			(refs, symrefs) = self._parse_refs((yield self.git_job(self.refs_args)))
+			with snapshot.lock:
+				if snapshot.refs is None:
+					(snapshot.refs, snapshot.symrefs) = (refs, symrefs)
+		with snapshot.lock:
+			refs = snapshot.refs
+		yield refs
+
+	def _parse_refs(self, out):
+		refs = {}
+		symrefs = {}
+		for line in out.split('\n'):
+			if line:
+				#output is stripped, so the empty symref field may be missing from the last line
+				fields = line.split(' ', 2)
+				refs[fields[1]] = fields[0]
+				if (len(fields) > 2) and fields[2]:
+					symrefs[fields[1]] = fields[2]
+		return (refs, symrefs)
+
+	def invalidate_refs(self):
+		'''invalidate_refs() -- drop the ref snapshot; it is reloaded on the next query'''
+		with self._snapshot.lock:
+			self._snapshot.refs = None
+
+	def _set_ref(self, ref, sha):
+		#write-through update of the snapshot after a ref change; sha=None for a deleted ref
+		snapshot = self._snapshot
+		with snapshot.lock:
+			if snapshot.refs is None:
+				return
+			elif (not ref.startswith('refs/')) or (ref in snapshot.symrefs):
+				#symbolic or abbreviated name - don't guess what was changed
+				snapshot.refs = None
+			elif sha is None:
+				snapshot.refs.pop(ref, None)
+			else:
+				snapshot.refs[ref] = sha
+
+	def expand_ref(self, name):
+		'''expand_ref(name) -> full name of the ref that name refers to, or None if there isn't one
+		Raises UncachedRefError if name may be something other than a ref (a SHA, a revision
+		expression, a pseudo-ref such as FETCH_HEAD) that the snapshot can't answer for.'''
+		if name == 'HEAD':
+			try:
+				head = open(os.path.join(self.git_dir, 'HEAD')).read().strip()
+			except IOError:
+				raise UncachedRefError(name)
+			if not head.startswith('ref:'):
+				#detached HEAD
+				raise UncachedRefError(name)
+			name = head[len('ref:'):].strip()
+			if name in self.refs():
+				return name
+			else:
+				#unborn branch
+				return None
+
+		if (not name) or (name[0] in '-/') or ('..' in name) or \
+				any(c in name for c in '~^:@{}[]?*\\ \t\n'):
+			raise UncachedRefError(name)
+		is_hex = all(c in string.hexdigits for c in name)
+		if is_hex and (len(name) == 40):
+			raise UncachedRefError(name)
+		if ('/' not in name) and name.isupper():
+			#FETCH_HEAD, ORIG_HEAD and friends live outside refs/
+			raise UncachedRefError(name)
+
+		refs = self.refs()
+		matches = [rule % name for rule in self.ref_rules if (rule % name) in refs]
+		if len(matches) > 1:
+			#ambiguous - leave git's warnings and tie-breaking to git
+			raise UncachedRefError(name)
+		elif matches:
+			#like rev-parse, report the ref a symbolic ref points to
+			ref = matches[0]
+			symrefs = self._snapshot.symrefs
+			seen = []
+			while (ref in symrefs) and (ref not in seen):
+				seen.append(ref)
+				ref = symrefs[ref]
+			if ref in refs:
+				return ref
+			else:
+				return None
+
+		if is_hex:
+			#could be an abbreviated SHA
+			raise UncachedRefError(name)
+		return None
+
+	def shorten_ref(self, ref):
+		'''shorten_ref(ref) -> shortest unambiguous name for the full ref name ref, as rev-parse --abbrev-ref'''
+		refs = self.refs()
+		rules = self.ref_rules
+		for i in range(len(rules)-1, 0, -1):
+			(prefix, suffix) = rules[i].split('%s')
+			if ref.startswith(prefix) and ref.endswith(suffix) and (len(ref) > len(prefix) + len(suffix)):
+				short = ref[len(prefix):len(ref)-len(suffix)]
+				if not [j for j in range(len(rules)) if (j != i) and ((rules[j] % short) in refs)]:
+					return short
+		return ref
+
 	def rev_parse(self, rev, full_name=False, abbrev_ref=False):
+		if self.use_ref_snapshot:
+			try:
+				ref = self.expand_ref(rev)
+			except UncachedRefError:
+				#fall through to the batch channel or one-shot rev-parse
+				pass
+			else:
+				if ref is None:
+					raise UnknownRevisionError('Unknown revision %s' % rev)
+				elif full_name:
+					return ref
+				elif abbrev_ref:
+					return self.shorten_ref(ref)
+				else:
+					return self.refs()[ref]
+
+		if self.use_batch and not (full_name or abbrev_ref):
+			try:
+				sha = self.batch.resolve(rev)
+			except BatchUnavailableError:
+				#fall through to a one-shot rev-parse
+				pass
+			else:
+				if sha is None:
+					raise UnknownRevisionError('Unknown revision %s' % rev)
+				return sha
+
 		args = ['rev-parse']
 		if full_name:
 			args.append('--symbolic-full-name')
@@ -525,6 +1386,11 @@ class Repo(object):
 			else:
 				return self.valid_rev(rev, include_sha=True)
 
+	def has_object(self, sha):
+		'''has_object(sha) -> True if the commit sha (possibly abbreviated) is in the local object store'''
+		#unlike rev-parse of a bare SHA, peeling requires the object to exist
+		return self.valid_rev('%s^{commit}' % sha)
+
 	def valid_sha(self, rev):
 		#Note: this will fail for revs that are prefixes of their own SHAs
 		#However, if you name your branches that way, you deserve what you get
@@ -535,6 +1401,35 @@ class Repo(object):
 
 		return rp[:len(rev)] == rev
 
+	def is_ancestor(self, ancestor, descendant):
+		'''is_ancestor(ancestor, descendant) -> True if commit ancestor is reachable from commit descendant
+		Both are SHAs; answers are memoized.  A shallow repo is only deepened when one of the
+		commits is missing, not to confirm a negative answer, which would fetch the whole
+		history whenever upstream has moved on.'''
+		key = (ancestor, descendant)
+		if key in _ancestry_cache:
+			return _ancestry_cache[key]
+
+		answer = []
+		def known():
+			(ret, out, err) = self.git_func(['merge-base', '--is-ancestor', ancestor, descendant], raise_errors=False)
+			if ret not in [0, 1]:
+				#in a shallow repo, a commit may simply not have been fetched yet
+				if self.is_shallow():
+					return False
+				raise GitError('git merge-base --is-ancestor %s %s: %s' % (ancestor, descendant, err))
+			answer.append(ret == 0)
+			return True
+		self.deepen(known)
+		if not answer:
+			raise GitError('git merge-base --is-ancestor %s %s: commit not found' % (ancestor, descendant))
+		ret = answer[0]
+		#a shallow history may end before reaching ancestor: a negative answer is only
+		#kept once the history is complete
+		if ret or not self.is_shallow():
+			_ancestry_cache[key] = ret
+		return ret
+
 	def symbolic_ref(self, ref):
 		return self.git_func(['symbolic-ref', ref])
 
@@ -548,7 +1443,8 @@ class Repo(object):
 	def get_blob_id(self, file, rev=None):
 		if rev == None:
 			rev = 'HEAD'
-		return self.git_func(['ls-tree', Rev.cast(self, rev).get_short_name(), '--', file]).split()[2]
+		#'<rev>:<path>' names the blob directly, and is answered by the batch channel
+		return self.rev_parse('%s:%s' % (Rev.cast(self, rev).get_sha(), file))
 
 	def show(self, sha):
 		return self.git_func(['show', sha])
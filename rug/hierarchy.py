@@ -1,44 +1,133 @@
 import os
 import sys
 
-#info: (path (if any), parent, subdirectories, subdirectory info lists)
-def dfs(info):
-	ret = []
-	for c in info[3]:
-		if c[0]:
-			ret.append(c[0])
-		else:
-			ret.extend(dfs(c))
-	return ret
+class Node(object):
+	__slots__ = ['name', 'parent', 'children', 'path']
+
+	def __init__(self, name=None, parent=None):
+		self.name = name
+		self.parent = parent
+		#name: Node for each subdirectory
+		self.children = {}
+		#the path stored at this node, if any, as it was given
+		self.path = None
+
+class Trie(object):
+	'''Trie(paths=[]) -- a set of paths arranged by directory, for finding which paths contain which
+	Paths are normalized as they are added: empty and "." components are ignored and ".." removes
+	the component before it.  A path that leaves the root raises ValueError, as does a path that
+	normalizes to the same place as one already present.  Paths can be added and removed one at
+	a time; each costs time proportional to the path's length.'''
+
+	def __init__(self, paths=[]):
+		self.root = Node()
+		self.nodes = {}
+		for path in paths:
+			self.add(path)
+
+	@staticmethod
+	def split(path):
+		'split(path) -> list of normalized directory components'
+		components = [d for d in path.split(os.path.sep) if d not in ['', '.']]
+		if '..' not in components:
+			return components
+		ret = []
+		for d in components:
+			if d == '..':
+				if not ret:
+					raise ValueError('Path "%s" is outside of the root' % path)
+				ret.pop()
+			else:
+				ret.append(d)
+		return ret
+
+	def __contains__(self, path):
+		return path in self.nodes
+
+	def __len__(self):
+		return len(self.nodes)
+
+	def add(self, path):
+		cursor = self.root
+		for d in self.split(path):
+			child = cursor.children.get(d)
+			if child is None:
+				child = Node(d, cursor)
+				cursor.children[d] = child
+			cursor = child
+		if cursor.path is not None:
+			raise ValueError('Duplicate paths: "%s" and "%s"' % (cursor.path, path))
+		cursor.path = path
+		self.nodes[path] = cursor
+
+	def remove(self, path):
+		node = self.nodes.pop(path)
+		node.path = None
+		#drop directories that no longer lead to any path
+		while (node.parent is not None) and (node.path is None) and (not node.children):
+			del node.parent.children[node.name]
+			node = node.parent
+
+	def children(self, path):
+		'children(path) -> paths inside path with no other path in between'
+		ret = []
+		stack = self.nodes[path].children.values()
+		while stack:
+			node = stack.pop()
+			if node.path is not None:
+				ret.append(node.path)
+			else:
+				stack.extend(node.children.values())
+		return ret
+
+	def parent(self, path):
+		'parent(path) -> nearest path containing path, or None'
+		node = self.nodes[path].parent
+		while (node is not None) and (node.path is None):
+			node = node.parent
+		return node and node.path
+
+	def find(self, path):
+		'find(path) -> the stored path that is path or nearest contains it, or None; path needn\'t be stored'
+		cursor = self.root
+		ret = cursor.path
+		for d in self.split(path):
+			cursor = cursor.children.get(d)
+			if cursor is None:
+				break
+			if cursor.path is not None:
+				ret = cursor.path
+		return ret
+
+	def hierarchy(self):
+		'hierarchy() -> dictionary mapping each path to children(path), built in a single pass'
+		ret = {}
+		#(node, nearest path above it)
+		stack = [(self.root, None)]
+		while stack:
+			(node, enclosing) = stack.pop()
+			if node.path is not None:
+				ret[node.path] = []
+				if enclosing is not None:
+					ret[enclosing].append(node.path)
+				enclosing = node.path
+			for child in node.children.values():
+				stack.append((child, enclosing))
+		return ret
 
 def hierarchy(paths):
-	#TODO: properly handle ..
-	path_split = map(lambda x:[s for s in x.split(os.path.sep) if s not in ['','.']], paths)
-
-	root = [None, None, [], []]
-	path_leaves = []
-
-	for idx in range(len(paths)):
-		cursor = root
-		for d in path_split[idx]:
-			try:
-				cursor = cursor[3][cursor[2].index(d)]
-			except ValueError:
-				cursor[2].append(d)
-				new_cursor = [None, cursor, [], []]
-				cursor[3].append(new_cursor)
-				cursor = new_cursor
-		if cursor[0] is not None:
-			raise ValueError('Duplicate paths: "%s" and "%s"' % (cursor[0], paths[idx]))
-		else:
-			cursor[0] = paths[idx]
-			path_leaves.append(cursor)
-
-	path_dict = {}
-	for idx in range(len(paths)):
-		path_dict[paths[idx]] = dfs(path_leaves[idx])
-
-	return path_dict
+	'''hierarchy(paths) -> dictionary mapping each path to the paths directly inside it
+	(those with no other path in between)'''
+	return Trie(paths).hierarchy()
+
+def parents(path_dict):
+	'''parents(hierarchy(paths)) -> dictionary mapping each path to the nearest path containing it
+	(None for top-level paths)'''
+	ret = dict.fromkeys(path_dict)
+	for (path, children) in path_dict.items():
+		for c in children:
+			ret[c] = path
+	return ret
 
 if __name__ == '__main__':
 	print hierarchy(sys.argv[1:])
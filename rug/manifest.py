@@ -1,21 +1,50 @@
-import xml.dom.minidom
 import StringIO
+try:
+	import xml.etree.cElementTree as ElementTree
+except ImportError:
+	import xml.etree.ElementTree as ElementTree
+
+class ManifestError(StandardError):
+	pass
+
+REPO_TAGS = ['repo', 'project']
 
 def read_from_string(s, default_default=None, apply_default=True):
 	return read(StringIO.StringIO(s), default_default, apply_default)
 
 def read(file_or_name, default_default=None, apply_default=True):
-	manifest = xml.dom.minidom.parse(file_or_name)
-	m = manifest.childNodes[0]
-	if m.localName != 'manifest':
-		raise RugError('malformed manifext.xml: no manifest element')
-
-	#Defaults
+	#Elements are handled as the parser finishes them and then discarded, so the document
+	#is never held in memory as a tree
 	manifest_default = {}
-	default_nodes = manifest.getElementsByTagName('default')
-	#TODO: error on multiple default nodes?
-	for node in default_nodes:
-		manifest_default.update(node.attributes.items())
+	remotes = {}
+	repo_attrs = []
+	root = None
+	for (event, node) in ElementTree.iterparse(file_or_name, events=('start', 'end')):
+		if event == 'start':
+			if root is None:
+				root = node
+				if root.tag != 'manifest':
+					raise ManifestError('malformed manifest.xml: no manifest element')
+			continue
+
+		#Defaults
+		#TODO: error on multiple default nodes?
+		if node.tag == 'default':
+			manifest_default.update(node.attrib)
+		#Remotes
+		elif node.tag == 'remote':
+			remote = dict(node.attrib)
+			remotes[remote['name']] = remote
+		#Repos
+		elif node.tag in REPO_TAGS:
+			repo_attrs.append(dict(node.attrib))
+
+		if node is not root:
+			root.clear()
+
+	if root is None:
+		raise ManifestError('malformed manifest.xml: no manifest element')
+
 	if default_default is not None:
 		default = {}
 		default.update(default_default)
@@ -23,23 +52,15 @@ def read(file_or_name, default_default=None, apply_default=True):
 	else:
 		default = manifest_default
 
-	#Remotes
-	remotes = {}
-	remote_nodes = manifest.getElementsByTagName('remote')
-	for node in remote_nodes:
-		remote = dict(node.attributes.items())
-		remotes[remote['name']] = remote
-
-	#Repos
+	#Repos - the default element may come after them, so defaults are applied last
 	repos = {}
-	repo_nodes = sum(map(manifest.getElementsByTagName, ['repo', 'project']), [])
-	for node in repo_nodes:
+	for attrs in repo_attrs:
 		if apply_default:
 			repo = {}
 			repo.update(default)
-			repo.update(node.attributes.items())
+			repo.update(attrs)
 		else:
-			repo = dict(node.attributes.items())
+			repo = attrs
 		#TODO: detect duplicates
 		repos[repo['path']] = repo
 
@@ -49,31 +70,32 @@ def read(file_or_name, default_default=None, apply_default=True):
 		#manifest_default doesn't have the default_default entries, which we don't want to return anyway
 		return (remotes, repos, manifest_default)
 
+def quote_attr(value):
+	if isinstance(value, unicode):
+		value = value.encode('utf-8')
+	return value.replace('&', '&amp;').replace('<', '&lt;').replace('"', '&quot;').replace('>', '&gt;')
+
+def element(tag, attrs):
+	'''element(tag, attrs) -> one line of XML for an empty element, attributes sorted by name'''
+	attr_str = ''.join([' %s="%s"' % (k, quote_attr(v)) for (k,v) in sorted(attrs.items(), key=lambda x:x[0])])
+	return '\t<%s%s/>\n' % (tag, attr_str)
+
 def write(filename, remotes, repos, default):
-	doc = xml.dom.minidom.Document()
-	manifest = doc.createElement('manifest')
-	doc.appendChild(manifest)
+	#Written element by element, in the same format xml.dom.minidom's writexml produced
+	f = open(filename, 'w')
+	f.write('<?xml version="1.0" ?>\n')
+	f.write('<manifest>\n')
 
 	#Defaults
-	default_node = doc.createElement('default')
-	for (k,v) in sorted(default.items(), key=lambda x:x[0]):
-		default_node.setAttribute(k,v)
-	manifest.appendChild(default_node)
+	f.write(element('default', default))
 
 	#Remotes
 	for remote in sorted(remotes.values(), key=lambda x:x['name']):
-		remote_node = doc.createElement('remote')
-		for (k,v) in sorted(remote.items(), key=lambda x:x[0]):
-			remote_node.setAttribute(k,v)
-		manifest.appendChild(remote_node)
+		f.write(element('remote', remote))
 
 	#Repos
 	for repo in sorted(repos.values(), key=lambda x:x['name']):
-		repo_node = doc.createElement('repo')
-		for (k,v) in sorted(repo.items(), key=lambda x:x[0]):
-			repo_node.setAttribute(k,v)
-		manifest.appendChild(repo_node)
+		f.write(element('repo', repo))
 
-	f = open(filename, 'w')
-	doc.writexml(f, newl='\n', addindent='\t')
+	f.write('</manifest>\n')
 	f.close()
@@ -1,28 +1,45 @@
+import json
+import time
+import threading
+
 class Writer(object):
-	def write():
+	def __init__(self):
+		#whole writes are atomic, so lines from different threads never mix
+		self.lock = threading.Lock()
+
+	def write(self, str):
 		raise NotImplementedError('Writer.write is an abstract function')
 
 class StringWriter(Writer):
 	def __init__(self):
-		super(Writer, self).__init__()
-		self.string = ''
+		super(StringWriter, self).__init__()
+		self._chunks = []
 
 	def write(self, str):
 		if str:
 			if str[-1] != '\n':
 				str += '\n'
-			self.string += str
+			with self.lock:
+				self._chunks.append(str)
+
+	@property
+	def string(self):
+		with self.lock:
+			if len(self._chunks) > 1:
+				self._chunks = [''.join(self._chunks)]
+			return ''.join(self._chunks)
 
 class FileWriter(Writer):
 	def __init__(self, file):
-		super(Writer, self).__init__()
+		super(FileWriter, self).__init__()
 		self.file = file
 
 	def write(self, str):
 		if str:
 			if str[-1] != '\n':
 				str += '\n'
-			self.file.write(str)
+			with self.lock:
+				self.file.write(str)
 
 class OutputBuffer(object):
 	def __init__(self, arg=None, prefix=''):
@@ -30,7 +47,7 @@ class OutputBuffer(object):
 			self._prefix = arg.get_prefix() + prefix
 		else:
 			self._prefix = prefix
-		
+
 	def get_prefix(self):
 		return self._prefix
 
@@ -40,6 +57,11 @@ class OutputBuffer(object):
 	def spawn(self, prefix=''):
 		return type(self)(self, prefix)
 
+	def flush(self, prefix=''):
+		'''flush(prefix='') -- write out anything held back for the buffer spawn(prefix) and its spawn
+		Buffers that write straight through have nothing to do.'''
+		pass
+
 class WriterOutputBuffer(OutputBuffer):
 	def __init__(self, arg, prefix=''):
 		super(WriterOutputBuffer, self).__init__(arg, prefix)
@@ -55,6 +77,83 @@ class WriterOutputBuffer(OutputBuffer):
 		if str:
 			self._writer.write(self._prefix + str)
 
+class EventLog(object):
+	'''EventLog(writer, json_file=None) -- output records grouped by prefix, for EventOutputBuffer
+	Each group is held until it is flushed, then written to writer in one piece.  Output with no
+	prefix isn't held.  If json_file is given, each record written is also written to it as one
+	JSON object per line: {"repo": ..., "time": ..., "text": ...}, where repo is the prefix
+	with its ': ' separators turned into '/' (e.g. "b/c" for "b: c: "), or null.'''
+
+	def __init__(self, writer, json_file=None):
+		self.writer = writer
+		self.json_file = json_file
+		self.lock = threading.Lock()
+		#prefix: [(time, text)], and the prefixes in order of their first record
+		self.groups = {}
+		self.order = []
+
+	def add(self, prefix, text):
+		record = (time.time(), text)
+		if not prefix:
+			self.write(prefix, [record])
+			return
+		with self.lock:
+			if prefix not in self.groups:
+				self.groups[prefix] = []
+				self.order.append(prefix)
+			self.groups[prefix].append(record)
+
+	def flush(self, prefix=''):
+		'flush(prefix) -- write out, oldest first, every group whose prefix starts with prefix'
+		with self.lock:
+			flushed = [p for p in self.order if p.startswith(prefix)]
+			if not flushed:
+				return
+			self.order = [p for p in self.order if not p.startswith(prefix)]
+			groups = [(p, self.groups.pop(p)) for p in flushed]
+		for (p, records) in groups:
+			self.write(p, records)
+
+	def write(self, prefix, records):
+		self.writer.write(''.join([self.line(prefix + text) for (t, text) in records]))
+		if self.json_file is not None:
+			if prefix:
+				repo = '/'.join(prefix.split(': ')[:-1])
+			else:
+				repo = None
+			lines = [json.dumps({'repo': repo, 'time': t, 'text': text}) + '\n' for (t, text) in records]
+			with self.lock:
+				self.json_file.write(''.join(lines))
+
+	@staticmethod
+	def line(str):
+		if str[-1] != '\n':
+			str += '\n'
+		return str
+
+class EventOutputBuffer(OutputBuffer):
+	'''EventOutputBuffer(writer, json_file=None) -- output buffer that keeps each prefix's output together
+	Buffers spawned from it share one EventLog.  Whatever a repo's buffer appends is held as
+	records until flush is called for it, typically as the repo finishes, so output from repos
+	processed concurrently comes out grouped per repo instead of interleaved line by line.'''
+
+	def __init__(self, arg, prefix='', json_file=None):
+		super(EventOutputBuffer, self).__init__(arg, prefix)
+		if isinstance(arg, EventOutputBuffer):
+			self._log = arg.get_log()
+		else:
+			self._log = EventLog(arg, json_file)
+
+	def get_log(self):
+		return self._log
+
+	def append(self, str):
+		if str:
+			self._log.add(self._prefix, str)
+
+	def flush(self, prefix=''):
+		self._log.flush(self._prefix + prefix)
+
 class NullOutputBuffer(OutputBuffer):
 	def append(self, str):
 		pass
@@ -0,0 +1,167 @@
+import sys
+import threading
+import Queue
+
+#Default number of concurrent workers for multi-repo operations
+DEFAULT_JOBS = 8
+
+def imap(func, items, jobs=None):
+	'''imap(func, items, jobs=DEFAULT_JOBS) -> iterator of (item, result, error) tuples
+	func is called on each item on a pool of at most jobs worker threads.  Tuples are
+	yielded as each call finishes, not in input order.  Exceptions raised by func don't
+	stop the other calls: they are returned as error (result is then None).'''
+
+	items = list(items)
+	if jobs is None:
+		jobs = DEFAULT_JOBS
+	jobs = max(1, min(jobs, len(items)))
+
+	if jobs == 1:
+		#no point in threads
+		for item in items:
+			yield call(func, item)
+		return
+
+	todo = Queue.Queue()
+	for item in items:
+		todo.put(item)
+	done = Queue.Queue()
+
+	def worker():
+		while True:
+			try:
+				item = todo.get_nowait()
+			except Queue.Empty:
+				return
+			done.put(call(func, item))
+
+	for idx in range(jobs):
+		t = threading.Thread(target=worker)
+		t.daemon = True
+		t.start()
+
+	for idx in range(len(items)):
+		#a timeout keeps the main thread responsive to KeyboardInterrupt
+		while True:
+			try:
+				ret = done.get(timeout=0.1)
+				break
+			except Queue.Empty:
+				pass
+		yield ret
+
+def run(func, items, jobs=None):
+	'''run(func, items, jobs=DEFAULT_JOBS) -> list of (item, result, error) tuples in input order
+	see imap'''
+	items = list(items)
+	results = [None]*len(items)
+	for ((idx, item), result, error) in imap(lambda pair: func(pair[1]), enumerate(items), jobs):
+		results[idx] = (item, result, error)
+	return results
+
+def interleave(items, key):
+	'''interleave(items, key) -> items grouped by key(item), the groups interleaved round-robin
+	Spreads work for the same key (e.g. a server) across the run instead of bunching it up.'''
+	groups = {}
+	order = []
+	for item in items:
+		k = key(item)
+		if k not in groups:
+			groups[k] = []
+			order.append(k)
+		groups[k].append(item)
+
+	ret = []
+	while len(ret) < len(items):
+		for k in order:
+			if groups[k]:
+				ret.append(groups[k].pop(0))
+	return ret
+
+class SkippedError(Exception):
+	pass
+
+def imap_dag(func, items, prerequisites, jobs=None):
+	'''imap_dag(func, items, prerequisites, jobs=DEFAULT_JOBS) -> iterator of (key, result, error) tuples
+	items is a dictionary of key: item, prerequisites a dictionary of key: [keys].  func(item)
+	is only started once all of its prerequisites have finished successfully; items whose
+	prerequisites failed are not run, and are yielded with a SkippedError.  Independent items
+	run concurrently on at most jobs worker threads.'''
+
+	if jobs is None:
+		jobs = DEFAULT_JOBS
+	jobs = max(1, jobs)
+
+	waiting = {}
+	dependents = {}
+	for key in items:
+		pending = [k for k in prerequisites.get(key, []) if k in items]
+		waiting[key] = len(pending)
+		for k in pending:
+			dependents.setdefault(k, []).append(key)
+
+	todo = Queue.Queue()
+	done = Queue.Queue()
+
+	def worker():
+		while True:
+			key = todo.get()
+			if key is None:
+				return
+			(item, ret, err) = call(func, items[key])
+			done.put((key, ret, err))
+
+	threads = []
+	for idx in range(min(jobs, len(items))):
+		t = threading.Thread(target=worker)
+		t.daemon = True
+		t.start()
+		threads.append(t)
+
+	running = 0
+	for key in items:
+		if waiting[key] == 0:
+			todo.put(key)
+			running += 1
+
+	try:
+		while running:
+			#a timeout keeps the main thread responsive to KeyboardInterrupt
+			try:
+				(key, ret, err) = done.get(timeout=0.1)
+			except Queue.Empty:
+				continue
+			running -= 1
+			yield (key, ret, err)
+
+			skip = []
+			for k in dependents.get(key, []):
+				if waiting[k] is None:
+					#already skipped
+					continue
+				elif err is not None:
+					skip.append(k)
+				else:
+					waiting[k] -= 1
+					if waiting[k] == 0:
+						todo.put(k)
+						running += 1
+			while skip:
+				k = skip.pop()
+				if waiting[k] is None:
+					continue
+				waiting[k] = None
+				yield (k, None, SkippedError('not run: prerequisite %s failed' % key))
+				skip.extend(dependents.get(k, []))
+	finally:
+		for t in threads:
+			todo.put(None)
+
+def call(func, item):
+	'''call(func, item) -> (item, func(item), None), or (item, None, exception) if func raises'''
+	try:
+		return (item, func(item), None)
+	except KeyboardInterrupt:
+		raise
+	except Exception:
+		return (item, None, sys.exc_info()[1])
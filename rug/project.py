@@ -1,13 +1,18 @@
 #!/usr/bin/env python
 import os
 import sys
+import threading
 import xml.dom.minidom
 import config
 
 import manifest
 import git
+import cache
 import hierarchy
 import output
+import parallel
+import tracing
+import watch
 
 class RugError(StandardError):
 	pass
@@ -21,13 +26,69 @@ RUG_SHA_RIDER = 'refs/rug/sha_rider'
 RUG_DEFAULT_DEFAULT = {'revision': 'master', 'vcs': 'git'}
 RUG_CONFIG = 'config'
 RUG_REPO_CONFIG_SECTION = 'repoconfig'
+#Config section and key naming the object cache directory, overriding the environment
+RUG_CACHE_SECTION = 'cache'
+RUG_CACHE_DIR_KEY = 'dir'
+#Config section for clone options, and the manifest repo attributes that override it per repo
+RUG_CLONE_SECTION = 'clone'
+RUG_CLONE_OPTIONS = {'depth': 'clone-depth', 'filter': 'clone-filter'}
 RUG_CANDIDATE_TEMPLATES = ['%s', '%s/.rug/manifest', '%s/manifest']
+#Environment variable naming a project directory, trusted by find_project without checking it
+RUG_PROJECT_ENV = 'RUG_PROJECT_DIR'
 
 class Revset(git.Rev):
 	@staticmethod
 	def find_repo(repo_finder):
 		return repo_finder.manifest_repo
 
+class ConfigBatch(object):
+	'ConfigBatch(project) -- see Project.config_batch'
+
+	def __init__(self, project):
+		self.project = project
+
+	def __enter__(self):
+		p = self.project
+		with p._config_lock:
+			#read the file before any changes are made, so they apply to its current contents
+			p.config_file()
+			p._config_batch += 1
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		p = self.project
+		with p._config_lock:
+			p._config_batch -= 1
+			if not p._config_batch:
+				if exc_type is None:
+					p.write_config()
+				else:
+					p._config = None
+		return False
+
+class RepoEntry(dict):
+	'''RepoEntry(project, attrs) -- a manifest repo dictionary
+	The 'repo' entry, the vcs repo object (None if the repo isn't in the working tree), is
+	created on first lookup, so that commands which never touch a repo don't pay for it.'''
+
+	def __init__(self, project, attrs):
+		dict.__init__(self, attrs)
+		self.project = project
+
+	def __missing__(self, key):
+		if (key != 'repo') or self.project.bare:
+			raise KeyError(key)
+
+		p = self.project
+		abs_path = os.path.abspath(os.path.join(p.dir, self['path']))
+		R = p.vcs_class[self['vcs']]
+		if R.valid_repo(abs_path):
+			repo = R(abs_path, output_buffer=p.output.spawn(self['path'] + ': '))
+		else:
+			repo = None
+		self['repo'] = repo
+		return repo
+
 class Project(object):
 	vcs_class = {}
 
@@ -52,19 +113,48 @@ class Project(object):
 		self.manifest_dir = os.path.join(self.rug_dir, 'manifest')
 		self.manifest_filename = os.path.join(self.manifest_dir, 'manifest.xml')
 		self.manifest_repo = git.Repo(self.manifest_dir, output_buffer=self.output.spawn('manifest: '))
+		#(blob id, repos) of the committed manifest, see committed_repos
+		self._committed_manifest = None
+		self._committed_manifest_lock = threading.Lock()
+		#hierarchy.Trie of the repo paths, built on first use, see repo_hierarchy
+		self._repo_trie = None
+		#(ConfigFile, (mtime, size)) of the config file as last read or written, see config_file
+		self._config = None
+		#depth of nested config_batch blocks; while nonzero, set_config doesn't write
+		self._config_batch = 0
+		self._config_lock = threading.RLock()
+		#watch.Watcher of the working tree, see watch
+		self._watcher = None
+		#hierarchy.Trie of the repo paths and the manifest repo's, for finding the repo a changed path is in
+		self._watch_trie = None
+		#path: {name: value} of results kept while nothing changes under path, see watched
+		self._watch_cache = {}
+		#incremented whenever cached results are dropped
+		self._watch_generation = 0
+		self._watch_lock = threading.Lock()
 		self.read_manifest()
 
 	def read_manifest(self):
 		'''Project.read_manifest() -- read the manifest file.'''
-		(self.remotes, self.repos) = manifest.read(self.manifest_filename, default_default=RUG_DEFAULT_DEFAULT)
-		if not self.bare:
+		(self.remotes, repos) = manifest.read(self.manifest_filename, default_default=RUG_DEFAULT_DEFAULT)
+		#keep the path trie in step with the repos that were added or removed (e.g. by add or remove)
+		if self._repo_trie is not None:
 			for path in self.repos:
-				abs_path = os.path.abspath(os.path.join(self.dir, path))
-				R = self.vcs_class[self.repos[path]['vcs']]
-				if R.valid_repo(abs_path):
-					self.repos[path]['repo'] = R(abs_path, output_buffer=self.output.spawn(path + ': '))
-				else:
-					self.repos[path]['repo'] = None
+				if path not in repos:
+					self._repo_trie.remove(path)
+			for path in repos:
+				if path not in self.repos:
+					self._repo_trie.add(path)
+		#repo objects are created lazily, see RepoEntry
+		self.repos = {}
+		for (path, r) in repos.items():
+			self.repos[path] = RepoEntry(self, r)
+
+	def repo_hierarchy(self):
+		'Project.repo_hierarchy() -> dictionary of repo path: paths of the repos directly inside it'
+		if self._repo_trie is None:
+			self._repo_trie = hierarchy.Trie(self.repos.keys())
+		return self._repo_trie.hierarchy()
 
 	@classmethod
 	def register_vcs(cls, vcs, vcs_class):
@@ -74,18 +164,31 @@ class Project(object):
 	def find_project(cls, project_dir=None, output_buffer=None):
 		'Project.find_project(project_dir=pwd) -> project -- climb up the directory tree looking for a valid rug project'
 
+		return cls(cls.find_project_dir(project_dir), output_buffer=output_buffer)
+
+	@classmethod
+	def find_project_dir(cls, project_dir=None):
+		'Project.find_project_dir(project_dir=pwd) -> directory of the nearest rug project containing project_dir'
+
 		if project_dir == None:
 			project_dir = os.getcwd()
+		project_dir = os.path.abspath(project_dir)
 
+		#A project named in the environment is taken as it is once the climb reaches it.  Projects
+		#nested inside it (rug sub-projects) are still found first.
+		pointer = os.environ.get(RUG_PROJECT_ENV)
+		if pointer:
+			pointer = os.path.abspath(pointer)
+
+		#valid_project only looks at the filesystem, so the climb doesn't run git
 		head = project_dir
 		while head:
-			try:
-				return cls(head, output_buffer=output_buffer)
-			except InvalidProjectError:
-				if head == os.path.sep:
-					head = None
-				else:
-					(head, tail) = os.path.split(head)
+			if (head == pointer) or cls.valid_project(head):
+				return head
+			elif head == os.path.sep:
+				head = None
+			else:
+				(head, tail) = os.path.split(head)
 
 		raise InvalidProjectError('not a valid rug project')
 
@@ -122,7 +225,8 @@ class Project(object):
 		return cls(project_dir, output_buffer=output_buffer)
 
 	@classmethod
-	def clone(cls, url, project_dir=None, source=None, revset=None, bare=False, repo_config=None, output_buffer=None):
+	@tracing.phase('clone')
+	def clone(cls, url, project_dir=None, source=None, revset=None, bare=False, repo_config=None, jobs=None, cache_dir=None, depth=None, filter=None, output_buffer=None):
 		'Project.clone -- clone an existing rug repository'
 
 		if output_buffer is None:
@@ -163,6 +267,7 @@ class Project(object):
 		if clone_url:
 			git.Repo.clone(clone_url, repo_dir=manifest_dir, remote=source, rev=revset,
 			               config=repo_config, output_buffer=output_buffer.spawn('manifest: '))
+			output_buffer.flush('manifest: ')
 		else:
 			raise RugError('%s does not seem to be a rug project' % url)
 
@@ -174,10 +279,16 @@ class Project(object):
 
 		#checkout revset
 		p = cls(project_dir, output_buffer=output_buffer)
-		if repo_config is not None:
-			for (name, value) in repo_config.items():
-				p.set_config(RUG_REPO_CONFIG_SECTION, name, value)
-		p.checkout(revset)
+		with p.config_batch():
+			if repo_config is not None:
+				for (name, value) in repo_config.items():
+					p.set_config(RUG_REPO_CONFIG_SECTION, name, value)
+			if cache_dir is not None:
+				p.set_config(RUG_CACHE_SECTION, RUG_CACHE_DIR_KEY, os.path.abspath(cache_dir))
+			for (name, value) in [('depth', depth), ('filter', filter)]:
+				if value is not None:
+					p.set_config(RUG_CLONE_SECTION, name, value)
+		p.checkout(revset, jobs=jobs)
 
 		return p
 
@@ -189,25 +300,86 @@ class Project(object):
 	@classmethod
 	def valid_working_project(cls, project_dir):
 		manifest_dir = os.path.join(project_dir, RUG_DIR, 'manifest')
-		return git.Repo.valid_repo(manifest_dir) \
-				and os.path.exists(os.path.join(manifest_dir, 'manifest.xml'))
+		return os.path.exists(os.path.join(manifest_dir, 'manifest.xml')) \
+				and git.Repo.valid_repo(manifest_dir)
 
 	@classmethod
 	def valid_bare_project(cls, project_dir):
 		manifest_dir = os.path.join(project_dir, 'manifest')
-		return git.Repo.valid_repo(manifest_dir) \
-			and os.path.exists(os.path.join(manifest_dir, 'manifest.xml'))
+		return os.path.exists(os.path.join(manifest_dir, 'manifest.xml')) \
+			and git.Repo.valid_repo(manifest_dir)
+
+	def config_file(self):
+		'''Project.config_file() -> the project's parsed config.ConfigFile
+		The file is only parsed again when its mtime, size or inode has changed since it was
+		last read or written (config files are replaced by renaming a new file over them, so
+		an edit keeping both the size and the mtime still changes the inode).
+		Inside a config_batch block, the unwritten changes are returned.'''
+		with self._config_lock:
+			if self._config_batch and (self._config is not None):
+				return self._config[0]
+			config_path = os.path.join(self.rug_dir, RUG_CONFIG)
+			st = os.stat(config_path)
+			stamp = (st.st_mtime, st.st_size, st.st_ino)
+			if (self._config is None) or (self._config[1] != stamp):
+				self._config = (config.ConfigFile.from_path(config_path), stamp)
+			return self._config[0]
+
+	def write_config(self):
+		'Project.write_config() -- write the cached config file out atomically'
+		with self._config_lock:
+			config_path = os.path.join(self.rug_dir, RUG_CONFIG)
+			cf = self.config_file()
+			cf.to_path(config_path)
+			st = os.stat(config_path)
+			self._config = (cf, (st.st_mtime, st.st_size, st.st_ino))
+
+	def config_batch(self):
+		'''Project.config_batch() -> context manager gathering set_config calls into one write
+		The config file is written once, when the outermost block exits without an exception;
+		after an exception the changes are dropped.'''
+		return ConfigBatch(self)
 
 	def set_config(self, section, name, value):
-		config_file = os.path.join(self.rug_dir, RUG_CONFIG)
-		cf = config.ConfigFile.from_path(config_file)
-		cf.set(section, name, value)
-		cf.to_path(config_file)
+		with self._config_lock:
+			self.config_file().set(section, name, value)
+			if not self._config_batch:
+				self.write_config()
 
 	def get_config(self, section, name=None):
-		config_file = os.path.join(self.rug_dir, RUG_CONFIG)
-		cf = config.ConfigFile.from_path(config_file)
-		return cf.get(section, name)
+		with self._config_lock:
+			ret = self.config_file().get(section, name)
+			#a section is returned as a copy, so callers can't change the cache
+			if isinstance(ret, dict):
+				ret = dict(ret)
+			return ret
+
+	def object_cache(self):
+		'''Project.object_cache() -> the cache.ObjectCache git repos borrow objects from, or None
+		The project's config takes precedence over the environment.'''
+		try:
+			cache_dir = self.get_config(RUG_CACHE_SECTION, RUG_CACHE_DIR_KEY)
+		except KeyError:
+			cache_dir = os.environ.get(cache.RUG_CACHE_ENV)
+		if cache_dir:
+			return cache.ObjectCache(cache_dir)
+		else:
+			return None
+
+	def clone_options(self, r):
+		'''Project.clone_options(r) -> dictionary of git.Repo.clone depth and filter arguments for r
+		Taken from r's clone-depth and clone-filter manifest attributes, or else the project's config'''
+		ret = {}
+		for (name, attr) in RUG_CLONE_OPTIONS.items():
+			value = r.get(attr)
+			if value is None:
+				try:
+					value = self.get_config(RUG_CLONE_SECTION, name)
+				except KeyError:
+					pass
+			if value:
+				ret[name] = value
+		return ret
 
 	def get_branch_names(self, r):
 		revision = r.get('revision', 'HEAD')
@@ -265,7 +437,7 @@ class Project(object):
 		'delete a revset'
 		self.manifest_repo.branch_delete(dst, force)
 
-	def status(self, porcelain=True, recursive=True):
+	def status(self, porcelain=True, recursive=True, jobs=None):
 		#TODO: return objects or text?
 		#TODO: could add manifest status
 		if self.bare:
@@ -274,55 +446,189 @@ class Project(object):
 		#TODO: think through this
 
 		if porcelain:
-			ret = {}
-			for r in self.repos.values():
+			ret = dict(self.status_iter(porcelain=True, recursive=recursive, jobs=jobs))
+		else:
+			stat = self.manifest_status()
+			for (path, lines) in self.status_iter(porcelain=False, jobs=jobs):
+				stat.extend(lines)
+			ret = '\n'.join(stat)
+
+		return ret
+
+	def manifest_status(self):
+		'Project.manifest_status() -> list of lines describing the revset and uncommitted manifest changes'
+		stat = ['On revset %s:' % self.revset().get_short_name()]
+		diff = self.manifest_repo.diff()
+		if diff:
+			stat.append('manifest diff:')
+			stat.extend(map(lambda line: '\t' + line, diff.split('\n')))
+		return stat
+
+	def status_iter(self, porcelain=True, recursive=True, jobs=None):
+		'''Project.status_iter(porcelain=True, recursive=True, jobs=None) -> iterator of (path, status)
+		Repos are examined concurrently on a pool of jobs workers, and each is yielded as soon as it is done.
+		porcelain: status is as in Project.status
+		not porcelain: status is a list of human readable lines'''
+		if self.bare:
+			raise NotImplementedError('status not implemented for bare projects')
+
+		def repo_stat(r):
+			if porcelain:
 				stat = self.repo_status(r['path'])
 				if recursive:
 					if stat == 'D':
-						ret[r['path']] = [stat, None]
+						return [stat, None]
 					else:
-						r_stat = r['repo'].status(porcelain=True)
-						ret[r['path']] = [stat, r_stat]
+						return [stat, r['repo'].status(porcelain=True)]
 				else:
-					ret[r['path']] = stat
-		else:
-			stat = ['On revset %s:' % self.revset().get_short_name()]
-			diff = self.manifest_repo.diff()
-			if diff:
-				stat.append('manifest diff:')
-				stat.extend(map(lambda line: '\t' + line, self.manifest_repo.diff().split('\n')))
-			for r in self.repos.values():
+					return stat
+			else:
 				repo = r['repo']
 				if repo is None:
-					stat.append('repo %s missing' % r['path'])
+					return ['repo %s missing' % r['path']]
 				else:
-					stat.append('repo %s (%s):' % (r['path'], self.repo_status(r['path'])))
-					stat.extend(map(lambda line: '\t' + line, r['repo'].status(porcelain=False).split('\n')))
-			ret = '\n'.join(stat)
+					lines = ['repo %s (%s):' % (r['path'], self.repo_status(r['path']))]
+					lines.extend(map(lambda line: '\t' + line, repo.status(porcelain=False).split('\n')))
+					return lines
 
-		return ret
+		def watched_repo_stat(r):
+			#errors are re-raised below with the traceback from the worker thread
+			try:
+				return (self.watched(r['path'], ('status', porcelain, recursive), lambda: repo_stat(r)), None)
+			except Exception:
+				return (None, sys.exc_info())
+
+		self.poll_watch()
+		for (r, (stat, exc_info), err) in parallel.imap(watched_repo_stat, self.repos.values(), jobs):
+			if exc_info is not None:
+				raise exc_info[0], exc_info[1], exc_info[2]
+			yield (r['path'], stat)
 
 	def dirty(self):
 		#TODO: currently, "dirty" is defined as "would commit -a do anything"
 		#this seems to work, but needs further consideration
-		if self.manifest_repo.dirty():
+		self.poll_watch()
+		if self.watched(self.manifest_path(), 'dirty', self.manifest_repo.dirty):
 			return True
 		else:
 			for r in self.repos.values():
-				if self.repo_status(r['path']):
+				#a clean repo's status is two spaces
+				if self.watched(r['path'], 'repo_status', lambda: self.repo_status(r['path'])).strip():
 					return True
+		return False
+
+	def manifest_path(self):
+		'Project.manifest_path() -> path of the manifest repo, relative to the project directory'
+		return os.path.relpath(self.manifest_dir, self.dir)
+
+	def watch(self):
+		'''Project.watch() -> whether changes to the working tree are being watched
+		While watching, dirty and status only examine the repos with changes under their paths
+		since they last did, and reuse the results for the others.  Starting a watch walks the
+		whole tree, so it pays off in long-running processes, like the daemon.  Where watching
+		isn't available (see watch.Watcher), False is returned and every repo is examined each time.'''
+		if self.bare:
+			return False
+		if self._watcher is None:
+			try:
+				self._watcher = watch.Watcher(self.dir)
+			except watch.WatchError:
+				return False
+		return True
+
+	def unwatch(self):
+		'Project.unwatch() -- stop watching the working tree'
+		with self._watch_lock:
+			if self._watcher is not None:
+				self._watcher.close()
+				self._watcher = None
+			self._watch_cache = {}
+			self._watch_generation += 1
+
+	def poll_watch(self):
+		'''Project.poll_watch() -- drop the results kept for repos that changed since the last poll
+		A change to the manifest repo drops every result, since the repos' status depends on it.'''
+		if self._watcher is None:
+			return
+		try:
+			changed = self._watcher.changes()
+		except watch.WatchError:
+			#the tree can't be watched any more: examine every repo from now on
+			self._watcher.close()
+			self._watcher = None
+			changed = None
+		with self._watch_lock:
+			if self._watch_trie is None:
+				self._watch_trie = hierarchy.Trie(self.repos.keys() + [self.manifest_path()])
+			trie = self._watch_trie
+			if changed is None:
+				paths = None
+			else:
+				paths = set()
+				for path in changed:
+					found = trie.find(path)
+					paths.add(found)
+					if (found is not None) and (trie.split(found) == trie.split(path)):
+						#a repo's directory itself was created or removed: its parent sees it too
+						paths.add(trie.parent(found))
+				paths.discard(None)
+			if not paths and (paths is not None):
+				return
+			if (paths is None) or (self.manifest_path() in paths):
+				self._watch_cache = {}
+				#the repos may have changed too
+				self._watch_trie = None
+				paths = self.repos.keys() + [self.manifest_path()]
+			else:
+				for path in paths:
+					self._watch_cache.pop(path, None)
+			self._watch_generation += 1
+		for path in paths:
+			self.reload_repo(path)
+
+	def reload_repo(self, path, refs=True):
+		'''Project.reload_repo(path, refs=True) -- forget what is known about the repo at path, after it changed on disk
+		Its repo object is created again if the repo appeared or disappeared, and otherwise its
+		refs are read again, unless refs is False.'''
+		if path == self.manifest_path():
+			if refs:
+				self.manifest_repo.invalidate_refs()
+			return
+		r = self.repos.get(path)
+		#repo objects that haven't been created yet have nothing to forget
+		if (r is None) or not dict.__contains__(r, 'repo'):
+			return
+		repo = r['repo']
+		abs_path = os.path.abspath(os.path.join(self.dir, path))
+		if (repo is None) == bool(self.vcs_class[r['vcs']].valid_repo(abs_path)):
+			del r['repo']
+		elif refs and hasattr(repo, 'invalidate_refs'):
+			repo.invalidate_refs()
+
+	def watched(self, path, name, func):
+		'''Project.watched(path, name, func) -> func()
+		While watching (see watch), the value is kept under path and name, and returned again
+		instead of calling func until something under path changes.'''
+		if self._watcher is None:
+			return func()
+		with self._watch_lock:
+			results = self._watch_cache.get(path, {})
+			if name in results:
+				return results[name]
+			generation = self._watch_generation
+		value = func()
+		with self._watch_lock:
+			#unless dropped meanwhile
+			if generation == self._watch_generation:
+				self._watch_cache.setdefault(path, {})[name] = value
+		return value
 
 	def repo_status(self, path):
 		#"Index" (manifest working tree) info
 		index_r = self.repos.get(path)
 
 		#Committed revset info
-		manifest_blob_id = self.manifest_repo.get_blob_id('manifest.xml')
-		commit_repos = manifest.read_from_string(
-				self.manifest_repo.show(manifest_blob_id),
-				default_default=RUG_DEFAULT_DEFAULT
-			)[1]
-		commit_r = commit_repos.get(path)
+		commit_r = self.committed_repos().get(path)
 
 		#Working tree info
 		if index_r:
@@ -391,6 +697,21 @@ class Project(object):
 
 		return status1 + status2
 
+	def committed_repos(self):
+		'''Project.committed_repos() -> repos of the manifest committed at the manifest repo HEAD
+		The parsed manifest is cached by blob id, so it is only read once per manifest revision.'''
+		with self._committed_manifest_lock:
+			blob_id = self.manifest_repo.get_blob_id('manifest.xml')
+			cached = self._committed_manifest
+			if (cached is None) or (cached[0] != blob_id):
+				repos = manifest.read_from_string(
+						self.manifest_repo.show(blob_id),
+						default_default=RUG_DEFAULT_DEFAULT
+					)[1]
+				cached = (blob_id, repos)
+				self._committed_manifest = cached
+			return cached[1]
+
 	def remote_list(self):
 		return self.remotes.keys()
 
@@ -412,8 +733,9 @@ class Project(object):
 
 		self.output.append('default added: %s=%s' % (field, value))
 
-	def checkout(self, revset=None):
-		'check out a revset'
+	@tracing.phase('checkout')
+	def checkout(self, revset=None, jobs=None, offline=False):
+		'check out a revset; offline=True never fetches, and fails for repos that would need it'
 
 		#Checkout manifest manifest
 		if revset is None:
@@ -421,59 +743,123 @@ class Project(object):
 		revset = Revset.cast(self, revset)
 		#Always throw away local rug changes - uncommitted changes to the manifest.xml file are lost
 		self.manifest_repo.checkout(revset, force=True)
+		self.output.flush('manifest: ')
 
 		#reread manifest
 		self.read_manifest()
 
 		if not self.bare:
-			sub_repos = hierarchy.hierarchy(self.repos.keys())
-			for r in self.repos.values():
-				url = self.remotes[r['remote']]['fetch'] + '/' + r['name']
-
-				#if the repo doesn't exist, clone it
-				repo = r['repo']
-				if not repo:
-					self.create_repo(r, sub_repos[r['path']])
+			sub_repos = self.repo_hierarchy()
+			#Nested repos live in their parent's working tree, so a repo is only checked out
+			#(or cloned) once its parent is done.  Independent subtrees run concurrently.
+			prerequisites = {}
+			for (path, parent) in hierarchy.parents(sub_repos).items():
+				if parent is not None:
+					prerequisites[path] = [parent]
+
+			def checkout_repo(r):
+				return self.checkout_repo(r, sub_repos[r['path']], offline=offline)
+
+			error = []
+			count = 0
+			for (path, ret, err) in parallel.imap_dag(checkout_repo, self.repos, prerequisites, jobs):
+				count += 1
+				#the repo's own output comes out in one piece, ahead of its progress line
+				self.output.flush(path + ': ')
+				if err is None:
+					self.output.append('[%d/%d] %s %s' % (count, len(self.repos), path, ret))
 				else:
-					#Verify remotes
-					if r['remote'] not in repo.remote_list():
-						repo.remote_add(r['remote'], url)
+					self.output.append('[%d/%d] %s failed' % (count, len(self.repos), path))
+					error.append('%s: %s' % (path, str(err).strip()))
+			if error:
+				raise RugError('\n'.join(error))
+
+		self.output.append('revset %s checked out' % revset.get_short_name())
+
+	def checkout_repo(self, r, sub_repos, offline=False):
+		'check out the manifest revision of a single repo, cloning it if necessary'
+		url = self.remotes[r['remote']]['fetch'] + '/' + r['name']
+
+		#if the repo doesn't exist, clone it
+		repo = r['repo']
+		if not repo:
+			if offline:
+				raise RugError('repo does not exist and cannot be cloned offline')
+			self.create_repo(r, sub_repos)
+			return 'cloned'
+		else:
+			#Verify remotes
+			new_remote = False
+			if r['remote'] not in repo.remote_list():
+				repo.remote_add(r['remote'], url)
+				new_remote = True
+			else:
+				candidate_urls = map(lambda c: c % url, RUG_CANDIDATE_TEMPLATES)
+				if repo.config('remote.%s.url' % r['remote']) not in candidate_urls:
+					clone_url = None
+					for cu in candidate_urls:
+						if git.Repo.valid_repo(cu, config=repo_config):
+							clone_url = cu
+							break
+					if clone_url:
+						repo.remote_set_url(r['remote'], clone_url)
 					else:
-						candidate_urls = map(lambda c: c % url, RUG_CANDIDATE_TEMPLATES)
-						if repo.config('remote.%s.url' % r['remote']) not in candidate_urls:
-							clone_url = None
-							for cu in candidate_urls:
-								if git.Repo.valid_repo(cu, config=repo_config):
-									clone_url = cu
-									break
-							if clone_url:
-								repo.remote_set_url(r['remote'], clone_url)
-							else:
-								raise RugError('%s does not seem to be a rug project' % url)
+						raise RugError('%s does not seem to be a rug project' % url)
+
+			#Fetch from remote, but only if the refs or objects the checkout needs aren't already here
+			if new_remote or self.checkout_needs_fetch(r):
+				if offline:
+					raise RugError('revision %s is not available offline' % r.get('revision', 'HEAD'))
+				repo.fetch(r['remote'])
+				fetched = True
+				revision = r.get('revision', 'HEAD')
+				if (r['vcs'] == 'git') and repo.valid_sha(revision):
+					#a shallow repo may need more history to reach the revision
+					repo.deepen(lambda: repo.has_object(revision), r['remote'])
+			else:
+				fetched = False
+
+			branches = self.get_branch_names(r)
 
-					#Fetch from remote
-					#TODO:decide if we should always do this here.  Sometimes have to, since we may not have
-					#seen this remote before
-					repo.fetch(r['remote'])
+			#all ref changes for this repo are made in one atomic transaction
+			with repo.ref_transaction() as refs:
+				#create rug and bookmark branches if they don't exist
+				#branches are fully qualified ('refs/...') branch names, so use ref updates
+				#instead of create_branch
+				for b in ['rug', 'bookmark']:
+					if not repo.valid_rev(branches[b]):
+						refs.create(branches[b], branches['remote'])
 
-					branches = self.get_branch_names(r)
+				for b in ['rug_index', 'bookmark_index']:
+					if repo.valid_rev(branches[b]):
+						refs.delete(branches[b])
 
-					#create rug and bookmark branches if they don't exist
-					#branches are fully qualified ('refs/...') branch names, so use update_ref
-					#instead of create_branch
-					for b in ['rug', 'bookmark']:
-						if not repo.valid_rev(branches[b]):
-							repo.update_ref(branches[b], branches['remote'])
+				#create the live branch
+				refs.update(branches['live_plumbing'], branches['rug'])
 
-					for b in ['rug_index', 'bookmark_index']:
-						if repo.valid_rev(branches[b]):
-							repo.delete_ref(branches[b])
+			#checkout the live branch
+			repo.checkout(branches['live_porcelain'])
 
-					#create and checkout the live branch
-					repo.update_ref(branches['live_plumbing'], branches['rug'])
-					repo.checkout(branches['live_porcelain'])
+			if fetched:
+				return 'fetched and checked out'
+			else:
+				return 'checked out'
 
-		self.output.append('revset %s checked out' % revset.get_short_name())
+	def checkout_needs_fetch(self, r):
+		'''Project.checkout_needs_fetch(r) -> False if the local repo already has what checking out r needs
+		A SHA revision needs the commit to be present; rug sub-projects can't tell, so always
+		fetch.  A branch revision needs the rug and bookmark branches, since they would
+		otherwise be created from a (possibly stale) remote branch.'''
+		repo = r['repo']
+		revision = r.get('revision', 'HEAD')
+		if revision == 'HEAD':
+			if not repo.valid_rev('refs/remotes/%s/HEAD' % r['remote']):
+				return True
+		elif repo.valid_sha(revision):
+			return (r['vcs'] != 'git') or not repo.has_object(revision)
+
+		branches = self.get_branch_names(r)
+		return not (repo.valid_rev(branches['rug']) and repo.valid_rev(branches['bookmark']))
 
 	def create_repo(self, r, sub_repos):
 		if self.bare:
@@ -486,19 +872,28 @@ class Project(object):
 			config = self.get_config(RUG_REPO_CONFIG_SECTION)
 		except KeyError:
 			config = None
-		repo = R.clone(url, repo_dir=abs_path, remote=r['remote'], rev=r.get('revision', None), config=config, output_buffer=self.output.spawn(r['path'] + ': '))
+		kwargs = {}
+		if r['vcs'] == 'git':
+			kwargs.update(self.clone_options(r))
+			object_cache = self.object_cache()
+			if object_cache is not None:
+				kwargs['reference'] = object_cache.mirror(url)
+		repo = R.clone(url, repo_dir=abs_path, remote=r['remote'], rev=r.get('revision', None), config=config, output_buffer=self.output.spawn(r['path'] + ': '), **kwargs)
 		if r['path'] == '.':
 			repo.add_ignore(RUG_DIR)
 		for sr in sub_repos:
 			repo.add_ignore(os.path.relpath(sr, r['path']))
 		r['repo'] = repo
 		branches = self.get_branch_names(r)
-		for b in ['live_plumbing', 'rug', 'bookmark']:
-			repo.update_ref(branches[b], branches['remote'])
+		with repo.ref_transaction() as refs:
+			for b in ['live_plumbing', 'rug', 'bookmark']:
+				refs.update(branches[b], branches['remote'])
 
 		repo.checkout(branches['live_porcelain'])
 
-	def fetch(self, source=None, repos=None):
+	@tracing.phase('fetch')
+	def fetch(self, source=None, repos=None, jobs=None):
+		'fetch the manifest repo, then all repos concurrently, running at most jobs commands at once'
 		self.manifest_repo.fetch(source)
 
 		if not self.bare:
@@ -508,14 +903,33 @@ class Project(object):
 				#TODO: turn list of strings into repos
 				pass
 
-			for r in repos:
-				repo = r['repo']
-				if repo:
-					repo.fetch(r['remote'])
-					repo.remote_set_head(r['remote'])
-
-		#TODO:output
-
+			#repos whose remote advertises nothing new are not fetched.  Those that are fetched
+			#update their object cache mirror first, so the fetch itself finds the objects locally
+			object_cache = self.object_cache()
+			#All repos are fetched as coroutines on one thread, at most jobs commands at a time
+			def fetch_repo(r):
+				before_fetch = None
+				if (object_cache is not None) and (r['vcs'] == 'git'):
+					url = self.remotes[r['remote']]['fetch'] + '/' + r['name']
+					before_fetch = lambda: object_cache.update(url)
+				return r['repo'].update_remote_async(r['remote'], before_fetch=before_fetch)
+
+			repos = [r for r in repos if r['repo']]
+			error = []
+			skipped = 0
+			results = git.run_coroutines(map(fetch_repo, repos), jobs or parallel.DEFAULT_JOBS)
+			for (r, (ret, err)) in zip(repos, results):
+				self.output.flush(r['path'] + ': ')
+				if err is not None:
+					error.append('%s: fetch failed: %s' % (r['path'], str(err).strip()))
+				elif not ret:
+					skipped += 1
+
+			self.output.append('fetched %d of %d repos (%d already up to date)' % (len(repos) - len(error) - skipped, len(repos), skipped))
+			if error:
+				raise RugError('\n'.join(error))
+
+	@tracing.phase('update')
 	def update(self, recursive=False):
 		#TODO: implement per repo update
 		repos = self.repos.values()
@@ -530,7 +944,7 @@ class Project(object):
 
 		#TODO:update manifest?
 
-		sub_repos = hierarchy.hierarchy(self.repos.keys())
+		sub_repos = self.repo_hierarchy()
 		for r in repos:
 			repo = r['repo']
 			if repo:
@@ -562,7 +976,7 @@ class Project(object):
 						repo.merge(remote_rev)
 						repo.update_ref(branches['bookmark_index'], remote_rev)
 					#otherwise rebase/merge local work
-					elif bookmark_branch and head_rev.is_descendant(bookmark_branch):
+					elif bookmark_rev and head_rev.is_descendant(bookmark_rev):
 						#TODO: currently dead code - we check for dirtyness at the top of the function
 						if repo.dirty():
 							#TODO: option to stash, rebase, then reapply?
@@ -572,12 +986,13 @@ class Project(object):
 							#TODO: handle merge/rebase conflicts
 							#TODO: remember if we're in a conflict state
 							self.output.append('%s is being rebased onto upstream repo' % r['name'])
-							[ret,out,err] = repo.rebase(bookmark_branch, onto=branches['remote'])
+							[ret,out,err] = repo.rebase(bookmark_rev, onto=branches['remote'])
 							if ret:
+								self.output.flush(r['path'] + ': ')
 								self.output.append(out)
 							else:
 								repo.update_ref(branches['bookmark_index'], branches['remote'])
-					elif not bookmark_branch:
+					elif not bookmark_rev:
 						self.output.append('%s has an unusual relationship with the remote branch, and no bookmark. Skipping this repo.' % r['path'])
 					#Fail
 					#TODO: currently dead code - we check for dirtyness at the top of the function
@@ -588,10 +1003,13 @@ class Project(object):
 						self.output.append('You are out of your element.  The current branch in %s has been in altered in an unusal way and must be manually updated.' % r['path'])
 			else:
 				repo = self.create_repo(r, sub_repos[r['path']])
+				self.output.flush(r['path'] + ': ')
 				self.output.append('Deleted repo %s check out' % r['path'])
 
 			if recursive:
 				repo.update(recursive)
+			#repos are updated one at a time: write each one's output in order with the messages about it
+			self.output.flush(r['path'] + ': ')
 
 	def add(self, path, name=None, remote=None, rev=None, vcs=None, use_sha=None):
 		#TODO:handle lists of dirs
@@ -689,13 +1107,15 @@ class Project(object):
 			repo = r['repo']
 			branches = self.get_branch_names(r)
 
-			#Update rug_index
-			repo.update_ref(branches['rug_index'], rev)
+			with repo.ref_transaction() as refs:
+				#Update rug_index
+				refs.update(branches['rug_index'], rev)
 
-			#If this is a new repo, set the rug branch
-			if update_rug_branch:
-				repo.update_ref(branches['rug'], rev)
+				#If this is a new repo, set the rug branch
+				if update_rug_branch:
+					refs.update(branches['rug'], rev)
 
+		self.output.flush(path + ': ')
 		self.output.append("%s added to manifest" % path)
 
 	def remove(self, path):
@@ -716,8 +1136,10 @@ class Project(object):
 		manifest.write(self.manifest_filename, remotes, repos, default)
 		self.read_manifest()
 
+		self.output.flush(path + ': ')
 		self.output.append("%s removed from manifest" % path)
 
+	@tracing.phase('commit')
 	def commit(self, message=None, all=False, recursive=False):
 		if not self.bare:
 			for r in self.repos.values():
@@ -734,13 +1156,15 @@ class Project(object):
 						self.add(r['path'])
 						r = self.repos[r['path']]
 				branches = self.get_branch_names(r)
-				if repo.valid_rev(branches['rug_index']):
-					repo.update_ref(branches['rug'], branches['rug_index'])
-					repo.delete_ref(branches['rug_index'])
+				with repo.ref_transaction() as refs:
+					if repo.valid_rev(branches['rug_index']):
+						refs.update(branches['rug'], branches['rug_index'])
+						refs.delete(branches['rug_index'])
 
-				if repo.valid_rev(branches['bookmark_index']):
-					repo.update_ref(branches['bookmark'], branches['bookmark_index'])
-					repo.delete_ref(branches['bookmark_index'])
+					if repo.valid_rev(branches['bookmark_index']):
+						refs.update(branches['bookmark'], branches['bookmark_index'])
+						refs.delete(branches['bookmark_index'])
+				self.output.flush(r['path'] + ': ')
 
 		#TODO: what about untracked files?
 		if self.manifest_repo.dirty():
@@ -748,13 +1172,15 @@ class Project(object):
 				raise RugError('commit message required')
 			self.manifest_repo.commit(message, all=True)
 
+		self.output.flush('manifest: ')
 		self.output.append("committed revset %s to %s" % (self.revset().get_short_name(), self.dir))
 
 	#TODO: remove this quick hack
 	def test_publish(self, remote=None):
 		return self.publish(remote, test=True)
 
-	def publish(self, source=None, test=False):
+	@tracing.phase('publish')
+	def publish(self, source=None, test=False, jobs=None):
 		if source is None:
 			source = 'origin'
 		if not source in self.source_list():
@@ -768,12 +1194,20 @@ class Project(object):
 			self.manifest_repo.stash()
 			self.read_manifest()
 
+		try:
+			return self._publish(source, test, jobs)
+		finally:
+			if do_manifest_stash_pop:
+				self.manifest_repo.stash_pop()
+				self.read_manifest()
+
+	def _publish(self, source, test, jobs):
 		#TODO: use manifest.read with apply_default=False
 		error = []
 
-		#Verify that we can push to all unpublished remotes
-		ready = True
+		#Find unpublished repos
 		repo_updates = []
+		skipped = []
 
 		if not self.bare:
 			for r in self.repos.values():
@@ -798,9 +1232,12 @@ class Project(object):
 						refspec = '%s:refs/heads/%s' % (branches['rug'], r['revision'])
 						force = False
 					repo_updates.append((r, refspec, force))
-					if not repo.test_push(r['remote'], refspec, force=force):
-						error.append('%s: %s cannot be pushed to %s' % (r['name'], r['revision'], r['remote']))
-						ready = False
+				else:
+					skipped.append(r)
+
+		#Repos sharing a remote are grouped, and the groups interleaved, so that concurrent
+		#pushes are spread across servers rather than all hitting one
+		repo_updates = parallel.interleave(repo_updates, lambda u: self.remotes.get(u[0]['remote'], {}).get('fetch'))
 
 		#Verify that we can push to manifest repo
 		#TODO: We don't always need to push manifest repo
@@ -811,9 +1248,28 @@ class Project(object):
 		else:
 			manifest_refspec = manifest_revision.get_short_name()
 			manifest_force = False
-		if not self.manifest_repo.test_push(source, manifest_refspec, force=manifest_force):
-			error.append('manifest branch %s cannot be pushed to %s' % (manifest_revision.get_short_name(), source))
-			ready = False
+
+		#Verify that we can push to all unpublished remotes and the manifest repo, concurrently.
+		#Nothing is pushed unless every dry run succeeds.
+		def test_push(update):
+			(r, refspec, force) = update
+			if r is None:
+				return self.manifest_repo.test_push(source, manifest_refspec, force=manifest_force)
+			else:
+				return r['repo'].test_push(r['remote'], refspec, force=force)
+
+		for ((r, refspec, force), ret, err) in parallel.run(test_push, repo_updates + [(None, None, None)], jobs):
+			if ret:
+				continue
+			elif r is None:
+				message = 'manifest branch %s cannot be pushed to %s' % (manifest_revision.get_short_name(), source)
+			else:
+				message = '%s: %s cannot be pushed to %s' % (r['name'], r['revision'], r['remote'])
+			#a dry run that raised, rather than answering no, says why
+			if err is not None:
+				message += ': %s' % str(err).strip()
+			error.append(message)
+		ready = not error
 
 		if test:
 			return ready
@@ -823,23 +1279,36 @@ class Project(object):
 			raise RugError('\n'.join(error))
 
 		#Push unpublished remotes
-		for (r, refspec, force) in repo_updates:
+		def push(update):
+			(r, refspec, force) = update
 			repo = r['repo']
 			repo.push(r['remote'], refspec, force)
 			branches = self.get_branch_names(r)
 			repo.update_ref(branches['bookmark'], branches['rug'])
-			self.output.append('%s: pushed %s to %s' % (r['name'], r['revision'], r['remote']))
 
-		#Push manifest
+		summary = {}
+		for r in skipped:
+			summary.setdefault(r['remote'], [0, 0, 0])[1] += 1
+		for ((r, refspec, force), ret, err) in parallel.run(push, repo_updates, jobs):
+			self.output.flush(r['path'] + ': ')
+			if err is None:
+				summary.setdefault(r['remote'], [0, 0, 0])[0] += 1
+				self.output.append('%s: pushed %s to %s' % (r['name'], r['revision'], r['remote']))
+			else:
+				summary.setdefault(r['remote'], [0, 0, 0])[2] += 1
+				error.append('%s: push of %s to %s failed: %s' % (r['name'], r['revision'], r['remote'], str(err).strip()))
+		for (remote, (pushed, skipped_count, failed)) in sorted(summary.items()):
+			self.output.append('remote %s: %d pushed, %d skipped, %d failed' % (remote, pushed, skipped_count, failed))
+
 		#TODO: we've taken steps to predict errors, but failure can still happen.  Need to
 		#leave the repo in a consistent state if that happens
+		if error:
+			raise RugError('manifest branch %s not pushed:\n%s' % (manifest_revision.get_short_name(), '\n'.join(error)))
+
+		#Push manifest
 		self.manifest_repo.push(source, manifest_refspec, force=manifest_force)
 		self.output.append('manifest branch %s pushed to %s' % (manifest_revision.get_short_name(), source))
 
-		if do_manifest_stash_pop:
-			self.manifest_repo.stash_pop()
-			self.read_manifest()
-
 	#TODO: define precisely what this should do
 	#def reset(self, optlist=[], repos=None):
 	#	if repos is None:
@@ -1,4 +1,5 @@
 import project
+import git
 
 class Repo_Rev(project.Revset):
 	@staticmethod
@@ -20,6 +21,7 @@ class Repo(object):
 			'valid_rev': mr.valid_rev,
 			'update_ref': mr.update_ref,
 			'delete_ref': mr.delete_ref,
+			'ref_transaction': mr.ref_transaction,
 			'head': mr.head,
 			'rev_parse': mr.rev_parse,
 			'symbolic_ref': mr.symbolic_ref,
@@ -57,6 +59,17 @@ class Repo(object):
 		#TODO: repo Project doesn't currently support fetching a particular source
 		self.project.fetch()
 
+	def update_remote(self, remote, before_fetch=None):
+		#no cheap way to tell whether a rug repo is current: always fetch
+		if before_fetch is not None:
+			before_fetch()
+		self.fetch(remote)
+		self.remote_set_head(remote)
+		return True
+
+	def update_remote_async(self, remote, before_fetch=None):
+		yield (yield git.Call(self.update_remote, remote, before_fetch))
+
 	def add_ignore(self, pattern):
 		raise NotImplemented('ignoring through rug repos not implemented')
 
@@ -3,8 +3,22 @@ import getopt
 import os.path
 from project import Project, RugError
 import output
+import tracing
+import daemon
 from version import __version__
 
+def get_jobs(optdict):
+	if optdict.has_key('-j'):
+		try:
+			jobs = int(optdict['-j'])
+		except ValueError:
+			jobs = 0
+		if jobs < 1:
+			raise RugError('-j requires a positive number of jobs')
+		return jobs
+	else:
+		return None
+
 def init(output_buffer, optdict, project_dir=None):
 	Project.init(project_dir, optdict.has_key('--bare'), output_buffer=output_buffer)
 
@@ -24,16 +38,20 @@ def clone(output_buffer, optdict, url=None, project_dir=None):
 		revset=optdict.get('-b'),
 		bare=optdict.has_key('--bare'),
 		repo_config=repo_config,
+		jobs=get_jobs(optdict),
+		cache_dir=optdict.get('--cache'),
+		depth=optdict.get('--depth'),
+		filter=optdict.get('--filter'),
 		output_buffer=output_buffer
 	)
 
 def checkout(proj, optdict, rev=None, src=None):
 	if '-b' in optdict:
 		proj.revset_create(rev, src)
-	proj.checkout(rev)
+	proj.checkout(rev, jobs=get_jobs(optdict), offline=optdict.has_key('--offline'))
 
 def fetch(proj, optdict, repos=None):
-	proj.fetch(repos=repos)
+	proj.fetch(repos=repos, jobs=get_jobs(optdict))
 
 def update(proj, optdict):
 	proj.update(recursive=optdict.has_key('-r'))
@@ -55,12 +73,16 @@ def status_recurse(project, project_status, level=0):
 	return output
 
 def status(proj, optdict):
+	#Generator: each repo's status is printed as soon as it is available
 	porcelain = optdict.has_key('-p')
-	if porcelain:
-		stat = proj.status(porcelain=True)
-		return '\n'.join(status_recurse(proj, stat))
-	else:
-		return proj.status(porcelain=False)
+	jobs = get_jobs(optdict)
+	if not porcelain:
+		yield '\n'.join(proj.manifest_status())
+	for (path, stat) in proj.status_iter(porcelain=porcelain, jobs=jobs):
+		if porcelain:
+			yield '\n'.join(status_recurse(proj, {path: stat}))
+		else:
+			yield '\n'.join(stat)
 
 def revset(proj, optdict, dst=None, src=None):
 	if dst is None:
@@ -98,7 +120,7 @@ def commit(proj, optdict):
 	proj.commit(message=optdict.get('-m'), all=optdict.has_key('-a'), recursive=optdict.has_key('-r'))
 
 def publish(proj, optdict, source=None):
-	proj.publish(source)
+	proj.publish(source, jobs=get_jobs(optdict))
 
 def remote_list(proj, optdict):
 	return '\n'.join(proj.remote_list())
@@ -112,53 +134,123 @@ def source_list(proj, optdict):
 def source_add(proj, optdict, source=None, url=None):
 	proj.source_add(source, url)
 
+def daemon_command(output_buffer, optdict):
+	project_dir = Project.find_project_dir()
+	if optdict.has_key('--stop'):
+		if not daemon.stop(project_dir):
+			raise RugError('no daemon is running for %s' % project_dir)
+	else:
+		commands = dict([(c, rug_commands[c][0]) for c in ['status', 'revset', 'revset_list']])
+		d = daemon.Daemon(project_dir, commands)
+		d.listen()
+		output_buffer.append('rug daemon listening on %s' % d.path)
+		output_buffer.flush()
+		try:
+			d.serve()
+		except KeyboardInterrupt:
+			pass
+
 #(function, pass project flag, options, long_options, return_stdout)
 rug_commands = {
 	'init': (init, False, '', ['bare'], False),
-	'clone': (clone, False, 'b:o:c:', ['bare'], False),
-	'checkout': (checkout, True, 'b', [], False),
-	'fetch': (fetch, True, '', [], False),
+	'clone': (clone, False, 'b:o:c:j:', ['bare', 'cache=', 'depth=', 'filter='], False),
+	'checkout': (checkout, True, 'bj:', ['offline'], False),
+	'fetch': (fetch, True, 'j:', [], False),
 	'update': (update, True, 'r', [], False),
-	'status': (status, True, 'p', [], True),
+	'status': (status, True, 'pj:', [], True),
 	'revset': (revset, True, '', [], True),
 	'revset_list': (revset_list, True, '', [], True),
 	'add': (add, True, 'sv:', [], False),
 	'remove': (remove, True, '', [], False),
 	'commit': (commit, True, 'm:ar', [], False),
-	'publish': (publish, True, '', [], False),
+	'publish': (publish, True, 'j:', [], False),
 	'remote_list': (remote_list, True, '', [], True),
 	'remote_add': (remote_add, True, '', [], False),
 	'source_list': (source_list, True, '', [], True),
 	'source_add': (source_add, True, '', [], False),
+	'daemon': (daemon_command, False, '', ['stop'], False),
 	#'reset': (Project.reset, True, ['soft', 'mixed', 'hard']),
 	}
 
 def main():
-	if (len(sys.argv) < 2):
+	#global options come before the command
+	try:
+		[global_optlist, argv] = getopt.getopt(sys.argv[1:], '', ['trace', 'trace-json=', 'output-json='])
+	except getopt.GetoptError:
 		#TODO: write usage
 		print 'rug usage'
+		return
+	global_optdict = dict(global_optlist)
+	if global_optdict.has_key('--trace') or global_optdict.has_key('--trace-json'):
+		tracer = tracing.enable()
+		try:
+			run_command(argv, global_optdict)
+		finally:
+			tracer.disable()
+			if global_optdict.has_key('--trace'):
+				sys.stderr.write(tracer.report() + '\n')
+			if global_optdict.has_key('--trace-json'):
+				tracer.write_chrome_trace(global_optdict['--trace-json'])
 	else:
-		command = sys.argv[1]
+		run_command(argv, global_optdict)
+
+def run_command(argv, global_optdict):
+	if (len(argv) < 1):
+		#TODO: write usage
+		print 'rug usage'
+	else:
+		command = argv[0]
 		if command == 'version':
 			print 'rug version %s' % __version__
 		elif command not in rug_commands:
 			print 'rug usage'
 		else:
 			(func, pass_project, optspec, long_options, return_stdout) = rug_commands[command]
-			[optlist, args] = getopt.gnu_getopt(sys.argv[2:], optspec, long_options)
+			[optlist, args] = getopt.gnu_getopt(argv[1:], optspec, long_options)
 			optdict = dict(optlist)
 			if return_stdout:
 				file = sys.stderr
 			else:
 				file = sys.stdout
-			output_buffer = output.WriterOutputBuffer(output.FileWriter(file))
-			if pass_project:
-				ret = func(Project.find_project(output_buffer=output_buffer), optdict, *args)
+			if global_optdict.has_key('--output-json'):
+				json_file = open(global_optdict['--output-json'], 'w')
 			else:
-				ret = func(output_buffer, optdict, *args)
+				json_file = None
+			#queries go to the project's daemon if one is running, unless the caller wants
+			#this process's traces or output records
+			if daemon.answers(command, args) and (tracing.tracer is None) and (json_file is None):
+				messages = daemon.query(Project.find_project_dir(), command, optdict, args)
+				if messages is not None:
+					for (name, text) in messages:
+						if name == 'stdout':
+							print text
+							sys.stdout.flush()
+						else:
+							file.write(text)
+					return
 
-			if return_stdout:
-				print ret
+			#repos' output is written a repo at a time (see Project's flush calls), the rest at the end
+			output_buffer = output.EventOutputBuffer(output.FileWriter(file), json_file=json_file)
+			try:
+				#streamed output is produced while it is printed, so the phase covers both
+				with tracing.phase(command):
+					if pass_project:
+						ret = func(Project.find_project(output_buffer=output_buffer), optdict, *args)
+					else:
+						ret = func(output_buffer, optdict, *args)
+
+					if return_stdout:
+						if isinstance(ret, basestring):
+							print ret
+						elif ret is not None:
+							#streamed output
+							for chunk in ret:
+								print chunk
+								sys.stdout.flush()
+			finally:
+				output_buffer.flush()
+				if json_file is not None:
+					json_file.close()
 
 if __name__ == '__main__':
 	main()
@@ -0,0 +1,182 @@
+import os
+import time
+import json
+import threading
+import functools
+import git
+
+class Tracer(object):
+	'''Tracer() -- records every command rug runs, and the rug-level phases it runs them in
+	Once enabled, each command finishing (see git.command_hooks) adds a record of its command,
+	working directory, timing, exit code and output size.'''
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.records = []
+		self.phases = []
+		#names of the phases currently running on each thread, outermost first; see stack
+		self.local = threading.local()
+		#the stack of the thread that began the first phase, normally the one running the command
+		self.main_stack = None
+		self.main_thread = None
+		self.start_time = time.time()
+
+	def enable(self):
+		if self.hook not in git.command_hooks:
+			git.command_hooks.append(self.hook)
+
+	def disable(self):
+		if self.hook in git.command_hooks:
+			git.command_hooks.remove(self.hook)
+
+	def hook(self, job, start, end, out, err):
+		if job.cmd == git.GIT:
+			name = job.args and job.args[0] or ''
+		else:
+			name = os.path.basename(job.cmd)
+		record = {
+			'command': name,
+			'args': [job.cmd] + job.args,
+			'cwd': os.path.abspath(job.cwd or os.getcwd()),
+			'phase': self.phase_path(),
+			'start': start,
+			'duration': end - start,
+			'returncode': job.proc.returncode,
+			'output_bytes': len(out or '') + len(err or ''),
+			'thread': threading.current_thread().ident,
+		}
+		with self.lock:
+			self.records.append(record)
+
+	def own_stack(self):
+		'own_stack() -> list of the phases begun by the current thread'
+		if not hasattr(self.local, 'stack'):
+			self.local.stack = []
+			with self.lock:
+				if self.main_stack is None:
+					self.main_stack = self.local.stack
+					self.main_thread = threading.current_thread().ident
+		return self.local.stack
+
+	def stack(self):
+		'''stack() -> names of the phases the current thread is running in, outermost first
+		Other threads (workers of parallel, git.Call threads) run within the phases of the
+		command's thread, followed by any they begin themselves.'''
+		own = self.own_stack()
+		if (own is self.main_stack) or (self.main_stack is None):
+			return list(own)
+		return list(self.main_stack) + own
+
+	def phase_path(self):
+		'phase_path() -> "/"-separated names of the running phases, or None outside of any'
+		names = []
+		for name in self.stack():
+			#e.g. the "checkout" command calling Project.checkout is one phase
+			if (not names) or (names[-1] != name):
+				names.append(name)
+		return '/'.join(names) or None
+
+	def begin_phase(self, name):
+		self.own_stack().append(name)
+		return time.time()
+
+	def end_phase(self, name, start):
+		stack = self.stack()
+		if (len(stack) < 2) or (stack[-2] != name):
+			record = {'phase': self.phase_path(), 'start': start, 'duration': time.time() - start,
+				'thread': threading.current_thread().ident}
+			with self.lock:
+				self.phases.append(record)
+		self.own_stack().pop()
+
+	def report(self):
+		'report() -> text summary of the commands run: totals per command, per repo and per phase'
+		total = sum([r['duration'] for r in self.records])
+		lines = ['%d commands, %.3fs running commands, %.3fs elapsed' % (len(self.records), total, time.time() - self.start_time)]
+		for (title, key) in [('command', 'command'), ('repo', 'cwd'), ('phase', 'phase')]:
+			lines.append('')
+			lines.append('%-40s %6s %10s %7s %12s' % ('by ' + title, 'calls', 'seconds', 'failed', 'output_bytes'))
+			totals = {}
+			for r in self.records:
+				k = r[key]
+				if key == 'cwd':
+					k = os.path.relpath(k)
+				if k not in totals:
+					totals[k] = [0, 0.0, 0, 0]
+				t = totals[k]
+				t[0] += 1
+				t[1] += r['duration']
+				t[2] += (r['returncode'] != 0)
+				t[3] += r['output_bytes']
+			for (k, t) in sorted(totals.items(), key=lambda x:x[1][1], reverse=True):
+				lines.append('%-40s %6d %10.3f %7d %12d' % (k or '-', t[0], t[1], t[2], t[3]))
+		return '\n'.join(lines)
+
+	def chrome_trace(self):
+		'''chrome_trace() -> the records in Chrome's trace event format (chrome://tracing, Perfetto)
+		Commands are laid out on as many rows as are needed to keep concurrent ones apart.  The
+		phases of each thread are on a row of their own, the command's thread's first.'''
+		pid = os.getpid()
+		events = []
+		#thread: row of its phases, 0 for the command's, then -1, -2... in order of their first phase ending
+		rows = {self.main_thread: 0}
+		for p in self.phases:
+			tid = rows.setdefault(p['thread'], -len(rows))
+			events.append({'name': p['phase'], 'cat': 'phase', 'ph': 'X', 'pid': pid, 'tid': tid,
+				'ts': int((p['start'] - self.start_time) * 1e6), 'dur': int(p['duration'] * 1e6)})
+
+		lanes = []
+		for r in sorted(self.records, key=lambda x:x['start']):
+			for (idx, end) in enumerate(lanes):
+				if end <= r['start']:
+					break
+			else:
+				idx = len(lanes)
+				lanes.append(None)
+			lanes[idx] = r['start'] + r['duration']
+			events.append({'name': ' '.join(r['args'][:2]), 'cat': 'command', 'ph': 'X', 'pid': pid, 'tid': idx + 1,
+				'ts': int((r['start'] - self.start_time) * 1e6), 'dur': int(r['duration'] * 1e6),
+				'args': {'args': r['args'], 'cwd': r['cwd'], 'returncode': r['returncode'],
+					'output_bytes': r['output_bytes'], 'phase': r['phase']}})
+		return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+	def write_chrome_trace(self, path):
+		f = open(path, 'w')
+		json.dump(self.chrome_trace(), f)
+		f.close()
+
+#The tracer phases are recorded against; None when tracing is off
+tracer = None
+
+def enable():
+	'enable() -> the process-wide Tracer, created and enabled on first use'
+	global tracer
+	if tracer is None:
+		tracer = Tracer()
+	tracer.enable()
+	return tracer
+
+class phase(object):
+	'''phase(name) -- marks a rug-level phase (checkout, update, ...), as a decorator or with "with"
+	Commands run during it, including on worker threads, are attributed to it.'''
+	def __init__(self, name):
+		self.name = name
+		self.tracer = None
+
+	def __enter__(self):
+		self.tracer = tracer
+		if self.tracer is not None:
+			self.start = self.tracer.begin_phase(self.name)
+		return self
+
+	def __exit__(self, exc_type, exc_value, tb):
+		if self.tracer is not None:
+			self.tracer.end_phase(self.name, self.start)
+
+	def __call__(self, func):
+		name = self.name
+		@functools.wraps(func)
+		def wrapper(*args, **kwargs):
+			with phase(name):
+				return func(*args, **kwargs)
+		return wrapper
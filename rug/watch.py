@@ -0,0 +1,198 @@
+import os
+import errno
+import struct
+try:
+	import ctypes
+	import ctypes.util
+except ImportError:
+	ctypes = None
+
+class WatchError(StandardError):
+	pass
+
+#inotify constants, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 02000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+	IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW
+#struct inotify_event, without its name
+EVENT_HEADER = 'iIII'
+EVENT_HEADER_SIZE = struct.calcsize(EVENT_HEADER)
+
+_libc = None
+
+def libc():
+	'libc() -> the C library, if it has inotify, or None'
+	global _libc
+	if (_libc is None) and (ctypes is not None):
+		name = ctypes.util.find_library('c')
+		try:
+			lib = ctypes.CDLL(name, use_errno=True)
+			lib.inotify_init1
+			lib.inotify_add_watch
+			lib.inotify_rm_watch
+		except (OSError, AttributeError):
+			lib = False
+		_libc = lib
+	return _libc or None
+
+def available():
+	'available() -> whether the platform can watch for changes (Linux inotify, through ctypes)'
+	return libc() is not None
+
+def git_dir_filter(path):
+	'''git_dir_filter(path) -> whether to watch the directory path
+	Inside a .git directory only the directory itself (HEAD, index, packed-refs...) and refs/
+	are watched; objects, logs and the rest change as a side effect of changes already seen
+	elsewhere, or don't matter.'''
+	components = path.split(os.path.sep)
+	if '.git' not in components:
+		return True
+	rest = components[components.index('.git')+1:]
+	return (not rest) or (rest[0] == 'refs')
+
+class Watcher(object):
+	'''Watcher(root, watched=git_dir_filter) -- inotify watch of the directory tree under root
+	changes() returns the paths, relative to root, that changed since it was last called.
+	Directories created later are watched as they appear.  watched(path) decides which
+	directories (relative to root) are watched at all.  Raises WatchError if the platform can't
+	watch, or the tree has more directories than the kernel allows watches (see
+	/proc/sys/fs/inotify/max_user_watches).'''
+
+	def __init__(self, root, watched=git_dir_filter):
+		lib = libc()
+		if lib is None:
+			raise WatchError('filesystem watching is not available')
+		self.lib = lib
+		self.root = os.path.abspath(root)
+		self.watched = watched
+		self.fd = None
+		self.start()
+
+	def start(self):
+		'start() -- watch the whole tree afresh, dropping any watches and events from before'
+		self.close()
+		fd = self.lib.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+		if fd < 0:
+			raise WatchError('inotify_init1: %s' % os.strerror(ctypes.get_errno()))
+		self.fd = fd
+		#watch descriptor: relative path of the directory, and the reverse
+		self.dirs = {}
+		self.wds = {}
+		try:
+			self.add_tree('')
+		except:
+			self.close()
+			raise
+
+	def close(self):
+		if self.fd is not None:
+			os.close(self.fd)
+			self.fd = None
+
+	def add_tree(self, path):
+		'add_tree(path) -- watch the directory path (relative to root) and the directories under it'
+		for (dirpath, dirnames, filenames) in os.walk(os.path.join(self.root, path)):
+			rel = os.path.relpath(dirpath, self.root)
+			if rel == '.':
+				rel = ''
+			if not self.watched(rel):
+				del dirnames[:]
+				continue
+			wd = self.lib.inotify_add_watch(self.fd, dirpath, WATCH_MASK)
+			if wd < 0:
+				err = ctypes.get_errno()
+				if err in [errno.ENOENT, errno.ENOTDIR]:
+					#removed while walking: its parent's events report it
+					del dirnames[:]
+					continue
+				raise WatchError('inotify_add_watch %s: %s' % (dirpath, os.strerror(err)))
+			self.dirs[wd] = rel
+			self.wds[rel] = wd
+
+	def remove_tree(self, path):
+		'remove_tree(path) -- stop watching the directory path (relative to root) and those under it'
+		prefix = path + os.path.sep
+		for (rel, wd) in self.wds.items():
+			if (rel == path) or rel.startswith(prefix):
+				self.lib.inotify_rm_watch(self.fd, wd)
+				del self.wds[rel]
+				del self.dirs[wd]
+
+	def read(self):
+		'read() -> list of (wd, mask, name) of the events queued, without waiting'
+		data = []
+		while True:
+			try:
+				chunk = os.read(self.fd, 65536)
+			except OSError, e:
+				if e.errno in [errno.EAGAIN, errno.EINTR]:
+					break
+				raise
+			if not chunk:
+				break
+			data.append(chunk)
+		data = ''.join(data)
+
+		events = []
+		offset = 0
+		while offset < len(data):
+			(wd, mask, cookie, length) = struct.unpack_from(EVENT_HEADER, data, offset)
+			offset += EVENT_HEADER_SIZE
+			name = data[offset:offset+length].rstrip('\0')
+			offset += length
+			events.append((wd, mask, name))
+		return events
+
+	def changes(self):
+		'''changes() -> set of paths (relative to root) changed since the last call, or None
+		None means changes may have been missed, e.g. when the kernel's event queue overflowed,
+		so anything may have changed.  The tree is then watched afresh (see start), so later
+		calls report changes again.  Raises WatchError if it can't be.'''
+		changed = set()
+		lost = False
+		for (wd, mask, name) in self.read():
+			if mask & IN_Q_OVERFLOW:
+				lost = True
+				continue
+			rel = self.dirs.get(wd)
+			if rel is None:
+				#a watch already removed
+				continue
+			if mask & IN_IGNORED:
+				del self.dirs[wd]
+				self.wds.pop(rel, None)
+				continue
+			if name.endswith('.lock'):
+				#git writes files under a .lock name, then renames them into place
+				continue
+			path = os.path.join(rel, name)
+			if mask & IN_ISDIR:
+				if mask & (IN_CREATE | IN_MOVED_TO):
+					#files may have been created before the watch was in place: the new
+					#directory itself is reported
+					try:
+						self.add_tree(path)
+					except WatchError:
+						lost = True
+				elif mask & IN_MOVED_FROM:
+					self.remove_tree(path)
+			changed.add(path)
+		if lost:
+			self.start()
+			return None
+		return changed
@@ -1,10 +1,71 @@
 import rug
+import rug.cache
+import rug.config
+import rug.daemon
+import rug.hierarchy
+import rug.manifest
+import rug.output
+import rug.parallel
+import rug.rug
+import rug.tracing
+import rug.watch
 import unittest
 import os
+import json
+import threading
 import shutil
+import socket
+import StringIO
+import sys
+import tempfile
+import time
+import traceback
 
 test_url = 'git@github.com:abstrakraft/rug-test-project'
 test_repo = 'test_repo'
+local_repo = 'test_local_repo'
+
+def make_local_repo(path, commits=1):
+	'''make_local_repo(path, commits=1) -> git.Repo with a linear history on master, no network needed'''
+	repo = rug.git.Repo.init(path)
+	repo.config('user.name', 'rug test')
+	repo.config('user.email', 'rug@example.com')
+	for idx in range(commits):
+		f = open(os.path.join(path, 'file'), 'a')
+		f.write('%d\n' % idx)
+		f.close()
+		repo.add('file')
+		repo.commit('commit %d' % idx)
+	return repo
+
+def make_local_project(path):
+	'''make_local_project(path) -> rug.Project with a single repo, a, no network needed'''
+	project = rug.Project.init(path)
+	make_local_repo(os.path.join(path, 'a'))
+	project.remote_add('origin', 'file:///nowhere')
+	project.add('a', name='a', remote='origin')
+	return project
+
+def make_remote_project(path, remote_dir, names=['a', 'b'], output_buffer=None):
+	'''make_remote_project(path, remote_dir, names=['a', 'b'], output_buffer=None) -> rug.Project cloned to path
+	Its manifest and the repos named are bare repos in remote_dir, no network needed.'''
+	remote_dir = os.path.abspath(remote_dir)
+	src = os.path.join(remote_dir, 'src')
+	for name in names + ['manifest']:
+		make_local_repo(os.path.join(src, name))
+	f = open(os.path.join(src, 'manifest', 'manifest.xml'), 'w')
+	f.write('<manifest>\n<default revision="master" remote="origin"/>\n')
+	f.write('<remote name="origin" fetch="file://%s"/>\n' % remote_dir)
+	for name in names:
+		f.write('<repo path="%s" name="%s"/>\n' % (name, name))
+	f.write('</manifest>\n')
+	f.close()
+	manifest_repo = rug.git.Repo(os.path.join(src, 'manifest'))
+	manifest_repo.add('manifest.xml')
+	manifest_repo.commit('manifest')
+	for name in names + ['manifest']:
+		rug.git.shell_cmd(rug.git.GIT, ['clone', '-q', '--bare', os.path.join(src, name), os.path.join(remote_dir, name)])
+	return rug.Project.clone('file://' + os.path.join(remote_dir, 'manifest'), path, output_buffer=output_buffer)
 
 class GitCloneTestCase(unittest.TestCase):
 	'''Test cases for git.Repo.clone'''
@@ -38,6 +99,870 @@ class GitRevTestCase(unittest.TestCase):
 		self.assertEqual(rug.git.Rev(repo, head.get_sha()).get_sha(), head.get_sha())
 		self.assertTrue(rug.git.Rev(repo, head.get_sha()).is_sha())
 
+class GitCoroutineTestCase(unittest.TestCase):
+	'''Test cases for git.run_coroutines'''
+	def test_run_coroutines(self):
+		'''test_run_coroutines - jobs, calls, nested coroutines and errors'''
+		def echo(word):
+			out = yield rug.git.Job('echo', [word])
+			yield out
+
+		def nested(word):
+			out = yield echo(word)
+			n = yield rug.git.Call(len, out)
+			yield (out, n)
+
+		def failing():
+			yield rug.git.Job('false', [])
+
+		def stdin(data):
+			yield (yield rug.git.Job('cat', [], input=data))
+
+		data = 'x' * 100000
+		results = rug.git.run_coroutines([nested(w) for w in ['a', 'bb', 'ccc']] + [failing(), stdin(data)], jobs=2)
+		self.assertEqual(results[:3], [(('a', 1), None), (('bb', 2), None), (('ccc', 3), None)])
+		self.assertEqual(results[3][0], None)
+		self.assertTrue(isinstance(results[3][1], rug.git.GitError))
+		self.assertEqual(results[4], (data, None))
+
+		self.assertEqual(rug.git.run_coroutine(echo('sync')), 'sync')
+		self.assertRaises(rug.git.GitError, rug.git.run_coroutine, failing())
+
+		#the error is raised with the traceback from inside the coroutine
+		def raising():
+			yield rug.git.Job('echo', ['x'])
+			raise ValueError('raising')
+		try:
+			rug.git.run_coroutine(raising())
+		except ValueError:
+			frames = traceback.extract_tb(sys.exc_info()[2])
+		self.assertEqual(frames[-1][2], 'raising')
+
+	def test_interrupted(self):
+		'''test_interrupted - calls still running when the loop is interrupted don't write to reused fds'''
+		release = threading.Event()
+		def waiting():
+			yield rug.git.Call(release.wait)
+		def interrupting():
+			raise KeyboardInterrupt()
+			yield
+		self.assertRaises(KeyboardInterrupt, rug.git.run_coroutines, [waiting(), interrupting()])
+
+		#files opened now may get the numbers of the loop's closed fds
+		files = [tempfile.TemporaryFile() for idx in range(2)]
+		release.set()
+		time.sleep(0.2)
+		for f in files:
+			f.seek(0)
+			self.assertEqual(f.read(), '')
+			f.close()
+
+class TracingTestCase(unittest.TestCase):
+	'''Test cases for rug.tracing'''
+	def test_tracer(self):
+		'''test_tracer - commands are recorded with their phase, and summarized'''
+		tracer = rug.tracing.Tracer()
+		tracer.enable()
+		try:
+			@rug.tracing.phase('outer')
+			def outer():
+				rug.git.shell_cmd('echo', ['hello'])
+				rug.git.shell_cmd('false', [], raise_errors=False)
+			rug.tracing.tracer = tracer
+			outer()
+		finally:
+			rug.tracing.tracer = None
+			tracer.disable()
+		rug.git.shell_cmd('true', [])
+
+		self.assertEqual([(r['command'], r['phase'], r['returncode']) for r in tracer.records], [('echo', 'outer', 0), ('false', 'outer', 1)])
+		self.assertEqual(tracer.records[0]['output_bytes'], len('hello\n'))
+		self.assertTrue('by phase' in tracer.report())
+		events = tracer.chrome_trace()['traceEvents']
+		self.assertEqual(sorted([e['cat'] for e in events]), ['command', 'command', 'phase'])
+
+	def test_threads(self):
+		'''test_threads - each thread has its own phases, within those of the command's thread'''
+		tracer = rug.tracing.Tracer()
+		tracer.enable()
+		inside = threading.Event()
+		done = threading.Event()
+		def worker():
+			with rug.tracing.phase('inner'):
+				inside.set()
+				rug.git.shell_cmd('echo', ['inner'])
+				done.wait()
+			rug.git.shell_cmd('echo', ['worker'])
+		try:
+			rug.tracing.tracer = tracer
+			with rug.tracing.phase('outer'):
+				t = threading.Thread(target=worker)
+				t.start()
+				inside.wait()
+				#the worker's phase doesn't leak into this thread's
+				rug.git.shell_cmd('echo', ['outer'])
+				done.set()
+				t.join()
+		finally:
+			rug.tracing.tracer = None
+			tracer.disable()
+
+		phases = dict([(r['args'][1], r['phase']) for r in tracer.records])
+		self.assertEqual(phases, {'inner': 'outer/inner', 'worker': 'outer', 'outer': 'outer'})
+		rows = dict([(e['name'], e['tid']) for e in tracer.chrome_trace()['traceEvents'] if e['cat'] == 'phase'])
+		self.assertEqual(rows, {'outer': 0, 'outer/inner': -1})
+
+class GitBatchTestCase(unittest.TestCase):
+	'''Test cases for queries answered through git.BatchChannel'''
+	@classmethod
+	def setUpClass(cls):
+		make_local_repo(local_repo, commits=2)
+
+	@classmethod
+	def tearDownClass(cls):
+		if os.path.exists(local_repo):
+			shutil.rmtree(local_repo)
+
+	def test_batch_matches_oneshot(self):
+		'''test_batch_matches_oneshot - batched and one-shot rev_parse agree'''
+		repo = rug.git.Repo(local_repo)
+		for rev in ['HEAD', 'master', 'HEAD~1', 'refs/heads/master']:
+			repo.use_batch = True
+			batched = repo.rev_parse(rev)
+			repo.use_batch = False
+			self.assertEqual(batched, repo.rev_parse(rev))
+		repo.close()
+
+	def test_batch_unknown(self):
+		'''test_batch_unknown - unknown revs are invalid through the batch channel'''
+		repo = rug.git.Repo(local_repo)
+		self.assertFalse(repo.valid_rev('refs/rug/no_such_ref'))
+		self.assertRaises(rug.git.UnknownRevisionError, repo.rev_parse, 'no_such_branch')
+		self.assertTrue(repo.valid_sha(repo.head().get_sha()))
+		repo.close()
+
+class GitRefSnapshotTestCase(unittest.TestCase):
+	'''Test cases for the git.Repo ref snapshot'''
+	@classmethod
+	def setUpClass(cls):
+		repo = make_local_repo(local_repo, commits=2)
+		repo.git_cmd(['tag', 'v1', 'HEAD~1'])
+		repo.git_cmd(['tag', '-a', '-m', 'annotated', 'v2'])
+		repo.git_cmd(['tag', 'dup', 'HEAD~1'])
+		repo.branch_create('dup')
+		repo.remote_add('origin', os.path.abspath(local_repo))
+		repo.fetch('origin')
+		repo.remote_set_head('origin')
+
+	@classmethod
+	def tearDownClass(cls):
+		if os.path.exists(local_repo):
+			shutil.rmtree(local_repo)
+
+	def test_matches_rev_parse(self):
+		'''test_matches_rev_parse - snapshot answers agree with rev-parse'''
+		repo = rug.git.Repo(local_repo)
+		names = ['HEAD', 'master', 'v1', 'v2', 'dup', 'origin', 'origin/HEAD', 'origin/master',
+			'refs/remotes/origin/HEAD', 'refs/heads/master', 'heads/master', 'tags/v1']
+		for name in names:
+			for kwargs in [{}, {'full_name': True}, {'abbrev_ref': True}]:
+				repo.use_ref_snapshot = True
+				snapshot = repo.rev_parse(name, **kwargs)
+				repo.use_ref_snapshot = False
+				self.assertEqual(snapshot, repo.rev_parse(name, **kwargs), '%s %s' % (name, kwargs))
+		repo.use_ref_snapshot = True
+		self.assertFalse(repo.valid_rev('refs/rug/rug_index'))
+
+	def test_write_through(self):
+		'''test_write_through - ref changes made through Repo are visible in the snapshot'''
+		repo = rug.git.Repo(local_repo)
+		repo.refs()
+		repo.update_ref('refs/rug/test', 'HEAD~1')
+		self.assertEqual(repo.refs()['refs/rug/test'], rug.git.shell_cmd('git', ['rev-parse', 'HEAD~1'], cwd=local_repo))
+		repo.delete_ref('refs/rug/test')
+		self.assertFalse(repo.valid_rev('refs/rug/test'))
+		repo.branch_create('snapshot_branch')
+		self.assertTrue(repo.valid_rev('snapshot_branch'))
+
+class GitRefTransactionTestCase(unittest.TestCase):
+	'''Test cases for git.RefTransaction'''
+	@classmethod
+	def setUpClass(cls):
+		make_local_repo(local_repo, commits=2)
+
+	@classmethod
+	def tearDownClass(cls):
+		if os.path.exists(local_repo):
+			shutil.rmtree(local_repo)
+
+	def test_transaction(self):
+		'''test_transaction - queued changes are applied together and may refer to each other'''
+		repo = rug.git.Repo(local_repo)
+		with repo.ref_transaction() as refs:
+			refs.update('refs/rug/a', 'HEAD~1')
+			refs.create('refs/rug/b', 'refs/rug/a')
+		self.assertEqual(repo.rev_parse('refs/rug/b'), repo.rev_parse('HEAD~1'))
+		with repo.ref_transaction() as refs:
+			refs.update('refs/rug/a', 'refs/rug/b')
+			refs.delete('refs/rug/b')
+		self.assertFalse(repo.valid_rev('refs/rug/b'))
+
+	def test_atomic(self):
+		'''test_atomic - a failing transaction changes nothing'''
+		repo = rug.git.Repo(local_repo)
+		refs = repo.ref_transaction()
+		refs.update('refs/rug/c', 'HEAD')
+		refs.create('refs/heads/master', 'HEAD~1')
+		self.assertRaises(rug.git.GitError, refs.commit)
+		repo.invalidate_refs()
+		self.assertFalse(repo.valid_rev('refs/rug/c'))
+
+class GitAncestryTestCase(unittest.TestCase):
+	'''Test cases for git.Rev ancestry queries'''
+	@classmethod
+	def setUpClass(cls):
+		make_local_repo(local_repo, commits=3)
+
+	@classmethod
+	def tearDownClass(cls):
+		if os.path.exists(local_repo):
+			shutil.rmtree(local_repo)
+
+	def test_ancestry(self):
+		'''test_ancestry - is_descendant and can_fastforward follow the commit graph'''
+		repo = rug.git.Repo(local_repo)
+		head = repo.head()
+		old = rug.git.Rev(repo, 'HEAD~2')
+		self.assertTrue(head.is_descendant(old))
+		self.assertTrue(head.is_descendant(head))
+		self.assertFalse(old.is_descendant(head))
+		self.assertTrue(old.can_fastforward(head))
+		self.assertFalse(head.can_fastforward(old))
+
+class GitRemoteCurrentTestCase(unittest.TestCase):
+	'''Test cases for git.Repo.update_remote'''
+	@classmethod
+	def setUpClass(cls):
+		make_local_repo(local_repo)
+
+	@classmethod
+	def tearDownClass(cls):
+		for d in [local_repo, local_repo + '_clone']:
+			if os.path.exists(d):
+				shutil.rmtree(d)
+
+	def test_update_remote(self):
+		'''test_update_remote - only remotes that advertise new refs are fetched'''
+		upstream = rug.git.Repo(local_repo)
+		repo = rug.git.Repo.clone(os.path.abspath(local_repo), local_repo + '_clone')
+		self.assertFalse(repo.update_remote('origin'))
+
+		upstream.branch_create('dev', 'master')
+		self.assertTrue(repo.update_remote('origin'))
+		self.assertEqual(repo.rev_parse('origin/dev'), upstream.rev_parse('dev'))
+		self.assertFalse(repo.update_remote('origin'))
+
+		upstream.git_cmd(['tag', 'v1'])
+		self.assertTrue(repo.update_remote('origin'))
+		self.assertFalse(repo.update_remote('origin'))
+
+class ObjectCacheTestCase(unittest.TestCase):
+	'''Test cases for rug.cache.ObjectCache'''
+	@classmethod
+	def setUpClass(cls):
+		make_local_repo(local_repo)
+
+	@classmethod
+	def tearDownClass(cls):
+		for d in [local_repo, local_repo + '_clone', local_repo + '_cache']:
+			if os.path.exists(d):
+				shutil.rmtree(d)
+
+	def test_reference_clone(self):
+		'''test_reference_clone - clones borrow objects from the mirror, which fetch keeps current'''
+		upstream = rug.git.Repo(local_repo)
+		url = os.path.abspath(local_repo)
+		object_cache = rug.cache.ObjectCache(local_repo + '_cache')
+		mirror = object_cache.mirror(url)
+		self.assertEqual(mirror, object_cache.mirror_dir(url))
+
+		repo = rug.git.Repo.clone(url, local_repo + '_clone', reference=mirror)
+		self.assertEqual(repo.rev_parse('master'), upstream.rev_parse('master'))
+		self.assertEqual(repo.git_func(['count-objects']).split()[0], '0')
+
+		make_local_repo(local_repo)
+		object_cache.update(url)
+		self.assertEqual(rug.git.Repo(mirror).rev_parse('master'), upstream.rev_parse('master'))
+
+class GitShallowTestCase(unittest.TestCase):
+	'''Test cases for shallow clones and deepening'''
+	@classmethod
+	def setUpClass(cls):
+		make_local_repo(local_repo, commits=5)
+
+	@classmethod
+	def tearDownClass(cls):
+		for d in [local_repo, local_repo + '_clone', local_repo + '_old', local_repo + '_partial', local_repo + '_behind']:
+			if os.path.exists(d):
+				shutil.rmtree(d)
+
+	def test_deepen(self):
+		'''test_deepen - ancestry queries and SHA checkouts fetch the history they need'''
+		upstream = rug.git.Repo(local_repo)
+		url = 'file://' + os.path.abspath(local_repo)
+		old = upstream.rev_parse('HEAD~3')
+
+		repo = rug.git.Repo.clone(url, local_repo + '_clone', depth=1)
+		self.assertTrue(repo.is_shallow())
+		self.assertFalse(repo.has_object(old))
+		self.assertTrue(repo.is_ancestor(old, repo.rev_parse('HEAD')))
+		self.assertFalse(repo.is_ancestor(repo.rev_parse('HEAD'), old))
+		self.assertFalse(repo.is_shallow())
+
+		repo = rug.git.Repo.clone(url, local_repo + '_old', rev=old, depth=1)
+		self.assertEqual(repo.rev_parse('HEAD'), old)
+
+	def test_negative_ancestry(self):
+		'''test_negative_ancestry - a negative answer between fetched commits doesn't deepen the repo'''
+		url = 'file://' + os.path.abspath(local_repo)
+		repo = rug.git.Repo.clone(url, local_repo + '_behind', depth=1)
+		upstream = rug.git.Repo(local_repo)
+		head = upstream.rev_parse('HEAD')
+		f = open(os.path.join(local_repo, 'file'), 'a')
+		f.write('new\n')
+		f.close()
+		upstream.commit('upstream moved on', all=True)
+		try:
+			repo.fetch('origin', depth=1)
+			self.assertFalse(repo.is_ancestor(repo.rev_parse('remotes/origin/master'), repo.rev_parse('HEAD')))
+			self.assertTrue(repo.is_shallow())
+		finally:
+			rug.git.shell_cmd(rug.git.GIT, ['reset', '-q', '--hard', head], cwd=local_repo)
+
+	def test_filter(self):
+		'''test_filter - partial clones remember their filter'''
+		upstream = rug.git.Repo(local_repo)
+		upstream.config('uploadpack.allowFilter', 'true')
+		repo = rug.git.Repo.clone('file://' + os.path.abspath(local_repo), local_repo + '_partial', filter='blob:none')
+		self.assertEqual(repo.config('remote.origin.partialclonefilter'), 'blob:none')
+		self.assertEqual(repo.rev_parse('HEAD'), upstream.rev_parse('HEAD'))
+
+class GitValidRepoTestCase(unittest.TestCase):
+	'''Test cases for git.Repo.valid_repo local detection'''
+	@classmethod
+	def setUpClass(cls):
+		make_local_repo(local_repo)
+
+	@classmethod
+	def tearDownClass(cls):
+		for d in [local_repo, local_repo + '.git', local_repo + '_link']:
+			if os.path.exists(d):
+				shutil.rmtree(d)
+
+	def test_layouts(self):
+		'''test_layouts - working, bare and gitdir-file repos are valid; plain directories aren't'''
+		self.assertTrue(rug.git.Repo.valid_repo(local_repo))
+		self.assertFalse(rug.git.Repo(local_repo).bare)
+		self.assertFalse(rug.git.Repo.valid_repo(os.path.join(local_repo, '.git', 'refs')))
+		self.assertFalse(rug.git.Repo.valid_repo('no_such_directory'))
+
+		rug.git.shell_cmd('git', ['clone', '-q', '--bare', local_repo, local_repo + '.git'])
+		self.assertTrue(rug.git.Repo.valid_repo(local_repo + '.git'))
+		self.assertTrue(rug.git.Repo(local_repo + '.git').bare)
+
+		os.mkdir(local_repo + '_link')
+		f = open(os.path.join(local_repo + '_link', '.git'), 'w')
+		f.write('gitdir: ../%s/.git\n' % local_repo)
+		f.close()
+		self.assertTrue(rug.git.Repo.valid_repo(local_repo + '_link'))
+
+	def test_is_url(self):
+		'''test_is_url - URLs and scp-like host:path names are remote, anything else is a path'''
+		for url in ['file:///srv/repo', 'ssh://host/repo', 'host:repo', 'h:repo', 'user@host:dir/repo']:
+			self.assertTrue(rug.git.is_url(url), url)
+		for path in ['repo', 'dir/repo', './h:repo', '/srv/h:repo', ':repo']:
+			self.assertFalse(rug.git.is_url(path), path)
+
+class ManifestTestCase(unittest.TestCase):
+	'''Test cases for rug.manifest'''
+	def test_round_trip(self):
+		'''test_round_trip - manifest.write output reads back unchanged, with defaults applied'''
+		filename = 'test_manifest.xml'
+		remotes = {'origin': {'name': 'origin', 'fetch': 'http://example.com/a&b'}}
+		repos = {'a': {'path': 'a', 'name': 'a'}, 'b/c': {'path': 'b/c', 'name': 'c', 'revision': 'dev'}}
+		default = {'revision': 'master', 'remote': 'origin'}
+		try:
+			rug.manifest.write(filename, remotes, repos, default)
+			self.assertEqual(rug.manifest.read(filename, apply_default=False), (remotes, repos, default))
+			(r, applied) = rug.manifest.read(filename, default_default={'vcs': 'git'})
+			self.assertEqual(applied['a'], {'path': 'a', 'name': 'a', 'revision': 'master', 'remote': 'origin', 'vcs': 'git'})
+			self.assertEqual(applied['b/c']['revision'], 'dev')
+		finally:
+			os.remove(filename)
+
+	def test_default_after_repos(self):
+		'''test_default_after_repos - a default element applies to repos that precede it'''
+		(remotes, repos) = rug.manifest.read_from_string(
+			'<manifest><repo path="a" name="a"/><default revision="dev"/></manifest>')
+		self.assertEqual(repos['a']['revision'], 'dev')
+		self.assertRaises(rug.manifest.ManifestError, rug.manifest.read_from_string, '<notmanifest/>')
+
+class HierarchyTestCase(unittest.TestCase):
+	'''Test cases for rug.hierarchy'''
+	def test_hierarchy(self):
+		'''test_hierarchy - nearest enclosing paths, with . and .. normalized'''
+		h = rug.hierarchy.hierarchy(['.', 'a', 'a/x/b', 'c/../d', 'a/./x/b/e'])
+		self.assertEqual(dict([(k, sorted(v)) for (k, v) in h.items()]),
+			{'.': ['a', 'c/../d'], 'a': ['a/x/b'], 'a/x/b': ['a/./x/b/e'], 'c/../d': [], 'a/./x/b/e': []})
+		self.assertRaises(ValueError, rug.hierarchy.hierarchy, ['a/b', 'a/c/../b'])
+		self.assertRaises(ValueError, rug.hierarchy.hierarchy, ['a/../../b'])
+
+	def test_incremental(self):
+		'''test_incremental - paths can be added and removed one at a time'''
+		trie = rug.hierarchy.Trie(['a', 'a/b/c'])
+		trie.add('a/b')
+		self.assertEqual(trie.children('a'), ['a/b'])
+		self.assertEqual(trie.parent('a/b/c'), 'a/b')
+		self.assertEqual(trie.find('a/b/d/e'), 'a/b')
+		self.assertEqual(trie.find('x'), None)
+		trie.remove('a/b')
+		trie.remove('a/b/c')
+		self.assertEqual(trie.children('a'), [])
+		self.assertEqual(trie.root.children['a'].children, {})
+		self.assertEqual(len(trie), 1)
+
+class OutputTestCase(unittest.TestCase):
+	'''Test cases for rug.output'''
+	def test_event_buffer(self):
+		'''test_event_buffer - repo output is held and written a repo at a time'''
+		writer = rug.output.StringWriter()
+		json_file = StringIO.StringIO()
+		root = rug.output.EventOutputBuffer(writer, json_file=json_file)
+		a = root.spawn('a: ')
+		b = root.spawn('b: ')
+		a.append('one')
+		b.append('two')
+		a.spawn('c: ').append('three')
+		a.append('four\n')
+		root.append('progress')
+		self.assertEqual(writer.string, 'progress\n')
+
+		root.flush('b: ')
+		root.flush('a: ')
+		self.assertEqual(writer.string, 'progress\nb: two\na: one\na: four\na: c: three\n')
+		root.flush()
+		self.assertEqual(writer.string.count('\n'), 5)
+
+		records = [json.loads(line) for line in json_file.getvalue().split('\n') if line]
+		self.assertEqual([(r['repo'], r['text']) for r in records],
+			[(None, 'progress'), ('b', 'two'), ('a', 'one'), ('a', 'four\n'), ('a/c', 'three')])
+
+class ParallelTestCase(unittest.TestCase):
+	'''Test cases for rug.parallel'''
+	def test_run(self):
+		'''test_run - results come back in input order, and errors don't stop other items'''
+		def func(x):
+			if x == 3:
+				raise ValueError('three')
+			return x*x
+		results = rug.parallel.run(func, range(10), jobs=4)
+		self.assertEqual([item for (item, ret, err) in results], range(10))
+		self.assertEqual(results[2], (2, 4, None))
+		self.assertTrue(isinstance(results[3][2], ValueError))
+
+	def test_interleave(self):
+		'''test_interleave - items sharing a key are spread out round-robin'''
+		items = ['a1', 'a2', 'a3', 'b1', 'c1', 'c2']
+		self.assertEqual(rug.parallel.interleave(items, lambda x: x[0]), ['a1', 'b1', 'c1', 'a2', 'c2', 'a3'])
+
+	def test_imap_dag(self):
+		'''test_imap_dag - items run after their prerequisites, and failures skip dependents'''
+		paths = ['a', 'a/b', 'a/b/c', 'd', 'd/e', 'f']
+		parents = rug.hierarchy.parents(rug.hierarchy.hierarchy(paths))
+		prerequisites = dict([(p, [parents[p]]) for p in paths if parents[p]])
+		finished = []
+		def func(path):
+			for pre in prerequisites.get(path, []):
+				self.assertTrue(pre in finished)
+			if path == 'd':
+				raise ValueError('d')
+			finished.append(path)
+		results = dict([(key, err) for (key, ret, err) in
+			rug.parallel.imap_dag(func, dict(zip(paths, paths)), prerequisites, jobs=3)])
+		self.assertEqual(sorted(results.keys()), sorted(paths))
+		self.assertTrue(isinstance(results['d'], ValueError))
+		self.assertTrue(isinstance(results['d/e'], rug.parallel.SkippedError))
+		self.assertEqual(sorted(finished), ['a', 'a/b', 'a/b/c', 'f'])
+
+class ProjectUpdateTestCase(unittest.TestCase):
+	'''Test cases for rug.Project.update'''
+	def setUp(self):
+		self.project = rug.Project.init(local_repo)
+		make_local_repo(os.path.join(local_repo, 'a'))
+		self.project.remote_add('origin', 'file:///nowhere')
+		self.project.add('a', name='a', remote='origin')
+		self.project.commit('add a')
+
+	def tearDown(self):
+		shutil.rmtree(local_repo)
+
+	def test_clean(self):
+		'''test_clean - a project with everything committed isn't dirty, and can be updated'''
+		self.assertFalse(self.project.dirty())
+		self.project.update()
+
+		#a commit not yet in the manifest
+		make_local_repo(os.path.join(local_repo, 'a'))
+		self.assertTrue(self.project.dirty())
+		self.assertRaises(rug.project.RugError, self.project.update)
+
+class ProjectStatusTestCase(unittest.TestCase):
+	'''Test cases for rug.Project.status_iter'''
+	def setUp(self):
+		self.project = make_local_project(local_repo)
+
+	def tearDown(self):
+		shutil.rmtree(local_repo)
+
+	def test_status(self):
+		'''test_status - repos' status, and errors raised with the traceback from the worker'''
+		p = self.project
+		self.assertEqual(list(p.status_iter()), [('a', ['A ', {}])])
+
+		def repo_status(path):
+			raise ValueError(path)
+		p.repo_status = repo_status
+		try:
+			list(p.status_iter())
+		except ValueError:
+			frames = traceback.extract_tb(sys.exc_info()[2])
+		self.assertEqual(frames[-1][2], 'repo_status')
+
+class ProjectFindTestCase(unittest.TestCase):
+	'''Test cases for rug.Project.find_project_dir'''
+	def setUp(self):
+		make_local_project(local_repo)
+		rug.Project.init(os.path.join(local_repo, 'sub'))
+		os.makedirs(os.path.join(local_repo, 'sub', 'dir'))
+		self.env = os.environ.pop(rug.project.RUG_PROJECT_ENV, None)
+
+	def tearDown(self):
+		if self.env is None:
+			os.environ.pop(rug.project.RUG_PROJECT_ENV, None)
+		else:
+			os.environ[rug.project.RUG_PROJECT_ENV] = self.env
+		shutil.rmtree(local_repo)
+
+	def test_find(self):
+		'''test_find - the nearest project is found, and one named in the environment is trusted once reached'''
+		top = os.path.abspath(local_repo)
+		sub = os.path.join(top, 'sub')
+		find = rug.Project.find_project_dir
+		for pointer in [None, top]:
+			if pointer is not None:
+				os.environ[rug.project.RUG_PROJECT_ENV] = pointer
+			self.assertEqual(find(os.path.join(local_repo, 'a')), top)
+			self.assertEqual(find(os.path.join(local_repo, 'sub', 'dir')), sub)
+
+		#taken without checking it, but only for the directories inside it
+		os.environ[rug.project.RUG_PROJECT_ENV] = os.path.join(local_repo, 'a')
+		self.assertEqual(find(os.path.join(local_repo, 'a')), os.path.join(top, 'a'))
+		self.assertEqual(find(local_repo), top)
+
+class ProjectRemoteTestCase(unittest.TestCase):
+	'''Test cases for rug.Project commands talking to (local) remotes'''
+	remote_dir = local_repo + '_remotes'
+
+	def setUp(self):
+		self.writer = rug.output.StringWriter()
+		self.project = make_remote_project(local_repo, self.remote_dir, names=['a', 'b', 'c'],
+			output_buffer=rug.output.WriterOutputBuffer(self.writer))
+
+	def tearDown(self):
+		for path in [local_repo, self.remote_dir]:
+			if os.path.exists(path):
+				shutil.rmtree(path)
+
+	def advance(self, name):
+		'advance(name) -> sha of a new commit pushed to the remote repo name'
+		src = os.path.join(self.remote_dir, 'src', name)
+		make_local_repo(src)
+		rug.git.shell_cmd(rug.git.GIT, ['push', '-q', os.path.abspath(os.path.join(self.remote_dir, name)), 'master'], cwd=src)
+		return rug.git.shell_cmd(rug.git.GIT, ['rev-parse', 'HEAD'], cwd=src)
+
+	def pin(self, name, revision):
+		'pin(name, revision) -- commit the manifest with repo name at revision'
+		p = self.project
+		(remotes, repos, default) = rug.manifest.read(p.manifest_filename, apply_default=False)
+		repos[name]['revision'] = revision
+		rug.manifest.write(p.manifest_filename, remotes, repos, default)
+		p.manifest_repo.add('manifest.xml')
+		p.manifest_repo.commit('pin %s' % name)
+
+	def commands(self, func, *args, **kwargs):
+		'commands(func, *args, **kwargs) -> (git command, repo directory name) of each command func runs'
+		ret = []
+		def hook(job, start, end, out, err):
+			ret.append((job.args[0], os.path.basename(job.cwd or '')))
+		rug.git.command_hooks.append(hook)
+		try:
+			func(*args, **kwargs)
+		finally:
+			rug.git.command_hooks.remove(hook)
+		return ret
+
+	def test_checkout(self):
+		'''test_checkout - only revisions missing locally are fetched, and never offline'''
+		p = self.project
+		commands = [c for (c, d) in self.commands(p.checkout)]
+		self.assertFalse(('fetch' in commands) or ('ls-remote' in commands))
+
+		sha = self.advance('a')
+		self.pin('a', sha)
+		self.assertEqual([d for (c, d) in self.commands(p.checkout) if c == 'fetch'], ['a'])
+		self.assertTrue(p.repos['a']['repo'].has_object(sha))
+
+		self.pin('a', self.advance('a'))
+		commands = [c for (c, d) in self.commands(self.assertRaises, rug.project.RugError, p.checkout, offline=True)]
+		self.assertFalse(('fetch' in commands) or ('ls-remote' in commands))
+
+		#rug sub-projects pinned to a SHA can't be asked for it, so always fetch
+		class SubProject(object):
+			def valid_sha(self, rev):
+				return True
+		self.assertTrue(p.checkout_needs_fetch({'vcs': 'rug', 'repo': SubProject(), 'remote': 'origin', 'revision': sha}))
+
+	def test_fetch(self):
+		'''test_fetch - a repo failing to fetch doesn't stop the others, and is reported'''
+		p = self.project
+		sha = self.advance('a')
+		self.advance('b')
+		p.repos['b']['repo'].remote_set_url('origin', 'file:///nowhere')
+		error = ''
+		try:
+			p.fetch()
+		except rug.project.RugError, e:
+			error = str(e)
+		self.assertEqual([line.split(':')[0] for line in error.split('\n') if ': fetch failed' in line], ['b'])
+		self.assertEqual(p.repos['a']['repo'].rev_parse('refs/remotes/origin/master'), sha)
+		self.assertTrue('fetched 1 of 3 repos (1 already up to date)' in self.writer.string)
+
+	def test_publish(self):
+		'''test_publish - nothing is pushed unless every repo can be, and pushes are summarized by remote'''
+		p = self.project
+		def remote_master(name):
+			return rug.git.shell_cmd(rug.git.GIT, ['rev-parse', 'master'], cwd=os.path.join(self.remote_dir, name))
+		before = remote_master('a')
+		for name in ['a', 'b']:
+			make_local_repo(os.path.join(local_repo, name))
+		p.commit('publish', all=True)
+		p.repos['b']['repo'].remote_set_url('origin', 'file:///nowhere')
+		error = ''
+		try:
+			p.publish()
+		except rug.project.RugError, e:
+			error = str(e)
+		self.assertTrue(error.startswith('b: master cannot be pushed to origin'))
+		self.assertEqual(remote_master('a'), before)
+		self.assertFalse('pushed' in self.writer.string)
+
+		p.repos['b']['repo'].remote_set_url('origin', 'file://' + os.path.abspath(os.path.join(self.remote_dir, 'b')))
+		p.publish()
+		self.assertEqual(remote_master('a'), p.repos['a']['repo'].rev_parse('HEAD'))
+		self.assertTrue('remote origin: 2 pushed, 1 skipped, 0 failed' in self.writer.string)
+
+class ProjectConfigTestCase(unittest.TestCase):
+	'''Test cases for rug.Project's config file'''
+	def setUp(self):
+		self.project = rug.Project.init(local_repo)
+
+	def tearDown(self):
+		shutil.rmtree(local_repo)
+
+	def test_cache(self):
+		'''test_cache - the config file is reread only when it changes, and batches write once'''
+		p = self.project
+		config_path = os.path.join(p.rug_dir, rug.project.RUG_CONFIG)
+		with p.config_batch():
+			p.set_config('a', 'x', '1')
+			p.set_config('a', 'y', '2')
+			self.assertEqual(os.path.getsize(config_path), 0)
+		self.assertEqual(p.get_config('a'), {'x': '1', 'y': '2'})
+		self.assertTrue(p.config_file() is p.config_file())
+
+		#a change made behind the project's back is picked up
+		cf = rug.config.ConfigFile.from_path(config_path)
+		cf.set('a', 'x', '10')
+		cf.to_path(config_path)
+		self.assertEqual(p.get_config('a', 'x'), '10')
+
+		#even one keeping the file's size and mtime
+		st = os.stat(config_path)
+		cf.set('a', 'x', '11')
+		cf.to_path(config_path)
+		os.utime(config_path, (st.st_atime, st.st_mtime))
+		self.assertEqual(os.path.getsize(config_path), st.st_size)
+		self.assertEqual(p.get_config('a', 'x'), '11')
+
+		#changes made in a failed batch are dropped
+		try:
+			with p.config_batch():
+				p.set_config('a', 'z', '3')
+				raise ValueError('z')
+		except ValueError:
+			pass
+		self.assertRaises(KeyError, p.get_config, 'a', 'z')
+		self.assertEqual([f for f in os.listdir(p.rug_dir) if f.startswith('.')], [])
+
+class WatchTestCase(unittest.TestCase):
+	'''Test cases for rug.watch and Project.watch'''
+	def setUp(self):
+		if not rug.watch.available():
+			self.skipTest('filesystem watching is not available')
+
+	def tearDown(self):
+		if os.path.exists(local_repo):
+			shutil.rmtree(local_repo)
+
+	def test_watcher(self):
+		'''test_watcher - changes are reported by path, new directories are watched, and git internals are skipped'''
+		os.makedirs(os.path.join(local_repo, 'a', '.git', 'refs', 'heads'))
+		os.makedirs(os.path.join(local_repo, 'a', '.git', 'objects', '00'))
+		watcher = rug.watch.Watcher(local_repo)
+		try:
+			for path in ['a/f', 'a/.git/HEAD', 'a/.git/objects/00/obj', 'a/.git/refs/heads/master.lock']:
+				open(os.path.join(local_repo, path), 'w').close()
+			os.makedirs(os.path.join(local_repo, 'a', 'new'))
+			self.assertEqual(watcher.changes(), set(['a/f', 'a/.git/HEAD', 'a/new']))
+			open(os.path.join(local_repo, 'a', 'new', 'g'), 'w').close()
+			self.assertEqual(watcher.changes(), set(['a/new/g']))
+			self.assertEqual(watcher.changes(), set())
+		finally:
+			watcher.close()
+
+	def test_overflow(self):
+		'''test_overflow - after lost events, changes() returns None once, then the tree is watched afresh'''
+		os.makedirs(os.path.join(local_repo, 'a'))
+		watcher = rug.watch.Watcher(local_repo)
+		try:
+			read = watcher.read
+			watcher.read = lambda: read() + [(-1, rug.watch.IN_Q_OVERFLOW, '')]
+			os.makedirs(os.path.join(local_repo, 'a', 'b'))
+			self.assertEqual(watcher.changes(), None)
+			watcher.read = read
+			self.assertTrue('a/b' in watcher.wds)
+			open(os.path.join(local_repo, 'a', 'b', 'f'), 'w').close()
+			self.assertEqual(watcher.changes(), set(['a/b/f']))
+		finally:
+			watcher.close()
+
+	def test_dirty(self):
+		'''test_dirty - Project.dirty only examines the manifest again after it changes'''
+		p = rug.Project.init(local_repo)
+		self.assertTrue(p.watch())
+		calls = []
+		manifest_dirty = p.manifest_repo.dirty
+		def dirty():
+			calls.append(None)
+			return manifest_dirty()
+		p.manifest_repo.dirty = dirty
+		self.assertFalse(p.dirty())
+		self.assertFalse(p.dirty())
+		self.assertEqual(len(calls), 1)
+		p.remote_add('origin', 'file:///nowhere')
+		self.assertTrue(p.dirty())
+		self.assertEqual(len(calls), 2)
+		p.unwatch()
+
+class DaemonTestCase(unittest.TestCase):
+	'''Test cases for rug.daemon'''
+	def setUp(self):
+		make_local_project(local_repo)
+		#as daemon_command does
+		commands = dict([(c, rug.rug.rug_commands[c][0]) for c in ['status', 'revset', 'revset_list']])
+		self.daemon = rug.daemon.Daemon(local_repo, commands)
+		self.daemon.listen()
+		self.thread = threading.Thread(target=self.daemon.serve)
+		self.thread.start()
+
+	def tearDown(self):
+		rug.daemon.stop(local_repo)
+		self.thread.join()
+		shutil.rmtree(local_repo)
+
+	def query(self, command, args=[], options={}):
+		return list(rug.daemon.query(local_repo, command, options, args))
+
+	def local(self, command, optdict={}):
+		'local(command, optdict={}) -> what the command prints run in this process, without the daemon'
+		ret = rug.rug.rug_commands[command][0](rug.Project(local_repo), optdict)
+		if isinstance(ret, basestring):
+			ret = [ret]
+		return ''.join([chunk + '\n' for chunk in ret])
+
+	def run_command(self, argv):
+		'run_command(argv) -> what rug prints to stdout for argv, run from the project'
+		cwd = os.getcwd()
+		(stdout, stderr) = (sys.stdout, sys.stderr)
+		sys.stdout = StringIO.StringIO()
+		sys.stderr = StringIO.StringIO()
+		try:
+			os.chdir(local_repo)
+			rug.rug.run_command(argv, {})
+			return sys.stdout.getvalue()
+		finally:
+			os.chdir(cwd)
+			(sys.stdout, sys.stderr) = (stdout, stderr)
+
+	def test_refresh(self):
+		'''test_refresh - answers follow ref changes made by other processes'''
+		self.assertEqual(self.query('revset_list'), [('stdout', 'master'), ('stderr', '')])
+		manifest_dir = self.daemon.project.manifest_dir
+		rug.git.shell_cmd(rug.git.GIT, ['branch', 'other'], cwd=manifest_dir)
+		self.assertEqual(self.query('revset_list')[0], ('stdout', 'master\nother'))
+
+		#commands that change the project run locally
+		self.assertEqual(rug.daemon.query(local_repo, 'revset', {}, ['new']), None)
+
+	def test_status(self):
+		'''test_status - status from the daemon matches status run locally, before and after a file changes'''
+		calls = []
+		status = self.daemon.commands['status']
+		def counted_status(proj, optdict):
+			calls.append(optdict)
+			return status(proj, optdict)
+		self.daemon.commands['status'] = counted_status
+
+		before = {}
+		for optdict in [{}, {'-p': ''}]:
+			before[optdict.has_key('-p')] = self.local('status', optdict)
+			answer = ''.join([text + '\n' for (name, text) in self.query('status', options=optdict) if name == 'stdout'])
+			self.assertEqual(answer, before[optdict.has_key('-p')])
+
+		f = open(os.path.join(local_repo, 'a', 'file'), 'a')
+		f.write('changed\n')
+		f.close()
+		for argv in [['status'], ['status', '-p']]:
+			expected = self.local('status', dict.fromkeys(argv[1:], ''))
+			self.assertNotEqual(expected, before['-p' in argv])
+			self.assertEqual(self.run_command(argv), expected)
+		self.assertEqual(self.run_command(['revset_list']), self.local('revset_list'))
+		#run_command went through the daemon
+		self.assertEqual(len(calls), 4)
+
+	def test_stale_socket(self):
+		'''test_stale_socket - with a socket left behind by a daemon that died, commands run locally'''
+		self.assertTrue(rug.daemon.stop(local_repo))
+		self.thread.join()
+		self.assertFalse(os.path.exists(self.daemon.path))
+		#bound, but nothing listening
+		s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		s.bind(self.daemon.path)
+		s.close()
+		self.assertEqual(rug.daemon.query(local_repo, 'status', {}, []), None)
+		self.assertEqual(self.run_command(['status', '-p']), self.local('status', {'-p': ''}))
+		self.assertTrue(os.path.exists(self.daemon.path))
+
 class ProjectCloneTestCase(unittest.TestCase):
 	'''Test cases for rug.Project.clone'''
 	@classmethod